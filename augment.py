@@ -0,0 +1,506 @@
+'''
+On-the-fly augmented bubble/control cutouts for training.
+
+Instead of writing a new set of JPEGs for every hshift/vshift setting,
+AugmentedCutouts samples cutouts straight from the panorama pyramid at training
+time. Every batch draws random shifts (in pixels or relative to the bubble
+radius), flips, rotations and scale jitter, and renders all of its cutouts at
+once with one vectorized bilinear (or nearest) lookup. Quarter turns and flips
+keep the lookup separable, so it runs as a 1-D pass over the rows and one over
+the columns, about as cheap as a plain resize; any angle rotations need a full
+per-pixel lookup. Batches are made in worker
+processes, and each batch only depends on the seed and its number, so a run
+can be reproduced exactly.
+'''
+
+import concurrent.futures
+import os
+
+import numpy as np
+
+from cutout_stream import crop_borders, mirror_center
+
+#Pyramid and sample table of the current worker process, see _init_worker
+_worker_state = {}
+
+#Rotation modes: none, multiples of 90 degrees, or any angle
+ROTATIONS = (None, 'right', 'any')
+
+#Resampling modes of render_batch
+INTERPOLATIONS = ('bilinear', 'nearest')
+
+
+def sample_table(catalog, shape, pad=50, controls=True, control_centers=None):
+    '''
+    Returns:
+    ______________
+    dict of arrays 'x', 'y', 'r', 'label' (1 bubble, 0 control) and 'position'
+    (catalog position) with one row per bubble and, if controls, one per control.
+    Only rows whose unaugmented crop is inside the panorama are kept
+
+    Args:
+    --------------
+    catalog: converted BubbleCatalog (the x, y, r fields are filled in)
+    shape: panorama shape, (rows, cols, ...)
+    pad: int; the cutoutgen.py pad
+    controls: bool; if True, the controls are sampled too
+    control_centers: dict of {catalog position: (x, y)} or None for the mirror locations
+
+    '''
+
+    from catalog import FLAG_BAD_COORDS
+
+    positions = np.flatnonzero((catalog['flags'] & FLAG_BAD_COORDS) == 0)
+    x, y, r = catalog['x'][positions], catalog['y'][positions], catalog['r'][positions]
+    columns = [(x, y, r, np.ones(len(positions)), positions)]
+
+    if controls:
+        if control_centers is None:
+            control_x, control_y = mirror_center((x, y), shape)
+            kept = np.ones(len(positions), dtype=bool)
+        else:
+            kept = np.array([position in control_centers for position in positions], dtype=bool)
+            centers = [control_centers[position] for position in positions[kept]]
+            control_x = np.array([center[0] for center in centers], dtype=np.int64)
+            control_y = np.array([center[1] for center in centers], dtype=np.int64)
+        columns.append((control_x, control_y, r[kept], np.zeros(kept.sum()), positions[kept]))
+
+    table = dict((name, np.concatenate(values)) for name, values in
+                 zip(('x', 'y', 'r', 'label', 'position'), zip(*columns)))
+    table['label'] = table['label'].astype(np.uint8)
+
+    left, right, top, bot = crop_borders((table['x'], table['y']), table['r'], pad)
+    inside = (left >= 0) & (right <= shape[1] - 1) & (top >= 0) & (bot <= shape[0] - 1)
+
+    return dict((name, values[inside]) for name, values in table.items())
+
+
+def augmentation_parameters(table, batch_size, rng, pad=50, shift=0.0, relative_shift=False,
+                            flips=True, rotations='right', scale_jitter=0.0):
+    '''
+    Returns:
+    ______________
+    dict of per-sample arrays: 'row' (into the sample table), 'x', 'y' (shifted
+    center), 'half' (half the side of the sampled square), 'angle' (radians),
+    'flip_x', 'flip_y' (+1 or -1)
+
+    Args:
+    --------------
+    table: dict from sample_table
+    batch_size: int; samples drawn
+    rng: numpy Generator
+    pad: int; pixels added to the radius, as in cutoutgen.py
+    shift: float; maximum shift along each axis, in pixels, or as a fraction of
+           the radius if relative_shift is True
+    flips: bool; random horizontal and vertical flips
+    rotations: one of ROTATIONS; random quarter turns ('right') or any angle ('any')
+    scale_jitter: float; the side of the square is scaled by a factor drawn from
+                  [1 - scale_jitter, 1 + scale_jitter]
+
+    '''
+
+    if rotations not in ROTATIONS:
+        raise ValueError('rotations must be one of %s' % (ROTATIONS,))
+
+    row = rng.integers(0, len(table['x']), batch_size)
+    radius = table['r'][row].astype(np.float64)
+
+    limit = shift * radius if relative_shift else np.full(batch_size, float(shift))
+    dx, dy = rng.uniform(-1, 1, (2, batch_size)) * limit
+
+    ones = np.ones(batch_size)
+    if rotations == 'any':
+        angle = rng.uniform(0, 2 * np.pi, batch_size)
+    elif rotations == 'right':
+        angle = rng.integers(0, 4, batch_size) * (np.pi / 2)
+    else:
+        angle = 0 * ones
+
+    return {'row': row,
+            'x': table['x'][row] + dx,
+            'y': table['y'][row] + dy,
+            'half': (radius + pad) * rng.uniform(1 - scale_jitter, 1 + scale_jitter, batch_size),
+            'angle': angle,
+            'flip_x': np.where(rng.random(batch_size) < 0.5, -1, 1) if flips else ones,
+            'flip_y': np.where(rng.random(batch_size) < 0.5, -1, 1) if flips else ones}
+
+
+def render_batch(pyramid, parameters, dim=(224, 224, 3), interpolation='bilinear'):
+    '''
+    Returns:
+    ______________
+    uint8 array of shape (batch_size,) + dim; the augmented cutouts
+
+    Args:
+    --------------
+    pyramid: PanoramaPyramid of the panorama
+    parameters: dict from augmentation_parameters
+    dim: tuple; shape of a single cutout, up to 4 channels
+    interpolation: 'bilinear' or 'nearest'
+
+    Notes:
+    --------------
+    Every sample is read from the pyramid level closest to dim, and all samples
+    are then resampled together with one lookup. Parts of a rotated or shifted
+    square outside of the panorama repeat the edge pixels. When every angle is a
+    multiple of 90 degrees, the lookup is separable (one coordinate per output
+    row and column, see _separable_lookup) and the quarter turns are applied to
+    the result
+
+    '''
+
+    if interpolation not in INTERPOLATIONS:
+        raise ValueError('interpolation must be one of %s' % (INTERPOLATIONS,))
+
+    count = len(parameters['row'])
+    height, width, channels = dim[0], dim[1], dim[2]
+
+    #Pyramid level of every sample: the smallest one that still has dim pixels across
+    side = 2 * parameters['half']
+    level = np.floor(np.log2(np.maximum(side / min(height, width), 1)))
+    level = np.clip(level, 0, len(pyramid) - 1).astype(np.int64)
+    scale = 2.0 ** level
+
+    #Output pixel centers in [-1, 1]. float32 is plenty for coordinates below 2**24
+    grid_x = ((np.arange(width, dtype=np.float32) + 0.5) / width * 2 - 1)[None, None, :]
+    grid_y = ((np.arange(height, dtype=np.float32) + 0.5) / height * 2 - 1)[None, :, None]
+
+    def per_sample(values):
+        return np.asarray(values, dtype=np.float32)[:, None, None]
+
+    quarter_turns = np.rint(parameters['angle'] / (np.pi / 2)).astype(np.int64) % 4
+    separable = np.allclose(np.mod(parameters['angle'] - quarter_turns * np.pi / 2 + np.pi,
+                                   2 * np.pi) - np.pi, 0, atol=1e-9)
+    if separable and height != width:
+        separable = not (quarter_turns % 2).any()
+
+    #A quarter turn after the lookup swaps the axes, so the flips swap with them
+    flip_x, flip_y = parameters['flip_x'], parameters['flip_y']
+    if separable:
+        odd = quarter_turns % 2 == 1
+        flip_x, flip_y = np.where(odd, flip_y, flip_x), np.where(odd, flip_x, flip_y)
+
+    #Flipped, scaled and rotated into the pixel coordinates of each sample's level
+    along_x = per_sample(parameters['half'] * flip_x / scale) * grid_x
+    along_y = per_sample(parameters['half'] * flip_y / scale) * grid_y
+    center_x = per_sample((parameters['x'] + 0.5) / scale - 0.5)
+    center_y = per_sample((parameters['y'] + 0.5) / scale - 0.5)
+
+    if separable:
+        #(count, 1, width) column and (count, height, 1) row coordinates
+        source_x = center_x + along_x
+        source_y = center_y + along_y
+    else:
+        cos = per_sample(np.cos(parameters['angle']))
+        sin = per_sample(np.sin(parameters['angle']))
+        source_x = center_x + cos * along_x - sin * along_y
+        source_y = center_y + sin * along_x + cos * along_y
+
+    #Read the bounding box of every sample into one padded buffer
+    left = np.floor(source_x.min(axis=(1, 2))).astype(np.int64)
+    top = np.floor(source_y.min(axis=(1, 2))).astype(np.int64)
+    right = np.floor(source_x.max(axis=(1, 2))).astype(np.int64) + 2
+    bot = np.floor(source_y.max(axis=(1, 2))).astype(np.int64) + 2
+    for sample in range(count):
+        rows, cols = pyramid[level[sample]].shape[:2]
+        left[sample], right[sample] = np.clip((left[sample], right[sample]), 0, cols)
+        top[sample], bot[sample] = np.clip((top[sample], bot[sample]), 0, rows)
+        if right[sample] <= left[sample]:
+            left[sample] = min(left[sample], cols - 1)
+            right[sample] = left[sample] + 1
+        if bot[sample] <= top[sample]:
+            top[sample] = min(top[sample], rows - 1)
+            bot[sample] = top[sample] + 1
+
+    if separable:
+        return _separable_lookup(pyramid, level, source_x[:, 0, :], source_y[:, :, 0],
+                                 (left, right, top, bot), quarter_turns, channels, interpolation)
+
+    #Pixels are padded to 4 bytes, so one uint32 gather fetches all channels
+    buffer = np.zeros((count, (bot - top).max(), (right - left).max(), 4), dtype=np.uint8)
+    for sample in range(count):
+        region = pyramid[level[sample]][top[sample]:bot[sample], left[sample]:right[sample]]
+        buffer[sample, :region.shape[0], :region.shape[1], :channels] = region
+    packed = buffer.view(np.uint32).reshape(-1)
+
+    #Lookup, clamped to each sample's region
+    source_x = source_x - per_sample(left)
+    source_y = source_y - per_sample(top)
+    last_x = (right - left - 1)[:, None, None]
+    last_y = (bot - top - 1)[:, None, None]
+    base = np.arange(count)[:, None, None] * buffer.shape[1]
+
+    def pixels(row, column):
+        index = (base + row) * buffer.shape[2] + column
+        return packed[index].view(np.uint8).reshape(index.shape + (4,))[..., :channels]
+
+    if interpolation == 'nearest':
+        images = pixels(np.clip(np.floor(source_y + 0.5).astype(np.int64), 0, last_y),
+                        np.clip(np.floor(source_x + 0.5).astype(np.int64), 0, last_x))
+    else:
+        x0 = np.floor(source_x)
+        y0 = np.floor(source_y)
+        weight_x = np.clip(source_x - x0, 0, 1)[..., None]
+        weight_y = np.clip(source_y - y0, 0, 1)[..., None]
+        x0 = np.clip(x0.astype(np.int64), 0, last_x)
+        y0 = np.clip(y0.astype(np.int64), 0, last_y)
+        x1 = np.minimum(x0 + 1, last_x)
+        y1 = np.minimum(y0 + 1, last_y)
+
+        def blend(first, second, weight):
+            first = first.astype(np.float32)
+            return first + (second.astype(np.float32) - first) * weight
+
+        top_row = blend(pixels(y0, x0), pixels(y0, x1), weight_x)
+        bottom_row = blend(pixels(y1, x0), pixels(y1, x1), weight_x)
+        images = np.rint(top_row + (bottom_row - top_row) * weight_y).astype(np.uint8)
+
+    return images
+
+
+def axis_weights(source, last, length, interpolation='bilinear'):
+    '''
+    Returns:
+    ______________
+    scipy.sparse CSR matrix of shape (count * size, count * length); row k * size + i
+    interpolates output pixel i of sample k from sample k's region along one axis,
+    so the 1-D lookup of the whole batch is one block-diagonal matrix product
+
+    Args:
+    --------------
+    source: (count, size) array of coordinates in every sample's region
+    last: (count,) int array; last pixel of every region, coordinates are clamped to it
+    length: int; length of the regions in the padded buffer
+    interpolation: 'bilinear' (two taps per row) or 'nearest' (one)
+
+    '''
+
+    from scipy import sparse
+
+    count, size = source.shape
+    offset = (np.arange(count) * length)[:, None, None]
+    last = np.asarray(last)[:, None, None]
+    source = source[..., None]
+
+    if interpolation == 'nearest':
+        index = np.clip(np.floor(source + 0.5).astype(np.int64), 0, last)
+        weight = np.ones(index.shape, dtype=np.float32)
+    else:
+        first = np.floor(source)
+        second_weight = np.clip(source - first, 0, 1)
+        first = np.clip(first.astype(np.int64), 0, last)
+        index = np.concatenate([first, np.minimum(first + 1, last)], axis=-1)
+        weight = np.concatenate([1 - second_weight, second_weight], axis=-1).astype(np.float32)
+
+    taps = index.shape[-1]
+    return sparse.csr_matrix((weight.ravel(), (index + offset).ravel(),
+                              np.arange(0, count * size * taps + 1, taps)),
+                             shape=(count * size, count * length))
+
+
+def _separable_lookup(pyramid, level, source_x, source_y, borders, quarter_turns, channels,
+                      interpolation):
+    '''
+    Returns:
+    ______________
+    uint8 (count, height, width, channels) array; render_batch's lookup when every
+    output column has one source x (source_x, (count, width)) and every output row
+    one source y (source_y, (count, height)), turned by quarter_turns
+
+    Notes:
+    --------------
+    nearest indexes each region with the rounded rows and columns. bilinear is a
+    1-D interpolation of the rows of all samples and channels with one sparse matrix
+    product (two taps per output row), then the same along the columns. The planes
+    are kept channel first as in resize_kernel.py, which makes the transposes between
+    the two products cheap. Turning the rows towards the columns matches a positive
+    angle of the lookup, and is done while every sample is copied to the output
+    '''
+
+    left, right, top, bot = borders
+    count, width = source_x.shape
+    height = source_y.shape[1]
+    rows, cols = (bot - top).max(), (right - left).max()
+    source_x = source_x - left[:, None]
+    source_y = source_y - top[:, None]
+
+    images = np.empty((count, height, width, channels), dtype=np.uint8)
+    if interpolation == 'nearest':
+        for sample in range(count):
+            region = pyramid[level[sample]][top[sample]:bot[sample], left[sample]:right[sample]]
+            row = np.clip(np.floor(source_y[sample] + 0.5).astype(np.int64), 0, len(region) - 1)
+            column = np.clip(np.floor(source_x[sample] + 0.5).astype(np.int64), 0,
+                             region.shape[1] - 1)
+            images[sample] = np.rot90(region[row[:, None], column[None, :]],
+                                      quarter_turns[sample])
+        return images
+
+    #float32 straight away, the matrix products would convert the uint8 pixels anyway
+    buffer = np.zeros((count, channels, rows, cols), dtype=np.float32)
+    for sample in range(count):
+        region = pyramid[level[sample]][top[sample]:bot[sample], left[sample]:right[sample]]
+        buffer[sample, :, :region.shape[0], :region.shape[1]] = region.transpose(2, 0, 1)
+
+    #One block per sample and channel
+    along_y = axis_weights(np.repeat(source_y, channels, axis=0),
+                           np.repeat(bot - top - 1, channels), rows, interpolation)
+    along_x = axis_weights(np.repeat(source_x, channels, axis=0),
+                           np.repeat(right - left - 1, channels), cols, interpolation)
+
+    planes = along_y @ buffer.reshape(count * channels * rows, cols)
+    planes = planes.reshape(count * channels, height, cols).transpose(0, 2, 1)
+    planes = along_x @ planes.reshape(count * channels * cols, height)
+    planes = np.rint(planes).astype(np.uint8).reshape(count, channels, width, height)
+    for sample in range(count):
+        images[sample] = np.rot90(planes[sample].transpose(2, 1, 0), quarter_turns[sample])
+
+    return images
+
+
+def _init_worker(data_dir, cache_path, min_rows, table):
+
+    from pyramid import PanoramaPyramid
+
+    _worker_state['pyramid'] = PanoramaPyramid(data_dir, cache_path, rebuild=False,
+                                               min_rows=min_rows)
+    _worker_state['pyramid'].advise_random_access()
+    _worker_state['table'] = table
+
+
+def _make_batch(number, settings):
+    '''
+    Returns:
+    ______________
+    (images, labels, positions) of batch number, made in a worker process
+    '''
+
+    return make_batch(_worker_state['pyramid'], _worker_state['table'], number, **settings)
+
+
+def make_batch(pyramid, table, number, seed=0, batch_size=64, dim=(224, 224, 3),
+               interpolation='bilinear', **augmentation):
+    '''
+    Returns:
+    ______________
+    (images, labels, positions); uint8 (batch_size,) + dim cutouts, uint8 labels
+    (1 bubble, 0 control) and the catalog positions they were drawn for
+
+    '''
+
+    rng = np.random.default_rng([seed, number])
+    parameters = augmentation_parameters(table, batch_size, rng, **augmentation)
+    images = render_batch(pyramid, parameters, dim, interpolation)
+    row = parameters['row']
+
+    return (images, table['label'][row], table['position'][row])
+
+
+class AugmentedCutouts(object):
+    '''
+    Iterable of augmented (images, labels, positions) batches.
+
+    Args:
+    --------------
+    catalog: converted BubbleCatalog (the x, y, r fields are filled in)
+    pyramid: PanoramaPyramid of the panorama
+    batch_size: int; samples per batch
+    dim: tuple; shape of a single cutout
+    pad: int; pixels added to the radius, as in cutoutgen.py
+    shift: float; maximum shift along each axis, in pixels or (relative_shift) radii
+    relative_shift: bool; if True, shift is a fraction of the bubble radius
+    flips: bool; random horizontal and vertical flips
+    rotations: one of ROTATIONS; random quarter turns ('right') or any angle ('any')
+    scale_jitter: float; relative jitter of the cutout size
+    interpolation: 'bilinear' or 'nearest'
+    controls: bool; if True, controls are sampled with label 0 next to the bubbles
+    control_centers: dict of {catalog position: (x, y)} or None for the mirror locations
+    workers: int; worker processes, 0 renders in this process. Defaults to os.cpu_count()
+    batches: int or None; batches per pass, defaults to one per table row / batch_size
+    seed: int; the batches of a pass only depend on the seed and the pass number
+
+    Usage:
+    ______________
+    batches = AugmentedCutouts(catalog, pyramid, shift=0.2, relative_shift=True,
+                               scale_jitter=0.1, workers=4)
+    for images, labels, positions in batches:
+        model.train_on_batch(images, labels)
+
+    '''
+
+    def __init__(self, catalog, pyramid, batch_size=64, dim=(224, 224, 3), pad=50, shift=0.0,
+                 relative_shift=False, flips=True, rotations='right', scale_jitter=0.0,
+                 interpolation='bilinear', controls=True, control_centers=None, workers=None,
+                 batches=None, seed=0):
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        self.pyramid = pyramid
+        self.pyramid.advise_random_access()
+        self.table = sample_table(catalog, pyramid.shape, pad, controls, control_centers)
+        self.workers = workers
+        self.batches = batches or max(1, int(np.ceil(len(self.table['x']) / float(batch_size))))
+        self.passes = 0
+        self.settings = {'seed': seed, 'batch_size': batch_size, 'dim': tuple(dim), 'pad': pad,
+                         'shift': shift, 'relative_shift': relative_shift, 'flips': flips,
+                         'rotations': rotations, 'scale_jitter': scale_jitter,
+                         'interpolation': interpolation}
+        self._pool = None
+
+        if len(self.table['x']) == 0:
+            raise ValueError('no bubble or control crop is inside the panorama')
+
+    def __len__(self):
+        return self.batches
+
+    def batch(self, number):
+        '''
+        Returns:
+        ______________
+        (images, labels, positions) of batch number, rendered in this process
+        '''
+
+        return make_batch(self.pyramid, self.table, number, **self.settings)
+
+    def __iter__(self):
+        '''
+        One pass of self.batches batches. Every pass draws new augmentations
+        '''
+
+        first = self.passes * self.batches
+        self.passes = self.passes + 1
+        numbers = range(first, first + self.batches)
+
+        if self.workers == 0:
+            for number in numbers:
+                yield self.batch(number)
+            return
+
+        if self._pool is None:
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers, initializer=_init_worker,
+                initargs=(self.pyramid.data_dir, self.pyramid.cache_path,
+                          self.pyramid.min_rows, self.table))
+
+        #Keep two batches per worker in flight and hand them out in order
+        pending = []
+        numbers = iter(numbers)
+        for number in numbers:
+            pending.append(self._pool.submit(_make_batch, number, self.settings))
+            if len(pending) >= 2 * self.workers:
+                break
+        while pending:
+            future = pending.pop(0)
+            for number in numbers:
+                pending.append(self._pool.submit(_make_batch, number, self.settings))
+                break
+            yield future.result()
+
+    def close(self):
+        '''
+        Stop the worker processes
+        '''
+
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
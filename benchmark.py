@@ -0,0 +1,694 @@
+'''
+Stage benchmarks on synthetic survey data.
+
+bubble_mapping.py and cutoutgen.py read the real survey from
+../Desktop/mapping_data, which is not available everywhere (e.g. in CI).
+make_synthetic_survey writes a stand-in with the same geometry: 43 JPEG tiles of
+6000 rows and a configurable width, and a bubbly.csv catalog of a configurable
+number of random bubbles. run_benchmark times every stage on it separately and
+the results are written as JSON, together with the parameters and the commit,
+so runs can be compared between commits:
+
+python benchmark.py --tile-width 1000 --bubbles 2000 --output bench.json
+python benchmark.py --compare bench_before.json bench.json
+
+Stages:
+load      decode every tile (read_tile)
+stitch    build the memory-mapped panorama cache (decode + write, see panorama_cache.py)
+pyramid   build the pyramid levels
+catalog   read bubbly.csv
+convert   degrees to pixels for the whole catalog
+extract   read the bubble and control crops from the panorama (or the pyramid)
+resize    resize the crops to dim
+save      encode the cutouts as JPEG and write them
+metadata  combine catalog rows and saved cutouts into the dataset metadata
+join      the cutoutgen.py dict_adjust/merge_dicts of the bubble and control dicts
+pipeline  the whole extract-resize-save path through run_cutout_pipeline
+
+The bare import time of the scripts is measured as well, each in a fresh
+interpreter, and checked against IMPORT_TARGET_SECONDS:
+
+python benchmark.py --imports-only
+
+The resize kernels of resize_kernel.py are compared on synthetic crops, for their
+speed and their error against the skimage cutouts, with:
+
+python benchmark.py --resize-only --output resize.json
+
+The on-the-fly augmentation of augment.py is timed per rotation mode and
+interpolation, in samples per second of one process, with:
+
+python benchmark.py --augment-only --output augment.json
+'''
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from mosaic import NORTHGRID_TILES
+from resize_kernel import RESIZE_KERNELS
+
+#Geometry of the survey: 22 northgrid and 21 southgrid tiles of 6000 rows
+SURVEY_TILES = 43
+SURVEY_TILE_ROWS = 6000
+
+#Order in which the stages are run and reported
+STAGES = ('load', 'stitch', 'pyramid', 'catalog', 'convert', 'extract', 'resize', 'save',
+          'metadata', 'join', 'pipeline')
+
+#Script modules that must stay cheap to import, and the target for each
+IMPORT_MODULES = ('cutoutgen', 'bubble_mapping', 'word_frequency_barplot', 'cutout_client')
+IMPORT_TARGET_SECONDS = 0.5
+
+#Written into the work directory by the benchmark. Only a directory holding it is emptied
+WORK_DIR_MARKER = '.bubble_benchmark'
+
+#Samples per second of one process that the separable augmentations (no rotation or
+#quarter turns) should reach with --augment-only
+AUGMENT_TARGET_SAMPLES_PER_SECOND = 1000
+
+
+def synthetic_tile(rows, cols, rng, block=40):
+    '''
+    Returns:
+    ______________
+    uint8 (rows, cols, 3) image of smooth blobs with noise, which compresses and
+    decodes about like a survey tile (pure noise would be far slower)
+
+    '''
+
+    coarse = rng.integers(0, 256, (rows // block + 2, cols // block + 2, 3)).astype(np.float32)
+
+    #Bilinear upsampling of the coarse grid, one axis at a time
+    def upsample(values, size, axis):
+        position = (np.arange(size) + 0.5) / block
+        low = np.floor(position).astype(np.int64)
+        weight = (position - low).astype(np.float32)
+        shape = [1, 1, 1]
+        shape[axis] = size
+        weight = weight.reshape(shape)
+        return (np.take(values, low, axis=axis) * (1 - weight) +
+                np.take(values, low + 1, axis=axis) * weight)
+
+    image = upsample(upsample(coarse, rows, 0), cols, 1)
+    image += rng.normal(0, 8, (rows, cols, 1)).astype(np.float32)
+
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def synthetic_catalog(path, bubbles, rng, max_radius=12.0):
+    '''
+    Write a bubbly.csv style catalog of random bubbles inside the survey range
+
+    Args:
+    --------------
+    path: string; the csv to write
+    bubbles: int; number of rows
+    rng: numpy Generator
+    max_radius: float; largest reff. Unit: arcminutes (as in bubbly.csv)
+
+    '''
+
+    from coords import GLON_RANGE, galactic_to_equatorial
+
+    #Wrapped glon runs from GLON_RANGE[1] to GLON_RANGE[0]; unwrap it back to [0, 360)
+    glon = rng.uniform(GLON_RANGE[1], GLON_RANGE[0], bubbles)
+    glon = np.where(glon < 0, glon + 360, glon)
+    glat = rng.uniform(-0.8, 0.8, bubbles)
+
+    #Log-uniform radii: many small bubbles, a few huge ones
+    reff = np.exp(rng.uniform(np.log(0.2), np.log(max_radius), bubbles))
+    hit = np.round(rng.uniform(0, 1, bubbles), 3)
+    ra, dec = galactic_to_equatorial(glon, glat)
+
+    with open(path, 'w') as csv_file:
+        csv_file.write('id,glon,glat,reff,hit,ra,dec\n')
+        for number in range(bubbles):
+            values = (glon[number], glat[number], reff[number], hit[number], ra[number],
+                      dec[number])
+            csv_file.write('1G%06d,%s\n' % (number, ','.join(repr(float(value))
+                                                             for value in values)))
+
+
+def make_synthetic_survey(data_dir, tile_width=1000, bubbles=1000, tiles=SURVEY_TILES,
+                          rows=SURVEY_TILE_ROWS, seed=0):
+    '''
+    Returns:
+    ______________
+    string; path of the synthetic bubbly.csv in data_dir
+
+    Args:
+    --------------
+    data_dir: string; created if needed. Existing tiles with the same geometry are kept
+    tile_width: int; columns per tile (the survey tiles have 9000)
+    bubbles: int; catalog size
+    tiles, rows: int; tile count and tile rows, the survey geometry by default
+    seed: int; the same seed writes the same tiles and catalog
+
+    '''
+
+    from cutout_writer import encode_jpeg
+    from mosaic import probe_tile_shape
+
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+
+    rng = np.random.default_rng(seed)
+    for number in range(tiles):
+        #Named like the survey: the northgrid tiles sort before the southgrid ones
+        grid = 'north' if number < NORTHGRID_TILES else 'south'
+        path = os.path.join(data_dir, 'tile%02d_%s.jpg' % (number, grid))
+        tile_rng = np.random.default_rng([seed, number])
+        if os.path.exists(path) and probe_tile_shape(path) == (rows, tile_width, 3):
+            continue
+        with open(path, 'wb') as tile_file:
+            tile_file.write(encode_jpeg(synthetic_tile(rows, tile_width, tile_rng)))
+
+    catalog_path = os.path.join(data_dir, 'bubbly.csv')
+    synthetic_catalog(catalog_path, bubbles, rng)
+
+    return catalog_path
+
+
+def git_commit(directory=None):
+    '''
+    Returns:
+    ______________
+    string; the commit checked out in directory (default: this file's), or None
+    '''
+
+    if directory is None:
+        directory = os.path.dirname(os.path.abspath(__file__))
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=directory,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class StageTimer(object):
+    '''
+    Collects the wall time, item count and bytes of the benchmark stages.
+
+    Usage:
+    ______________
+    timer = StageTimer()
+    with timer.stage('load', items=43) as stage:
+        ...
+        stage['bytes'] = total
+    timer.add('resize', seconds, items=1)
+
+    '''
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, name, seconds, items=0, nbytes=0):
+
+        stage = self.stages.setdefault(name, {'stage': name, 'seconds': 0.0, 'items': 0,
+                                              'bytes': 0})
+        stage['seconds'] = stage['seconds'] + seconds
+        stage['items'] = stage['items'] + items
+        stage['bytes'] = stage['bytes'] + nbytes
+
+        return stage
+
+    @contextlib.contextmanager
+    def stage(self, name, items=0):
+
+        values = {'items': items, 'bytes': 0}
+        start = time.perf_counter()
+        yield values
+        self.add(name, time.perf_counter() - start, values['items'], values['bytes'])
+
+    def report(self):
+        '''
+        Returns:
+        ______________
+        list of stage dicts in STAGES order, with items_per_second and megabytes_per_second
+        '''
+
+        stages = []
+        for name in STAGES:
+            if name not in self.stages:
+                continue
+            stage = dict(self.stages[name])
+            seconds = stage['seconds']
+            stage['items_per_second'] = stage['items'] / seconds if seconds > 0 else 0.0
+            stage['megabytes_per_second'] = (stage['bytes'] / 1024.0 ** 2 / seconds
+                                             if seconds > 0 else 0.0)
+            stages.append(stage)
+
+        return stages
+
+
+def run_benchmark(data_dir, work_dir, pad=50, dim=(224, 224, 3), use_pyramid=True, workers=None,
+                  pipeline=True, resize_kernel='skimage'):
+    '''
+    Returns:
+    ______________
+    list of stage dicts (see StageTimer.report)
+
+    Args:
+    --------------
+    data_dir: string; survey tiles and bubbly.csv, e.g. from make_synthetic_survey
+    work_dir: string; scratch directory for the cache, cutouts and dataset. It must be
+              new, empty, or a work directory of an earlier benchmark, which is
+              emptied first. Any other directory raises a ValueError
+    pad, dim: the cutoutgen.py loop parameters
+    use_pyramid: bool; if True, crops are read from the pyramid like cutoutgen.py does
+    workers: int; processes for the stitch and pyramid stages, defaults to os.cpu_count()
+    pipeline: bool; if True, also time the whole run_cutout_pipeline
+    resize_kernel: string; kernel of the resize and pipeline stages, see resize_kernel.py
+
+    '''
+
+    from catalog import BubbleCatalog
+    from cutout_pipeline import read_pyramid_regions, read_regions, resize_regions
+    from cutout_pipeline import run_cutout_pipeline
+    from cutout_stream import plan_cutouts
+    from cutout_writer import CutoutWriter, encode_jpeg
+    from cutoutgen import dict_adjust, merge_dicts
+    from dataset import write_metadata
+    from mosaic import ordered_tile_names, read_tile
+    from panorama_cache import build_panorama_cache
+    from pyramid import PanoramaPyramid
+
+    if os.path.isdir(work_dir) and os.listdir(work_dir):
+        if not os.path.exists(os.path.join(work_dir, WORK_DIR_MARKER)):
+            raise ValueError('%s is not empty and is not a benchmark work directory, choose a '
+                             'new or empty one' % work_dir)
+        shutil.rmtree(work_dir)
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    open(os.path.join(work_dir, WORK_DIR_MARKER), 'w').close()
+    cache_path = os.path.join(work_dir, 'final_panorama.u8')
+    timer = StageTimer()
+
+    names = ordered_tile_names(data_dir)
+    with timer.stage('load', items=len(names)) as stage:
+        for name in names:
+            stage['bytes'] += read_tile(os.path.join(data_dir, name)).nbytes
+
+    with timer.stage('stitch', items=len(names)) as stage:
+        panorama = build_panorama_cache(data_dir, cache_path, workers=workers)
+        stage['bytes'] = panorama.nbytes
+
+    with timer.stage('pyramid') as stage:
+        pyramid = PanoramaPyramid(data_dir, cache_path, workers=workers)
+        stage['items'] = len(pyramid) - 1
+        stage['bytes'] = sum(pyramid[level].nbytes for level in range(1, len(pyramid)))
+
+    with timer.stage('catalog') as stage:
+        catalog = BubbleCatalog.from_csv(os.path.join(data_dir, 'bubbly.csv'))
+        stage['items'] = len(catalog)
+
+    with timer.stage('convert', items=len(catalog)):
+        catalog.convert(panorama)
+
+    #Extract, resize and save alternate per pair, so only one pair is held at a time
+    saved = []
+    save_dir = os.path.join(work_dir, 'cutouts')
+    with CutoutWriter(save_dir) as writer:
+        for item in plan_cutouts(catalog, panorama.shape, pad):
+            start = time.perf_counter()
+            if use_pyramid:
+                regions = read_pyramid_regions(pyramid, dim[0], item)
+            else:
+                regions = read_regions(panorama, item)
+            timer.add('extract', time.perf_counter() - start, 2,
+                      regions[1].nbytes + regions[2].nbytes)
+
+            start = time.perf_counter()
+            record, bubble, control = resize_regions(dim, np.uint8, regions,
+                                                     kernel=resize_kernel)
+            timer.add('resize', time.perf_counter() - start, 2)
+
+            start = time.perf_counter()
+            bubble_jpeg, control_jpeg = encode_jpeg(bubble), encode_jpeg(control)
+            locations = (writer.write(record.name + ".jpg", bubble_jpeg),
+                         writer.write(record.name + "_control.jpg", control_jpeg))
+            timer.add('save', time.perf_counter() - start, 2, len(bubble_jpeg) + len(control_jpeg))
+            saved.append((record,) + locations)
+
+    dataset_dir = os.path.join(work_dir, 'dataset')
+    os.makedirs(dataset_dir)
+    with timer.stage('metadata', items=2 * len(saved)):
+        write_metadata(dataset_dir, catalog, saved, cutout_dir=save_dir, dim=dim)
+
+    #The same dicts cutoutgen.run_cutoutgen joins
+    cutout_dict = dict((record.name, (bubble, record.radius, record.hitrate,
+                                      record.bubble_center)) for record, bubble, control in saved)
+    control_dict = dict((record.name + "_control", (control, record.radius, record.hitrate,
+                                                    record.control_center,
+                                                    record.control_coordinates))
+                        for record, bubble, control in saved)
+    bubble_dict = dict((name, catalog.numerics(i)) for i, name in enumerate(catalog.ids))
+    with timer.stage('join', items=2 * len(saved)):
+        merge_dicts(dict_adjust(bubble_dict, cutout_dict), dict_adjust(bubble_dict, control_dict))
+
+    if pipeline:
+        with timer.stage('pipeline') as stage:
+            results = run_cutout_pipeline(catalog, panorama, os.path.join(work_dir, 'pipeline'),
+                                          pad=pad, dim=dim,
+                                          pyramid=pyramid if use_pyramid else None,
+                                          resize_kernel=resize_kernel)
+            stage['items'] = 2 * len(results)
+
+    return timer.report()
+
+
+def benchmark_resize(dim=(224, 224, 3), pairs=200, seed=0):
+    '''
+    Returns:
+    ______________
+    list of dicts, one per kernel of resize_kernel.RESIZE_KERNELS: 'kernel',
+    'seconds', 'warm_seconds', 'pairs_per_second', 'speedup' (over skimage),
+    'max_error', 'mean_error', 'differing_fraction' and 'psnr'
+
+    Args:
+    --------------
+    dim: cutout shape
+    pairs: int; number of bubble/control crop pairs resized by every kernel
+    seed: int; seed of the crops
+
+    Notes:
+    --------------
+    The crops are cut from synthetic_tile texture and are between dim / 2 and
+    2 * dim across, like the pyramid crops (the small ones are upsampled). seconds
+    is the first pass, which builds the weight matrices, warm_seconds a second one.
+    The errors are of the uint8 cutouts against the skimage ones, in levels
+
+    '''
+
+    from cutout_pipeline import resize_regions
+    from resize_kernel import kernel_weights
+
+    rng = np.random.default_rng(seed)
+    texture = synthetic_tile(4 * dim[0], 4 * dim[1], rng)
+    items = []
+    for pair in range(pairs):
+        rows = int(rng.integers(dim[0] // 2, 2 * dim[0]))
+        cols = rows + int(rng.integers(0, 2))
+        crops = []
+        for crop in range(2):
+            top = int(rng.integers(0, texture.shape[0] - rows))
+            left = int(rng.integers(0, texture.shape[1] - cols))
+            crops.append(np.array(texture[top:top + rows, left:left + cols]))
+        items.append((pair, crops[0], crops[1]))
+
+    results = []
+    reference = None
+    for kernel in RESIZE_KERNELS:
+        kernel_weights.cache_clear()
+        start = time.perf_counter()
+        cutouts = np.array([resize_regions(dim, np.uint8, item, kernel=kernel)[1:]
+                            for item in items])
+        seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for item in items:
+            resize_regions(dim, np.uint8, item, kernel=kernel)
+        warm_seconds = time.perf_counter() - start
+
+        if reference is None:
+            reference, reference_seconds = (cutouts, warm_seconds)
+        error = np.abs(cutouts.astype(np.int16) - reference)
+        mse = np.mean(error.astype(np.float64) ** 2)
+
+        results.append({'kernel': kernel, 'seconds': seconds, 'warm_seconds': warm_seconds,
+                        'pairs_per_second': pairs / warm_seconds,
+                        'speedup': reference_seconds / warm_seconds,
+                        'max_error': int(error.max()), 'mean_error': float(error.mean()),
+                        'differing_fraction': float(np.mean(error > 0)),
+                        'psnr': 10 * np.log10(255.0 ** 2 / mse) if mse > 0 else None})
+        print("Status: resize %-8s %7.3f s  warm %7.3f s  %7.1f pairs/s  x%5.2f  "
+              "max error %d  mean error %.4f  differing %.4f%%" % (
+                  kernel, seconds, warm_seconds, pairs / warm_seconds,
+                  reference_seconds / warm_seconds, error.max(), error.mean(),
+                  100 * np.mean(error > 0)))
+
+    return results
+
+
+def benchmark_augment(dim=(224, 224, 3), batches=8, batch_size=64, seed=0,
+                      target=AUGMENT_TARGET_SAMPLES_PER_SECOND):
+    '''
+    Returns:
+    ______________
+    list of dicts, one per rotation mode of augment.ROTATIONS and interpolation:
+    'rotations', 'interpolation', 'seconds', 'samples', 'samples_per_second' and,
+    for the separable modes (no rotation or quarter turns), 'target' and
+    'within_target'
+
+    Args:
+    --------------
+    dim: cutout shape
+    batches: int; batches rendered per mode, after one warm-up batch
+    batch_size: int; samples per batch
+    seed: int; seed of the panorama, the sample table and the augmentations
+    target: float; samples per second the separable modes are checked against
+
+    Notes:
+    --------------
+    The pyramid is built in memory from a synthetic_tile strip of 2048 x 8192
+    pixels, and the bubbles have radii of 10 to 400 pixels, so the samples are
+    read from all the levels. Every batch draws shifts, flips and a 10% scale jitter
+
+    '''
+
+    import augment
+    from pyramid import downsample_blocks
+
+    rng = np.random.default_rng(seed)
+    levels = [synthetic_tile(2048, 8192, rng)]
+    while levels[-1].shape[0] // 2 >= dim[0]:
+        levels.append(downsample_blocks(levels[-1]).astype(np.uint8))
+
+    count = 300
+    table = {'x': rng.integers(600, 7600, count), 'y': rng.integers(600, 1400, count),
+             'r': rng.integers(10, 400, count), 'label': np.ones(count, dtype=np.uint8),
+             'position': np.arange(count)}
+
+    results = []
+    for rotations in augment.ROTATIONS:
+        for interpolation in augment.INTERPOLATIONS:
+            seconds = 0.0
+            for number in range(batches + 1):
+                parameters = augment.augmentation_parameters(
+                    table, batch_size, np.random.default_rng([seed, number]), shift=5,
+                    rotations=rotations, scale_jitter=0.1)
+                start = time.perf_counter()
+                augment.render_batch(levels, parameters, dim, interpolation)
+                if number > 0:
+                    seconds = seconds + time.perf_counter() - start
+
+            samples = batches * batch_size
+            result = {'rotations': rotations, 'interpolation': interpolation,
+                      'seconds': seconds, 'samples': samples,
+                      'samples_per_second': samples / seconds}
+            flag = ''
+            if rotations != 'any':
+                result.update(target=target, within_target=samples / seconds >= target)
+                flag = '' if result['within_target'] else '  BELOW TARGET (%d)' % target
+            results.append(result)
+            print("Status: augment %-5s %-8s %7.3f s  %8.1f samples/s%s" % (
+                rotations, interpolation, seconds, samples / seconds, flag))
+
+    return results
+
+
+def compare_results(before, after, threshold=0.10):
+    '''
+    Returns:
+    ______________
+    list of (stage, seconds before, seconds after, ratio, regressed) tuples for the
+    stages in both results. regressed is True when after is more than threshold slower
+
+    Args:
+    --------------
+    before, after: dicts as written by main, or paths to them
+
+    '''
+
+    results = []
+    for result in (before, after):
+        if isinstance(result, str):
+            with open(result) as result_file:
+                result = json.load(result_file)
+        results.append(dict((stage['stage'], stage) for stage in result['stages']))
+
+    rows = []
+    for name in STAGES:
+        if name not in results[0] or name not in results[1]:
+            continue
+        old, new = results[0][name]['seconds'], results[1][name]['seconds']
+        ratio = new / old if old > 0 else float('inf')
+        rows.append((name, old, new, ratio, ratio > 1 + threshold))
+
+    return rows
+
+
+def import_seconds(module, repeat=3):
+    '''
+    Returns:
+    ______________
+    float; the fastest of repeat bare imports of module, each in a fresh
+    interpreter started in this file's directory. The interpreter startup is not counted
+
+    '''
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    code = ('import time; start = time.perf_counter(); import %s; '
+            'print(time.perf_counter() - start)' % module)
+
+    return min(float(subprocess.check_output([sys.executable, '-c', code], cwd=directory))
+               for attempt in range(repeat))
+
+
+def measure_imports(modules=IMPORT_MODULES, target=IMPORT_TARGET_SECONDS):
+    '''
+    Returns:
+    ______________
+    list of {'module', 'seconds', 'target_seconds', 'within_target'} dicts
+    '''
+
+    results = []
+    for module in modules:
+        seconds = import_seconds(module)
+        results.append({'module': module, 'seconds': seconds, 'target_seconds': target,
+                        'within_target': seconds <= target})
+        print("Status: import %-24s %6.3f s  (target %.2f s)%s" % (
+            module, seconds, target, '' if seconds <= target else '  OVER TARGET'))
+
+    return results
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Time the mapping/cutout stages on synthetic data.')
+    parser.add_argument('--data-dir', default=None,
+                        help='survey directory; synthetic data is written there if it has no tiles')
+    parser.add_argument('--work-dir', default=None,
+                        help='new or empty scratch directory, a temporary one by default')
+    parser.add_argument('--tile-width', type=int, default=1000)
+    parser.add_argument('--bubbles', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--pad', type=int, default=50)
+    parser.add_argument('--size', type=int, default=224)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--no-pyramid', action='store_true', help='crop from the full resolution')
+    parser.add_argument('--no-pipeline', action='store_true', help='skip the pipeline stage')
+    parser.add_argument('--output', default=None, help='JSON results file, printed if not given')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='compare two results files instead of running')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='relative slowdown reported as a regression by --compare')
+    parser.add_argument('--imports-only', action='store_true',
+                        help='only measure the import times; exit 1 when one is over target')
+    parser.add_argument('--import-target', type=float, default=IMPORT_TARGET_SECONDS)
+    parser.add_argument('--resize-kernel', choices=RESIZE_KERNELS, default='skimage',
+                        help='kernel of the resize and pipeline stages')
+    parser.add_argument('--resize-only', action='store_true',
+                        help='only compare the resize kernels on synthetic crops')
+    parser.add_argument('--resize-pairs', type=int, default=200,
+                        help='crop pairs resized by every kernel with --resize-only')
+    parser.add_argument('--augment-only', action='store_true',
+                        help='only time the augmentations of augment.py on a synthetic pyramid')
+    parser.add_argument('--augment-batches', type=int, default=8,
+                        help='batches of 64 rendered per augmentation mode with --augment-only')
+    args = parser.parse_args(argv)
+
+    if args.imports_only:
+        imports = measure_imports(target=args.import_target)
+        return 0 if all(entry['within_target'] for entry in imports) else 1
+
+    if args.compare:
+        regressions = 0
+        for name, old, new, ratio, regressed in compare_results(*args.compare,
+                                                                threshold=args.threshold):
+            print('%-10s %10.3f s %10.3f s  x%.2f%s' % (name, old, new, ratio,
+                                                      '  REGRESSION' if regressed else ''))
+            regressions = regressions + regressed
+        return 1 if regressions else 0
+
+    if args.resize_only or args.augment_only:
+        result = {'commit': git_commit(),
+                  'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  'python': platform.python_version(),
+                  'numpy': np.__version__,
+                  'platform': platform.platform(),
+                  'parameters': {'size': args.size, 'seed': args.seed}}
+        if args.resize_only:
+            result['parameters']['pairs'] = args.resize_pairs
+            result['resize'] = benchmark_resize(dim=(args.size, args.size, 3),
+                                                pairs=args.resize_pairs, seed=args.seed)
+        if args.augment_only:
+            result['parameters']['batches'] = args.augment_batches
+            result['augment'] = benchmark_augment(dim=(args.size, args.size, 3),
+                                                  batches=args.augment_batches, seed=args.seed)
+        text = json.dumps(result, indent=2)
+        if args.output:
+            with open(args.output, 'w') as output_file:
+                output_file.write(text + '\n')
+        else:
+            print(text)
+        return 0
+
+    imports = measure_imports(target=args.import_target)
+    scratch = tempfile.mkdtemp(prefix='bubble_benchmark_')
+    data_dir = args.data_dir or os.path.join(scratch, 'mapping_data')
+    work_dir = args.work_dir or os.path.join(scratch, 'work')
+
+    try:
+        start = time.perf_counter()
+        if not any(name.endswith('.jpg') for name in
+                   (os.listdir(data_dir) if os.path.isdir(data_dir) else [])):
+            make_synthetic_survey(data_dir, args.tile_width, args.bubbles, seed=args.seed)
+        generate_seconds = time.perf_counter() - start
+
+        stages = run_benchmark(data_dir, work_dir, pad=args.pad, dim=(args.size, args.size, 3),
+                               use_pyramid=not args.no_pyramid, workers=args.workers,
+                               pipeline=not args.no_pipeline, resize_kernel=args.resize_kernel)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    result = {'commit': git_commit(),
+              'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'platform': platform.platform(),
+              'cpu_count': os.cpu_count(),
+              'parameters': {'tile_width': args.tile_width, 'bubbles': args.bubbles,
+                             'seed': args.seed, 'pad': args.pad, 'size': args.size,
+                             'workers': args.workers, 'pyramid': not args.no_pyramid,
+                             'data_dir': args.data_dir, 'resize_kernel': args.resize_kernel},
+              'generate_seconds': generate_seconds,
+              'imports': imports,
+              'stages': stages}
+
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(text + '\n')
+    for stage in stages:
+        print("Status: %-8s %8.3f s  %6d items  %8.1f items/s" % (
+            stage['stage'], stage['seconds'], stage['items'], stage['items_per_second']))
+    if not args.output:
+        print(text)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
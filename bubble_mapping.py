@@ -3,141 +3,146 @@
 Map the large bubble data discussed in the paper presented by Simpson et al. to
 a given set of images of the galactic plane captured by Spitzer.
 
-"""
-import os
-import matplotlib
-import sys
-import collections
-import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
-from skimage import io
-from skimage import util
-from matplotlib.patches import Circle
-
-
-#Read in the csv bubble data as a DataFrame. Change directory as needed.
-bubble_data = pd.read_csv("../Desktop/mapping_data/bubbly.csv")
-
-#Convert the DataFrame into a numpy array
-bubble_data = bubble_data.values
-
-#Create array that contains the IDs
-IDs = bubble_data[:,0].reshape((3744,1))
-
-#Create an array that contains the glon,glat coordinates in degrees and the
-#effective radius in degrees
-glon_glat_reff = (np.vstack((bubble_data[:,1],bubble_data[:,2],bubble_data[:,3]/60))).T
-
-#Initialize a dictionary to store the bubble data
-bubble_dict = {}
-
-#Create the dictionary from the arrays above
-for i in range(0,3744):
-    bubble_dict[IDs[i,0]] = (glon_glat_reff[i,0],glon_glat_reff[i,1],glon_glat_reff[i,2])
-
-#Initialize list to store image names
-image_names = []
+Importing this module has no side effects and only loads numpy; matplotlib is
+loaded when a map is shown. From the command line:
 
-#Initialize ordered dictionary to store name:value pairs
-image_dict = collections.OrderedDict()
+python bubble_mapping.py --data-dir ../Desktop/mapping_data
 
-#Load the sorted image values and names into their respective lists
-for file in sorted(os.listdir("../Desktop/mapping_data")):
-    if file.endswith(".jpg"):
-        image_names.append(file) 
-        with open(os.path.join("../Desktop/mapping_data", file), 'rb') as myfile:
-            image_dict[file] = io.imread(myfile.name)
-            print("Status: Loaded image %s" %file)
-
-#Initialize list to store all of the individual image arrays
-image_list_unordered = []
-
-#Put the image arrays from the dictionary of images into the initialized array
-for value in image_dict.values():
-    image_list_unordered.append(value)
-
-#Split previously created list of all of the images into their respective northgrid/
-#southgrid categories. They are considered "unsorted" because they don't yet align
-#spatially
-northgrid_unordered_list = image_list_unordered[0:22]
-southgrid_unordered_list = image_list_unordered[22:43]
-
-#Align the list of images in each grid spatially
-northgrid_list = northgrid_unordered_list[::-1]
-southgrid_list = southgrid_unordered_list[::-1]
+"""
+import argparse
+import os
 
-#Construct the spatially oriented northgrid and southgrid arrays
-northgrid = np.concatenate(northgrid_list, axis=1)
-southgrid = np.concatenate(southgrid_list, axis=1)
+from coords import degrees_to_pixels
 
-#Stitch the northgrid and southgrid together to make a HUGE image
-final_panorama = np.concatenate((northgrid,southgrid), axis=1)
+#Default location of the survey tiles and bubbly.csv. Change directory as needed.
+DATA_DIR = "../Desktop/mapping_data"
 
 
 def degree_to_index(glon, glat, reff, array):
     '''
     Returns array index tuple cooresponding to the glon, glat values
     And a converted effective radius pixel value
-    
+
     Args:
     --------------
     glon: Floating. Galactic longitude. Unit: degrees. Expects range: [0:360]
     glat: Floating. Galactic latitude. Unit: degrees. Expects range: [-1:1]
     reff: floating. Unit: degrees.
     array: a numpy ndarray
-    
+
     Usage: index = degree_to_index(220.34, -0.4, 0.0348, my_image_array)
 
     '''
 
-    #Make sure input is good
-    if glon < 0 or glon > 360:
-        print('arg error: glon is out of acceptable range')
-    if glat < -1 or glat > 1:
-        print('arg error: glat is out of acceptable range')
-    if reff < 0:
-        print('arg error: radius must be positive')
-
-    #Regulate glon input to make the spherical wraparound less annoying
-    if glon <= 360 and glon >= 295.5:
-        glon = glon - 360
-
-    #Get array shape
-    rows = array.shape[0]
-    cols = array.shape[1]
-
-    #Set up the degree range for glon and glat based on the array shape
-    glat_range = np.linspace(1,-1,rows)
-    glon_range = np.linspace(64.5, -64.5, cols)
-
-    #Get the index based on closes value
-    glat_idx = (np.abs(glat_range - glat)).argmin()
-    glon_idx = (np.abs(glon_range - glon)).argmin()
-
-    #Get the effective pixel radius
-    radius_in_pixels = int(reff * 3000)
-    
+    #Use the closed form batch conversion on a single bubble. It also checks the input
+    glon_idx, glat_idx, radius_in_pixels = (int(value[0]) for value in
+                                            degrees_to_pixels([glon], [glat], [reff], array))
+
     return (glon_idx, glat_idx, radius_in_pixels)
 
 
-#Initialize bubble dictionary for storing the id and its respective x,y array location
-#along with the effective radius in pixels
-bubble_dict_idx = {}
+def load_bubble_map(data_dir=DATA_DIR, catalog_path=None):
+    '''
+    Returns:
+    ______________
+    (catalog, pyramid, degree_index, pixel_index); the converted BubbleCatalog, the
+    PanoramaPyramid and the SpatialIndex over the catalog in degree and pixel space
+
+    Args:
+    --------------
+    data_dir: string; directory containing the survey tiles
+    catalog_path: string; bubble csv, defaults to data_dir/bubbly.csv
+
+    '''
+
+    from catalog import BubbleCatalog
+    from pyramid import PanoramaPyramid
+    from spatial_index import SpatialIndex
+
+    if catalog_path is None:
+        catalog_path = os.path.join(data_dir, 'bubbly.csv')
+
+    #Read in the csv bubble data as a columnar catalog
+    #Fields: id, glon, glat, reff (degrees), hitrate, ra, dec, x, y, r, flags
+    catalog = BubbleCatalog.from_csv(catalog_path)
 
-#Convert degree values to array index values
-for ID, degree_tuple in bubble_dict.items():
-    bubble_dict_idx[ID] = degree_to_index(degree_tuple[0],degree_tuple[1],
-                                          degree_tuple[2], final_panorama)
+    #Memory-map the stitched panorama and its power-of-two pyramid. The tiles are decoded
+    #once into a cache next to them, so the HUGE image is never held in memory
+    pyramid = PanoramaPyramid(data_dir)
 
-#Put it all together!!!! Plot the image with the bubbles on it
-fig,ax = plt.subplots()
-ax.imshow(final_panorama)
-ax.set_aspect('equal')
-for pixel_tuple in bubble_dict_idx.values():
-    ax.add_patch(Circle((pixel_tuple[0],pixel_tuple[1]),pixel_tuple[2],
-                         facecolor='none',edgecolor='b'))
-plt.show()
+    #Convert degree values to array index values for the whole catalog at once
+    catalog.convert(pyramid[0])
 
+    #Grid indexes for region queries, e.g. degree_index.window(10, 12, -0.5, 0.5) for the
+    #bubbles in a glon/glat window or pixel_index.nearest(x, y, k=5) for the closest bubbles
+    degree_index = SpatialIndex.from_catalog(catalog, space='degrees')
+    pixel_index = SpatialIndex.from_catalog(catalog, space='pixels')
+
+    return (catalog, pyramid, degree_index, pixel_index)
+
+
+def show_bubble_map(catalog, pyramid, pixel_index=None, interactive_viewer=True,
+                    screen_width=4000, show=True):
+    '''
+    Returns:
+    ______________
+    (fig, ax, viewer); viewer is the BubbleViewer, or None for the static map
+
+    Args:
+    --------------
+    catalog: converted BubbleCatalog
+    pyramid: PanoramaPyramid of the panorama
+    pixel_index: SpatialIndex over the catalog in pixel space, built if None
+    interactive_viewer: bool; if True, only the visible region is drawn, from the
+                        pyramid level matching the zoom, with the bubbles inside it
+                        as one collection. It refreshes on pan and zoom
+    screen_width: int; width the static map is drawn at
+    show: bool; if True, plt.show() is called
+
+    '''
 
+    import matplotlib.pyplot as plt
+
+    #Put it all together!!!! Plot the image with the bubbles on it
+    fig,ax = plt.subplots()
+    viewer = None
+    if interactive_viewer:
+        from bubble_viewer import BubbleViewer
+        viewer = BubbleViewer(ax, pyramid, catalog, index=pixel_index)
+    else:
+        #The pyramid level matching the screen is drawn, the extent keeps the full resolution pixel axes
+        display_level = pyramid.display_level(screen_width)
+        rows, cols = pyramid.shape[0], pyramid.shape[1]
+        ax.imshow(pyramid[display_level],
+                  extent=(-0.5, cols - 0.5, rows - 0.5, -0.5))
+        ax.set_aspect('equal')
+        #All bubbles as one collection, like the viewer draws them
+        from bubble_viewer import bubble_collection
+        ax.add_collection(bubble_collection(ax, catalog['x'], catalog['y'], catalog['r']),
+                          autolim=False)
+    if show:
+        plt.show()
+
+    return (fig, ax, viewer)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Map the Simpson et al. bubbles onto the '
+                                                 'Spitzer panorama.')
+    parser.add_argument('--data-dir', default=DATA_DIR,
+                        help='directory of the survey tiles and bubbly.csv')
+    parser.add_argument('--catalog', default=None, help='bubble csv, default DATA_DIR/bubbly.csv')
+    parser.add_argument('--static', action='store_true',
+                        help='draw the whole panorama with all bubbles at once')
+    parser.add_argument('--screen-width', type=int, default=4000,
+                        help='width the static map is drawn at')
+    args = parser.parse_args(argv)
+
+    catalog, pyramid, degree_index, pixel_index = load_bubble_map(args.data_dir, args.catalog)
+    show_bubble_map(catalog, pyramid, pixel_index, interactive_viewer=not args.static,
+                    screen_width=args.screen_width)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+'''
+Viewport-driven interactive bubble map.
+
+Instead of drawing the whole panorama and one Circle patch per bubble, the
+viewer only draws what is inside the axes limits: the visible region read from
+the pyramid level that matches the axes' width in screen pixels, and the
+bubbles that reach into the view as a single EllipseCollection. Both are
+refreshed whenever the limits change (pan, zoom, or set_xlim/set_ylim).
+'''
+
+import time
+
+import numpy as np
+
+
+def bubble_collection(ax, x, y, r, edgecolor='b'):
+    '''
+    Returns:
+    ______________
+    EllipseCollection of unfilled circles of radius r around (x, y), in the data
+    coordinates of ax, which draws all bubbles in one call instead of a patch each
+    '''
+
+    from matplotlib.collections import EllipseCollection
+
+    diameters = 2 * np.asarray(r)
+
+    return EllipseCollection(diameters, diameters, np.zeros(len(diameters)), units='xy',
+                             offsets=np.column_stack((x, y)), offset_transform=ax.transData,
+                             facecolors='none', edgecolors=edgecolor)
+
+
+class BubbleViewer(object):
+    '''
+    Interactive viewer of the panorama with bubble overlays on a matplotlib axes.
+
+    Args:
+    --------------
+    ax: matplotlib Axes to draw on
+    pyramid: PanoramaPyramid of the panorama
+    catalog: converted BubbleCatalog (the x, y, r fields are filled in)
+    index: SpatialIndex over the catalog in pixel space, built if None
+    oversample: float; the level drawn has at least this many pixels per screen pixel
+    edgecolor: color of the bubble circles
+
+    Notes:
+    --------------
+    The axes keep the full resolution pixel coordinates, so catalog x, y and r
+    (and SpatialIndex queries) can be used directly
+
+    Usage:
+    ______________
+    fig, ax = plt.subplots()
+    viewer = BubbleViewer(ax, pyramid, catalog)
+    ax.set_xlim(150000, 160000)
+    plt.show()
+
+    '''
+
+    def __init__(self, ax, pyramid, catalog, index=None, oversample=1.0, edgecolor='b'):
+
+        from spatial_index import SpatialIndex
+
+        if index is None:
+            index = SpatialIndex.from_catalog(catalog, space='pixels')
+
+        self.ax = ax
+        self.pyramid = pyramid
+        self.catalog = catalog
+        self.index = index
+        self.oversample = oversample
+        self.edgecolor = edgecolor
+        self.level = None
+        self.bubbles = None
+        self.visible = None
+        self.refresh_seconds = 0.0
+        self._refreshing = False
+        self._view = None
+
+        rows, cols = pyramid.shape[0], pyramid.shape[1]
+        self.image = ax.imshow(np.zeros((1, 1, 3), dtype=np.uint8),
+                               extent=(-0.5, cols - 0.5, rows - 0.5, -0.5))
+        ax.set_aspect('equal')
+        ax.set_autoscale_on(False)
+        ax.set_xlim(-0.5, cols - 0.5)
+        ax.set_ylim(rows - 0.5, -0.5)
+
+        ax.callbacks.connect('xlim_changed', self._limits_changed)
+        ax.callbacks.connect('ylim_changed', self._limits_changed)
+        self.refresh()
+
+    def _limits_changed(self, ax):
+        self.refresh()
+
+    def viewport(self):
+        '''
+        Returns:
+        ______________
+        (left, right, top, bot) full resolution pixel borders of the visible
+        region, clipped to the panorama
+
+        '''
+
+        rows, cols = self.pyramid.shape[0], self.pyramid.shape[1]
+        xmin, xmax = sorted(self.ax.get_xlim())
+        ymin, ymax = sorted(self.ax.get_ylim())
+
+        left = int(np.clip(np.floor(xmin + 0.5), 0, cols - 1))
+        right = int(np.clip(np.ceil(xmax + 0.5), left + 1, cols))
+        top = int(np.clip(np.floor(ymin + 0.5), 0, rows - 1))
+        bot = int(np.clip(np.ceil(ymax + 0.5), top + 1, rows))
+
+        return (left, right, top, bot)
+
+    def refresh(self):
+        '''
+        Redraw the image and the bubbles for the current axes limits
+        '''
+
+        #set_extent below changes no limits, but guard against callbacks from it anyway
+        if self._refreshing:
+            return
+        self._refreshing = True
+        start = time.time()
+
+        try:
+            borders = self.viewport()
+            screen_width = max(self.ax.bbox.width, 1) * self.oversample
+            level = self.pyramid.display_level(screen_width, columns=borders[1] - borders[0])
+            if (level, borders) != self._view:
+                self._draw_image(borders, level)
+                self._draw_bubbles(borders)
+                self._view = (level, borders)
+                self.ax.figure.canvas.draw_idle()
+        finally:
+            self._refreshing = False
+
+        self.refresh_seconds = time.time() - start
+
+    def _draw_image(self, borders, level):
+
+        left, right, top, bot = borders
+        scale = 2 ** level
+
+        #Read whole level pixels and place them at their full resolution position
+        level_left, level_top = left // scale, top // scale
+        region = np.asarray(self.pyramid.extract(borders, level))
+        level_right = level_left + region.shape[1]
+        level_bot = level_top + region.shape[0]
+
+        self.image.set_data(region)
+        self.image.set_extent((level_left * scale - 0.5, level_right * scale - 0.5,
+                               level_bot * scale - 0.5, level_top * scale - 0.5))
+        self.level = level
+
+    def _draw_bubbles(self, borders):
+
+        left, right, top, bot = borders
+        visible = self.index.window(left, right, top, bot, overlap=True)
+
+        if self.bubbles is not None:
+            self.bubbles.remove()
+
+        self.bubbles = bubble_collection(self.ax, self.catalog['x'][visible],
+                                         self.catalog['y'][visible], self.catalog['r'][visible],
+                                         self.edgecolor)
+        self.ax.add_collection(self.bubbles, autolim=False)
+        self.visible = visible
@@ -0,0 +1,239 @@
+'''
+Columnar bubble catalog backed by a numpy structured array.
+
+Replaces the dicts of nested tuples (bubble_dict, converted_bubble_dict, ...)
+with one compact array of named fields that handles any catalog length and
+supports vectorized filtering.
+'''
+
+import numpy as np
+
+from coords import degrees_to_pixels, invalid_coordinates
+
+#Bit flags stored in the 'flags' field
+FLAG_BAD_COORDS = 1       #glon/glat/reff outside of the acceptable range
+FLAG_SKIPPED_CUTOUT = 2   #bubble cutout leaks outside of the panorama
+FLAG_SKIPPED_CONTROL = 4  #control cutout leaks outside of the panorama
+
+#Numeric fields of the catalog, in the column order of bubbly.csv after the ID
+'''Current numerics:
+   glon    galactic longitude (degrees)
+   glat    galactic latitude  (degrees)
+   reff    effective radius   (degrees, converted from the arcminutes in the csv)
+   hitrate                    (unitless)
+   ra                         (degrees)
+   dec                        (degrees)
+'''
+NUMERIC_FIELDS = ('glon', 'glat', 'reff', 'hitrate', 'ra', 'dec')
+
+#Pixel fields, filled in by BubbleCatalog.convert
+PIXEL_FIELDS = ('x', 'y', 'r')
+
+
+def catalog_dtype(id_length):
+    '''
+    Returns:
+    ______________
+    numpy structured dtype of a catalog whose IDs have at most id_length characters
+
+    '''
+
+    return np.dtype([('id', 'U%d' % max(id_length, 1))] +
+                    [(name, np.float64) for name in NUMERIC_FIELDS] +
+                    [(name, np.int64) for name in PIXEL_FIELDS] +
+                    [('flags', np.uint8)])
+
+
+class BubbleCatalog(object):
+    '''
+    A bubble catalog stored as a numpy structured array.
+
+    Fields: id, glon, glat, reff, hitrate, ra, dec, x, y, r, flags
+
+    Columns are read by name (catalog['glon']), single records by position
+    (catalog[12]) and sub-catalogs by boolean mask, index array or slice
+    (catalog[catalog['hitrate'] >= 0.5]).
+
+    Args:
+    --------------
+    records: numpy structured array with the catalog_dtype fields
+
+    Usage:
+    ______________
+    catalog = BubbleCatalog.from_csv("../Desktop/mapping_data/bubbly.csv")
+    catalog.convert(final_panorama)
+    best = catalog[catalog['hitrate'] >= 0.5]
+
+    '''
+
+    def __init__(self, records):
+
+        missing = set(catalog_dtype(1).names) - set(records.dtype.names)
+        if missing:
+            raise ValueError('catalog records are missing fields: %s' % sorted(missing))
+
+        self.records = records
+        self._positions = None
+
+    @classmethod
+    def from_arrays(cls, ids, glon, glat, reff, hitrate=None, ra=None, dec=None):
+        '''
+        Returns:
+        ______________
+        BubbleCatalog built from equally long columns. reff is in degrees, and the
+        optional hitrate/ra/dec columns default to NaN
+
+        '''
+
+        ids = np.asarray(ids).astype(str)
+        count = len(ids)
+
+        records = np.zeros(count, dtype=catalog_dtype(max([len(name) for name in ids] + [1])))
+        records['id'] = ids
+        columns = {'glon': glon, 'glat': glat, 'reff': reff, 'hitrate': hitrate, 'ra': ra,
+                   'dec': dec}
+        for name in NUMERIC_FIELDS:
+            if columns[name] is None:
+                records[name] = np.nan
+            else:
+                column = np.asarray(columns[name], dtype=np.float64)
+                if column.shape != (count,):
+                    raise ValueError('column %s has shape %s, expected (%d,)'
+                                     % (name, column.shape, count))
+                records[name] = column
+
+        return cls(records)
+
+    @classmethod
+    def from_csv(cls, path):
+        '''
+        Returns:
+        ______________
+        BubbleCatalog read from a bubbly.csv style file with the columns
+        ID, glon, glat, reff (arcminutes), and optionally hitrate, ra, dec
+
+        Usage:
+        ______________
+        catalog = BubbleCatalog.from_csv("../Desktop/mapping_data/bubbly.csv")
+
+        '''
+
+        import pandas as pd
+
+        bubble_data = pd.read_csv(path)
+        optional = [bubble_data.iloc[:, column].values if bubble_data.shape[1] > column else None
+                    for column in (4, 5, 6)]
+
+        return cls.from_arrays(bubble_data.iloc[:, 0].values,
+                               bubble_data.iloc[:, 1].values,
+                               bubble_data.iloc[:, 2].values,
+                               bubble_data.iloc[:, 3].values / 60,
+                               *optional)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __getitem__(self, key):
+
+        if isinstance(key, str):
+            return self.records[key]
+        if isinstance(key, (int, np.integer)):
+            return self.records[key]
+
+        return BubbleCatalog(self.records[key])
+
+    def __repr__(self):
+        return 'BubbleCatalog(%d bubbles, %d bytes)' % (len(self), self.nbytes)
+
+    @property
+    def nbytes(self):
+        return self.records.nbytes
+
+    @property
+    def ids(self):
+        return self.records['id']
+
+    def filter(self, mask):
+        '''
+        Returns:
+        ______________
+        BubbleCatalog with the records where mask is True
+
+        '''
+
+        return BubbleCatalog(self.records[np.asarray(mask, dtype=bool)])
+
+    def flagged(self, flag):
+        '''
+        Returns:
+        ______________
+        boolean mask of the records that have the given flag bit set
+
+        '''
+
+        return (self.records['flags'] & flag) != 0
+
+    def set_flag(self, flag, where):
+        '''
+        Set the given flag bit on the records selected by where, either a boolean
+        mask over the records or record positions
+        '''
+
+        where = np.asarray(where)
+        if where.dtype != bool:
+            where = np.atleast_1d(where).astype(np.int64)
+
+        self.records['flags'][where] |= np.uint8(flag)
+
+    def position(self, bubble_id):
+        '''
+        Returns:
+        ______________
+        int; position of the record with the given ID. Raises KeyError if missing
+
+        '''
+
+        if self._positions is None:
+            self._positions = dict((name, i) for i, name in enumerate(self.records['id']))
+
+        return self._positions[bubble_id]
+
+    def convert(self, array):
+        '''
+        Fill the x, y and r pixel fields for every record, and flag the records with
+        out of range coordinates
+
+        Args:
+        --------------
+        array: the panorama (anything with a .shape) or a (rows, cols, ...) shape tuple
+
+        '''
+
+        x, y, r = degrees_to_pixels(self.records['glon'], self.records['glat'],
+                                    self.records['reff'], array)
+        self.records['x'] = x
+        self.records['y'] = y
+        self.records['r'] = r
+
+        bad_glon, bad_glat, bad_reff = invalid_coordinates(self.records['glon'],
+                                                           self.records['glat'],
+                                                           self.records['reff'])
+        self.set_flag(FLAG_BAD_COORDS, bad_glon | bad_glat | bad_reff)
+
+        return self
+
+    def numerics(self, index):
+        '''
+        Returns:
+        ______________
+        tuple: (glon, glat, reff, hitrate, ra, dec) of the record at index, the
+        value format of the old bubble_dict
+
+        '''
+
+        record = self.records[index]
+
+        return tuple(float(record[name]) for name in NUMERIC_FIELDS)
@@ -0,0 +1,211 @@
+'''
+Overlap-aware control sampling.
+
+The original controls are taken at the point mirror of every bubble, whether or
+not another bubble sits there. sample_controls draws several candidate regions
+per bubble instead, rejects every candidate whose cutout would overlap a catalog
+bubble or leak outside of the panorama, and keeps up to count clean controls per
+bubble. A control has the radius of its bubble, so the controls follow the
+radius distribution of the bubbles exactly.
+
+Everything is vectorized over the catalog. The draws for a bubble only depend
+on its ID and the seed, so adding bubbles to the catalog does not move the
+controls of the others (and incremental runs keep their outputs).
+'''
+
+import zlib
+
+import numpy as np
+
+from cutout_buffer import convert_cutout
+from cutout_stream import crop_borders, extract, resize_cutout
+from spatial_index import SpatialIndex
+
+#One row per sampled control
+CONTROL_DTYPE = np.dtype([('position', np.int64),
+                          ('number', np.int64),
+                          ('x', np.int64),
+                          ('y', np.int64),
+                          ('r', np.int64)])
+
+
+def _splitmix64(values):
+    '''
+    Returns:
+    ______________
+    uint64 array; the splitmix64 hash of every value
+    '''
+
+    with np.errstate(over='ignore'):
+        z = np.asarray(values, dtype=np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+
+    return z ^ (z >> np.uint64(31))
+
+
+def bubble_draws(ids, draws, seed=0):
+    '''
+    Returns:
+    ______________
+    float array of shape (len(ids), draws); uniform values in [0, 1) that only
+    depend on the bubble ID, the column and the seed
+
+    '''
+
+    keys = np.array([zlib.crc32(str(name).encode()) for name in ids], dtype=np.uint64)
+    keys = _splitmix64(keys | (np.uint64(seed & 0xFFFFFFFF) << np.uint64(32)))
+    counters = _splitmix64(np.arange(draws, dtype=np.uint64))
+
+    bits = _splitmix64(keys[:, None] ^ counters[None, :])
+
+    return (bits >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+
+
+def sample_controls(catalog, shape, count=1, pad=50, hshift=0, vshift=0, candidates=8,
+                    mirror_first=True, index=None, seed=0, columns=None):
+    '''
+    Returns:
+    ______________
+    numpy array of CONTROL_DTYPE, sorted by catalog position and control number.
+    Bubbles without count clean candidates get fewer rows (possibly none)
+
+    Args:
+    --------------
+    catalog: converted BubbleCatalog (the x, y, r fields are filled in)
+    shape: panorama shape, (rows, cols, ...)
+    count: int; controls wanted per bubble
+    pad, hshift, vshift: the cutoutgen.py loop parameters, the controls are cropped with them
+    candidates: int; random candidates drawn per wanted control
+    mirror_first: bool; if True, the mirror location is the first candidate, so a
+                  clean mirror control is kept as before
+    index: SpatialIndex over the catalog in pixel space, built if None
+    seed: int; changes every random candidate
+    columns: list or None; the [start, stop) column ranges of every bubble, e.g.
+             of its shard (see sharding.py). The random candidates of a bubble are
+             drawn with their crop inside its ranges, the mirror candidate is kept
+             as it is. None draws them over the whole panorama
+
+    Notes:
+    --------------
+    A candidate is rejected when the circle of its cutout (radius r + pad) meets
+    the circle of any catalog bubble, its own bubble included, or a control
+    already chosen for the same bubble
+
+    Usage:
+    ______________
+    controls = sample_controls(catalog, final_panorama.shape, count=10)
+    control_centers = first_controls(controls)
+
+    '''
+
+    rows, cols = shape[0], shape[1]
+    x = np.asarray(catalog['x'], dtype=np.int64)
+    y = np.asarray(catalog['y'], dtype=np.int64)
+    radius = np.asarray(catalog['r'], dtype=np.int64)
+    half = radius + pad
+
+    if index is None:
+        index = SpatialIndex.from_catalog(catalog, space='pixels')
+
+    if columns is None:
+        columns = [[(0, cols)]] * len(x)
+    ranges = np.zeros((len(x), max([len(ranges) for ranges in columns] + [1]), 2),
+                      dtype=np.int64)
+    for position, bubble_ranges in enumerate(columns):
+        ranges[position, :len(bubble_ranges)] = bubble_ranges
+
+    #Uniform candidate centers over the ranges where the crop stays inside (see inside_panorama)
+    low_x = ranges[:, :, 0] + (half - hshift)[:, None]
+    widths = np.clip(ranges[:, :, 1] - 1 - (half + hshift)[:, None] - low_x + 1, 0, None)
+    ends = np.cumsum(widths, axis=1)
+    low_y, high_y = half - vshift, rows - 1 - half - vshift
+    draws = bubble_draws(catalog.ids, 2 * candidates * count, seed)
+    offset = np.floor(draws[:, 0::2] * ends[:, -1:]).astype(np.int64)
+    pick = np.minimum((offset[:, :, None] >= ends[:, None, :]).sum(axis=2), ranges.shape[1] - 1)
+    bubble_rows = np.arange(len(x))[:, None]
+    candidate_x = low_x[bubble_rows, pick] + offset - (ends - widths)[bubble_rows, pick]
+    candidate_y = low_y[:, None] + np.floor(draws[:, 1::2] * (high_y - low_y + 1)[:, None])
+    candidate_y = candidate_y.astype(np.int64)
+    drawn = np.repeat(ends[:, -1:] > 0, candidate_x.shape[1], axis=1)
+
+    if mirror_first:
+        candidate_x = np.concatenate([(cols - 1 - x)[:, None], candidate_x], axis=1)
+        candidate_y = np.concatenate([(rows - 1 - y)[:, None], candidate_y], axis=1)
+
+    left, right, top, bot = crop_borders((candidate_x, candidate_y), half[:, None], 0,
+                                         hshift, vshift)
+    clean = (left >= 0) & (right <= cols - 1) & (top >= 0) & (bot <= rows - 1)
+    #Bubbles whose ranges have no room for the crop draw no random candidates
+    clean[:, candidate_x.shape[1] - drawn.shape[1]:] &= drawn
+
+    overlaps = index.overlapping(candidate_x.ravel(), candidate_y.ravel(),
+                                 np.repeat(half, candidate_x.shape[1]))
+    clean &= ~overlaps.reshape(candidate_x.shape)
+
+    #Take the first clean candidate, drop the candidates it overlaps, and repeat
+    bubbles = np.arange(len(x))
+    chosen = []
+    for number in range(count):
+        found = clean.any(axis=1)
+        if not found.any():
+            break
+        column = np.argmax(clean, axis=1)[found]
+        picked = bubbles[found]
+        chosen_x = candidate_x[picked, column]
+        chosen_y = candidate_y[picked, column]
+        chosen.append((picked, np.full(len(picked), number), chosen_x, chosen_y))
+
+        distance = np.hypot(candidate_x[picked] - chosen_x[:, None],
+                            candidate_y[picked] - chosen_y[:, None])
+        clean[picked] &= distance >= 2 * half[picked, None]
+
+    if not chosen:
+        return np.zeros(0, dtype=CONTROL_DTYPE)
+
+    controls = np.zeros(sum(len(part[0]) for part in chosen), dtype=CONTROL_DTYPE)
+    for field, values in zip(('position', 'number', 'x', 'y'), zip(*chosen)):
+        controls[field] = np.concatenate(values)
+    controls['r'] = radius[controls['position']]
+
+    return np.sort(controls, order=('position', 'number'))
+
+
+def first_controls(controls):
+    '''
+    Returns:
+    ______________
+    dict of {catalog position: (x, y)} of control number 0 of every bubble, as
+    taken by plan_cutouts and run_cutout_pipeline
+
+    '''
+
+    first = controls[controls['number'] == 0]
+
+    return dict((int(position), (int(x), int(y)))
+                for position, x, y in zip(first['position'], first['x'], first['y']))
+
+
+def iter_control_cutouts(panorama, controls, pad=50, dim=(224, 224, 3), hshift=0, vshift=0,
+                         dtype=np.uint8):
+    '''
+    Returns:
+    ______________
+    generator of (control_row, control_cutout) tuples for every sampled control
+
+    Usage:
+    ______________
+    for control, cutout in iter_control_cutouts(final_panorama, sample_controls(catalog,
+                                                final_panorama.shape, count=10)):
+        ...
+
+    '''
+
+    for control in controls:
+        borders = crop_borders((int(control['x']), int(control['y'])), int(control['r']), pad,
+                               hshift, vshift)
+        cutout = resize_cutout(extract(panorama, borders), dim)
+        if dtype is not None:
+            cutout = convert_cutout(cutout, dtype)
+
+        yield (control, cutout)
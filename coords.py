@@ -0,0 +1,249 @@
+'''
+Vectorized conversion of galactic coordinates to panorama pixel indices.
+
+The panorama spans glon 64.5 to -64.5 degrees from left to right and glat 1 to
+-1 degrees from top to bottom. Rather than building np.linspace over every
+column and running argmin for each bubble, the nearest index is found in closed
+form and checked against its neighbours, so the result is identical to the
+argmin lookup.
+'''
+
+import numpy as np
+
+#Degree ranges covered by the panorama, left to right and top to bottom
+GLON_RANGE = (64.5, -64.5)
+GLAT_RANGE = (1, -1)
+
+#Longitudes at or above this value are shifted by -360 to handle the wraparound
+GLON_WRAP = 295.5
+
+#Pixels per degree used for the effective radius
+PIXELS_PER_DEGREE = 3000
+
+
+def linspace_values(index, start, stop, num):
+    '''
+    Returns:
+    ______________
+    float array; np.linspace(start, stop, num)[index], without building the linspace
+
+    '''
+
+    index = np.asarray(index, dtype=np.int64)
+    if num == 1:
+        return np.full(index.shape, float(start))
+
+    step = (stop - start) / float(num - 1)
+
+    return np.where(index == num - 1, float(stop), index * step + start)
+
+
+def nearest_linspace_index(values, start, stop, num):
+    '''
+    Returns:
+    ______________
+    int64 array; for each value, the index of the closest element of
+    np.linspace(start, stop, num), with ties resolved to the first index like argmin
+
+    Args:
+    --------------
+    values: array of floats
+    start, stop, num: the np.linspace arguments
+
+    '''
+
+    values = np.asarray(values, dtype=np.float64)
+
+    if num == 1:
+        return np.zeros(values.shape, dtype=np.int64)
+
+    #np.linspace computes start + i * step and then pins the last element to stop
+    step = (stop - start) / float(num - 1)
+
+    def linspace_value(index):
+        return linspace_values(index, start, stop, num)
+
+    guess = np.rint((values - start) / step)
+    guess = np.clip(np.nan_to_num(guess, nan=0.0), 0, num - 1).astype(np.int64)
+
+    #Rounding can be off by one, so look at the neighbours and keep the first minimum
+    best = np.clip(guess - 1, 0, num - 1)
+    best_error = np.abs(linspace_value(best) - values)
+    for offset in (0, 1):
+        candidate = np.clip(guess + offset, 0, num - 1)
+        error = np.abs(linspace_value(candidate) - values)
+        better = (error < best_error) | ((error == best_error) & (candidate < best))
+        best = np.where(better, candidate, best)
+        best_error = np.where(better, error, best_error)
+
+    #argmin over an all-NaN difference returns the first index
+    best[np.isnan(values)] = 0
+
+    return best
+
+
+def wrap_glon(glon):
+    '''
+    Returns:
+    ______________
+    float array; glon with the values at or above GLON_WRAP shifted by -360, so
+    the panorama covers one continuous range from 64.5 to -64.5. Unit: degrees
+
+    '''
+
+    glon = np.asarray(glon, dtype=np.float64)
+    wrapped = (glon <= 360) & (glon >= GLON_WRAP)
+
+    return np.where(wrapped, glon - 360, glon)
+
+
+def invalid_coordinates(glon, glat, reff):
+    '''
+    Returns:
+    ______________
+    tuple of boolean arrays: (bad_glon, bad_glat, bad_reff)
+
+    Args:
+    --------------
+    glon: array of galactic longitudes. Unit: degrees. Expects range: [0:360]
+    glat: array of galactic latitudes. Unit: degrees. Expects range: [-1:1]
+    reff: array of effective radii. Unit: degrees. Expects positive values
+
+    '''
+
+    glon = np.asarray(glon, dtype=np.float64)
+    glat = np.asarray(glat, dtype=np.float64)
+    reff = np.asarray(reff, dtype=np.float64)
+
+    return ((glon < 0) | (glon > 360), (glat < -1) | (glat > 1), reff < 0)
+
+
+def degrees_to_pixels(glon, glat, reff, array):
+    '''
+    Returns:
+    ______________
+    tuple of int64 arrays: (glon_idx, glat_idx, radius_in_pixels)
+
+    Args:
+    --------------
+    glon: array of galactic longitudes. Unit: degrees. Expects range: [0:360]
+    glat: array of galactic latitudes. Unit: degrees. Expects range: [-1:1]
+    reff: array of effective radii. Unit: degrees
+    array: the panorama (anything with a .shape) or a (rows, cols, ...) shape tuple
+
+    Notes:
+    ______________
+    Out of range values are reported once per batch, and converted anyway, the
+    same way degree_to_pixel reports and converts them one bubble at a time
+
+    Usage:
+    ______________
+    x, y, r = degrees_to_pixels(glon_array, glat_array, reff_array, final_panorama)
+
+    '''
+
+    glon = np.asarray(glon, dtype=np.float64)
+    glat = np.asarray(glat, dtype=np.float64)
+    reff = np.asarray(reff, dtype=np.float64)
+
+    #Make sure input is good
+    bad_glon, bad_glat, bad_reff = invalid_coordinates(glon, glat, reff)
+    if bad_glon.any():
+        print('arg error: %d glon values are out of acceptable range' % bad_glon.sum())
+    if bad_glat.any():
+        print('arg error: %d glat values are out of acceptable range' % bad_glat.sum())
+    if bad_reff.any():
+        print('arg error: %d radii are not positive' % bad_reff.sum())
+
+    #Regulate glon input to make the spherical wraparound less annoying
+    glon = wrap_glon(glon)
+
+    shape = array if isinstance(array, tuple) else array.shape
+    rows = shape[0]
+    cols = shape[1]
+
+    glat_idx = nearest_linspace_index(glat, GLAT_RANGE[0], GLAT_RANGE[1], rows)
+    glon_idx = nearest_linspace_index(glon, GLON_RANGE[0], GLON_RANGE[1], cols)
+
+    #Get the effective pixel radius, truncated towards zero like int()
+    radius_in_pixels = np.trunc(reff * PIXELS_PER_DEGREE).astype(np.int64)
+
+    return (glon_idx, glat_idx, radius_in_pixels)
+
+
+def pixels_to_degrees(x, y, array):
+    '''
+    Returns:
+    ______________
+    tuple of float arrays: (glon, glat) at the panorama pixels (x, y). Unit: degrees.
+    glon is in [0:360]
+
+    Args:
+    --------------
+    x, y: arrays of column and row indices
+    array: the panorama (anything with a .shape) or a (rows, cols, ...) shape tuple
+
+    '''
+
+    shape = array if isinstance(array, tuple) else array.shape
+
+    glon = linspace_values(x, GLON_RANGE[0], GLON_RANGE[1], shape[1])
+    glat = linspace_values(y, GLAT_RANGE[0], GLAT_RANGE[1], shape[0])
+
+    return (np.mod(glon, 360), glat)
+
+
+def mirror_coordinates(glon, glat):
+    '''
+    Returns:
+    ______________
+    tuple of float arrays: (glon, glat) of the point mirrored through the panorama
+    center, i.e. the location of the (cols - 1 - x, rows - 1 - y) pixel. Unit: degrees
+
+    Args:
+    --------------
+    glon: array of galactic longitudes. Unit: degrees. Expects range: [0:360]
+    glat: array of galactic latitudes. Unit: degrees. Expects range: [-1:1]
+
+    '''
+
+    glon = np.asarray(glon, dtype=np.float64)
+    glat = np.asarray(glat, dtype=np.float64)
+
+    #Undo the wraparound so the panorama center sits at glon 0, then mirror
+    mirrored = -wrap_glon(glon)
+
+    return (np.mod(mirrored, 360), -glat)
+
+
+#Rotation matrix from galactic to equatorial (ICRS) unit vectors
+GALACTIC_TO_EQUATORIAL = np.array([[-0.0548755604162154, 0.4941094278755837, -0.8676661490190047],
+                                   [-0.8734370902348850, -0.4448296299600112, -0.1980763734312015],
+                                   [-0.4838350155487132, 0.7469822444972189, 0.4559837761750669]])
+
+
+def galactic_to_equatorial(glon, glat):
+    '''
+    Returns:
+    ______________
+    tuple of float arrays: (ra, dec). Unit: degrees
+
+    Args:
+    --------------
+    glon: array of galactic longitudes. Unit: degrees
+    glat: array of galactic latitudes. Unit: degrees
+
+    '''
+
+    glon = np.radians(np.asarray(glon, dtype=np.float64))
+    glat = np.radians(np.asarray(glat, dtype=np.float64))
+
+    galactic = np.stack((np.cos(glat) * np.cos(glon),
+                         np.cos(glat) * np.sin(glon),
+                         np.sin(glat)))
+    equatorial = np.tensordot(GALACTIC_TO_EQUATORIAL, galactic, axes=1)
+
+    ra = np.degrees(np.arctan2(equatorial[1], equatorial[0])) % 360
+    dec = np.degrees(np.arcsin(np.clip(equatorial[2], -1, 1)))
+
+    return (ra, dec)
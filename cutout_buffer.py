@@ -0,0 +1,166 @@
+'''
+Compact, contiguous storage for resized cutouts.
+
+skimage.transform.resize returns float64 images, so holding every cutout in a
+dict costs about 1.2 MB per 224x224x3 cutout. A CutoutBuffer preallocates one
+(N, 224, 224, 3) array in a small dtype (uint8 by default), optionally backed by
+a memmapped .npy file, and records refer to their cutout by index.
+'''
+
+import resource
+import sys
+
+import numpy as np
+
+#Dtypes a cutout buffer can be stored in
+BUFFER_DTYPES = (np.uint8, np.float16, np.float32)
+
+
+def peak_rss_mb():
+    '''
+    Returns:
+    ______________
+    float; peak resident set size of this process so far. Unit: megabytes
+
+    '''
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    #ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return peak / 1024.0 ** 2
+
+    return peak / 1024.0
+
+
+def convert_cutout(image, dtype):
+    '''
+    Returns:
+    ______________
+    image converted to dtype. Float images are expected in [0, 1] (as returned by
+    resize), uint8 images in [0, 255]
+
+    Args:
+    --------------
+    image: numpy ndarray
+    dtype: one of BUFFER_DTYPES
+
+    '''
+
+    dtype = np.dtype(dtype)
+    image = np.asarray(image)
+
+    if dtype == np.uint8:
+        if image.dtype == np.uint8:
+            return image
+        return np.rint(np.clip(image, 0, 1) * 255).astype(np.uint8)
+
+    if image.dtype == np.uint8:
+        return (image / 255.0).astype(dtype)
+
+    return image.astype(dtype)
+
+
+class CutoutBuffer(object):
+    '''
+    A preallocated (capacity, rows, cols, channels) array of cutouts.
+
+    Args:
+    --------------
+    capacity: int; maximum number of cutouts
+    dim: tuple; shape of a single cutout
+    dtype: one of BUFFER_DTYPES; uint8 stores [0, 255], floats store [0, 1]
+    path: string or None; if given, the buffer is a memmapped .npy file at path
+
+    Usage:
+    ______________
+    cutouts = CutoutBuffer(2 * len(catalog), dim=(224,224,3), dtype=np.uint8)
+    index = cutouts.append(resize(extracted_bubble, (224,224,3)))
+    image = cutouts[index]
+
+    '''
+
+    def __init__(self, capacity, dim=(224, 224, 3), dtype=np.uint8, path=None):
+
+        if np.dtype(dtype) not in [np.dtype(option) for option in BUFFER_DTYPES]:
+            raise ValueError('cutout buffer dtype must be one of uint8, float16, float32')
+
+        self.dim = tuple(dim)
+        self.dtype = np.dtype(dtype)
+        self.path = path
+        self.count = 0
+
+        shape = (capacity,) + self.dim
+        if path is None:
+            self.array = np.zeros(shape, dtype=self.dtype)
+        else:
+            self.array = np.lib.format.open_memmap(path, mode='w+', dtype=self.dtype, shape=shape)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return self.images[index]
+
+    @property
+    def capacity(self):
+        return self.array.shape[0]
+
+    @property
+    def images(self):
+        '''
+        The filled part of the buffer, as a view
+        '''
+
+        return self.array[:self.count]
+
+    @property
+    def nbytes(self):
+        return self.array.nbytes
+
+    def append(self, image):
+        '''
+        Returns:
+        ______________
+        int; index of the stored cutout
+
+        Args:
+        --------------
+        image: numpy ndarray with shape dim, converted to the buffer dtype
+
+        '''
+
+        if self.count >= self.capacity:
+            raise IndexError('cutout buffer is full (capacity %d)' % self.capacity)
+        if np.shape(image) != self.dim:
+            raise ValueError('cutout has shape %s, expected %s' % (np.shape(image), self.dim))
+
+        index = self.count
+        self.array[index] = convert_cutout(image, self.dtype)
+        self.count = self.count + 1
+
+        return index
+
+    def put(self, index, image):
+        '''
+        Store image at index instead of at the end, for buffers that are filled out
+        of order. The filled part grows to cover index
+
+        '''
+
+        if index < 0 or index >= self.capacity:
+            raise IndexError('index %d is outside of the cutout buffer (capacity %d)'
+                             % (index, self.capacity))
+        if np.shape(image) != self.dim:
+            raise ValueError('cutout has shape %s, expected %s' % (np.shape(image), self.dim))
+
+        self.array[index] = convert_cutout(image, self.dtype)
+        self.count = max(self.count, index + 1)
+
+    def flush(self):
+        '''
+        Write a memmapped buffer to disk
+        '''
+
+        if isinstance(self.array, np.memmap):
+            self.array.flush()
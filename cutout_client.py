@@ -0,0 +1,155 @@
+'''
+Client of the local cutout service (cutout_server.py).
+
+The client keeps one HTTP/1.1 connection open, so a cached cutout comes back
+in about a millisecond and a new one in the time it takes to resize it.
+
+Usage:
+______________
+client = CutoutClient()
+bubble = client.cutout('1G303341-007180')
+control = client.cutout('1G303341-007180', control=True)
+region = client.cutout(glon=303.34, glat=-0.72, reff=0.03, dim=128)
+images = client.cutouts([{'id': name} for name in names])
+'''
+
+import http.client
+import io
+import json
+import urllib.parse
+
+import numpy as np
+
+#Port the server listens on and the client connects to by default
+DEFAULT_PORT = 8765
+
+
+class CutoutServiceError(Exception):
+    '''
+    A request the cutout service could not answer (unknown ID, crop outside of
+    the panorama, bad parameters)
+    '''
+
+
+class CutoutClient(object):
+    '''
+    Fetches cutouts from a running cutout_server.py.
+
+    Args:
+    --------------
+    host, port: address of the server
+    timeout: float; seconds to wait for a response
+
+    '''
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, timeout=60.0):
+
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.errors = []
+        self._connection = None
+
+    def _request(self, method, path, body=None):
+
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+
+        #A kept-alive connection may have been closed by the server in between
+        for attempt in (0, 1):
+            if self._connection is None:
+                self._connection = http.client.HTTPConnection(self.host, self.port,
+                                                              timeout=self.timeout)
+            try:
+                self._connection.request(method, path, body=body, headers=headers)
+                response = self._connection.getresponse()
+                data = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                self.close()
+                if attempt:
+                    raise
+
+        if response.status != 200:
+            try:
+                message = json.loads(data)['error']
+            except (ValueError, KeyError):
+                message = data.decode(errors='replace')
+            raise CutoutServiceError('%d: %s' % (response.status, message))
+
+        return (data, response.getheader('Content-Type'))
+
+    def cutout(self, bubble_id=None, control=False, glon=None, glat=None, reff=None, **options):
+        '''
+        Returns:
+        ______________
+        uint8 cutout array, or the JPEG bytes if format='jpeg'
+
+        Args:
+        --------------
+        bubble_id: catalog ID, or None to cut at glon, glat, reff (degrees)
+        control: bool; if True, return the control of the bubble instead
+        options: pad, dim (int or tuple), hshift, vshift, format ('npy' or 'jpeg')
+
+        '''
+
+        query = self._query(bubble_id, control, glon, glat, reff, options)
+        if isinstance(query.get('dim'), (tuple, list)):
+            query['dim'] = ','.join(str(value) for value in query['dim'])
+
+        data, content_type = self._request('GET', '/cutout?' + urllib.parse.urlencode(query))
+        if content_type == 'image/jpeg':
+            return data
+
+        return np.load(io.BytesIO(data), allow_pickle=False)
+
+    def cutouts(self, queries):
+        '''
+        Returns:
+        ______________
+        list of uint8 cutouts for a list of query dicts (keys as the cutout
+        arguments: 'id' or 'glon', 'glat', 'reff', and the options), cut in one
+        round trip. Queries that fail give None; errors lists why
+
+        '''
+
+        queries = [dict(query) for query in queries]
+        data = self._request('POST', '/cutouts', json.dumps(queries).encode())[0]
+
+        with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+            self.errors = [str(error) for error in arrays['errors']]
+            return [arrays[str(number)] if not error else None
+                    for number, error in enumerate(self.errors)]
+
+    def status(self):
+        '''
+        Returns:
+        ______________
+        dict of server statistics (requests, batches, cache hits, ...)
+        '''
+
+        return json.loads(self._request('GET', '/status')[0])
+
+    @staticmethod
+    def _query(bubble_id, control, glon, glat, reff, options):
+
+        query = dict(options)
+        if bubble_id is not None:
+            query['id'] = bubble_id
+        else:
+            query.update({'glon': glon, 'glat': glat, 'reff': reff})
+        if control:
+            query['control'] = 1
+
+        return query
+
+    def close(self):
+
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
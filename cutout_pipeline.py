@@ -0,0 +1,722 @@
+'''
+Multi-stage pipelined cutout production.
+
+The region read, resize, JPEG encode and write steps run as separate stages
+connected by bounded queues, so CPU-bound resizing and I/O-bound JPEG writing overlap.
+Every stage has its own worker count and reports its throughput. With the
+linear and area resize kernels, the pairs are read and resized in batches, and
+the crops of a batch are resized together by size.
+
+With a CutoutManifest, runs are incremental: only bubbles whose inputs changed
+(or whose outputs are missing) go through the stages, and outputs of bubbles
+that are no longer produced are removed.
+'''
+
+import concurrent.futures
+import functools
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+from cutout_buffer import convert_cutout
+from cutout_stream import resize_cutout, extract, plan_cutouts
+from cutout_writer import CutoutWriter, encode_jpeg
+from dataset import (DATASET_CUTOUTS, DATASET_HASHES, CutoutDataset, RowJournal,
+                     create_cutout_array)
+from manifest import cutout_input_hash
+from resize_kernel import RESIZE_KERNELS, resize_batch
+
+#Put on a queue to tell a worker that its upstream stage is finished
+_DONE = object()
+
+#Bubble/control pairs per resize task with the linear and area kernels. The crops
+#of a task are grouped by size, and every group is resized with one matrix product
+RESIZE_BATCH_PAIRS = 16
+
+
+class PipelineStage(object):
+    '''
+    One step of a pipeline.
+
+    Args:
+    --------------
+    name: string; shown in the throughput report
+    function: callable item -> item, or -> None to drop the item
+    workers: int; number of items processed concurrently
+    processes: bool; if True, function runs in a pool of worker processes, so it
+               and its items must be picklable. Otherwise it runs in threads
+    on_item: callable (item, result, seconds) or None; called in this process
+             after every item, e.g. to record slow items
+    split: bool; if True, function returns a list of items (e.g. for a batch), and
+           they are passed to the next stage one at a time
+
+    '''
+
+    def __init__(self, name, function, workers=1, processes=False, on_item=None, split=False):
+
+        if workers < 1:
+            raise ValueError('stage %s needs at least one worker' % name)
+
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.processes = processes
+        self.on_item = on_item
+        self.split = split
+
+        self.items = 0
+        self.busy = 0.0
+        self.started = None
+        self.finished = None
+
+    @property
+    def wall(self):
+        if self.started is None or self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+    def report(self):
+        '''
+        Returns:
+        ______________
+        dict with the stage name, workers, items, wall/busy seconds and throughput
+
+        '''
+
+        wall = self.wall
+
+        return {'stage': self.name,
+                'workers': self.workers,
+                'items': self.items,
+                'wall_seconds': wall,
+                'busy_seconds': self.busy,
+                'items_per_second': self.items / wall if wall > 0 else 0.0}
+
+
+def run_pipeline(items, stages, queue_size=16):
+    '''
+    Returns:
+    ______________
+    list of the items that come out of the last stage, in completion order
+
+    Args:
+    --------------
+    items: iterable of input items for the first stage
+    stages: list of PipelineStage
+    queue_size: int; capacity of the queue in front of every stage
+
+    Notes:
+    --------------
+    The first error raised by a stage stops the pipeline and is raised again here.
+    A throughput line is printed for every stage
+
+    Usage:
+    ______________
+    results = run_pipeline(range(10), [PipelineStage('square', lambda x: x * x, workers=2)])
+
+    '''
+
+    queues = [queue.Queue(maxsize=queue_size) for stage in stages] + [queue.Queue()]
+    errors = []
+    failed = threading.Event()
+    lock = threading.Lock()
+    remaining = [stage.workers for stage in stages]
+    pools = [concurrent.futures.ProcessPoolExecutor(max_workers=stage.workers)
+             if stage.processes else None for stage in stages]
+
+    def work(index):
+        stage = stages[index]
+        inbox = queues[index]
+        outbox = queues[index + 1]
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                break
+            #After a failure, keep draining so the upstream stages never block
+            if failed.is_set():
+                continue
+            start = time.time()
+            try:
+                if pools[index] is None:
+                    result = stage.function(item)
+                else:
+                    result = pools[index].submit(stage.function, item).result()
+            except Exception as error:
+                with lock:
+                    errors.append(error)
+                failed.set()
+                continue
+            end = time.time()
+            with lock:
+                stage.items = stage.items + 1
+                stage.busy = stage.busy + (end - start)
+                if stage.started is None or start < stage.started:
+                    stage.started = start
+                if stage.finished is None or end > stage.finished:
+                    stage.finished = end
+                if stage.on_item is not None:
+                    stage.on_item(item, result, end - start)
+            if result is None:
+                continue
+            if stage.split:
+                for part in result:
+                    outbox.put(part)
+            else:
+                outbox.put(result)
+
+        #The last worker of a stage tells every worker of the next stage to stop
+        with lock:
+            remaining[index] = remaining[index] - 1
+            last = remaining[index] == 0
+        if last:
+            downstream = stages[index + 1].workers if index + 1 < len(stages) else 1
+            for worker in range(downstream):
+                outbox.put(_DONE)
+
+    threads = []
+    for index, stage in enumerate(stages):
+        for worker in range(stage.workers):
+            thread = threading.Thread(target=work, args=(index,),
+                                      name='%s-%d' % (stage.name, worker))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+    #Collect the results while feeding, so a full last queue never blocks the feeder
+    results = []
+
+    def collect():
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                break
+            results.append(item)
+
+    collector = threading.Thread(target=collect, name='collect')
+    collector.daemon = True
+    collector.start()
+
+    try:
+        for item in items:
+            if failed.is_set():
+                break
+            queues[0].put(item)
+    finally:
+        for worker in range(stages[0].workers):
+            queues[0].put(_DONE)
+        for thread in threads:
+            thread.join()
+        collector.join()
+        for pool in pools:
+            if pool is not None:
+                pool.shutdown()
+
+    for stage in stages:
+        report = stage.report()
+        print("Status: stage %s: %d items in %.2f s (%.1f items/s, %.2f s busy, %d workers)"
+              % (stage.name, report['items'], report['wall_seconds'], report['items_per_second'],
+                 report['busy_seconds'], stage.workers))
+
+    if errors:
+        raise errors[0]
+
+    return results
+
+
+def read_regions(panorama, item):
+    '''
+    Returns:
+    ______________
+    (record, bubble_crop, control_crop); the crops are read into memory
+
+    Args:
+    --------------
+    panorama: the (memory-mapped) panorama
+    item: (record, bubble_borders, control_borders) from plan_cutouts
+
+    '''
+
+    record, bubble_borders, control_borders = item
+
+    return (record, np.array(extract(panorama, bubble_borders)),
+            np.array(extract(panorama, control_borders)))
+
+
+def read_pyramid_regions(pyramid, target_size, item):
+    '''
+    Returns:
+    ______________
+    (record, bubble_crop, control_crop); like read_regions, but every crop is read
+    from the smallest pyramid level that still has target_size pixels across it
+
+    '''
+
+    record, bubble_borders, control_borders = item
+
+    return (record, np.array(pyramid.extract_for(bubble_borders, target_size)),
+            np.array(pyramid.extract_for(control_borders, target_size)))
+
+
+def resize_regions(dim, dtype, item, kernel='skimage'):
+    '''
+    Returns:
+    ______________
+    (record, bubble_cutout, control_cutout) resized to dim with kernel (one of
+    resize_kernel.RESIZE_KERNELS) and converted to dtype
+
+    '''
+
+    record, bubble_crop, control_crop = item
+
+    if kernel == 'skimage':
+        bubble_cutout, control_cutout = (resize_cutout(bubble_crop, dim),
+                                         resize_cutout(control_crop, dim))
+    else:
+        #The pair has the same size, so it is resized as one batch
+        bubble_cutout, control_cutout = resize_batch([bubble_crop, control_crop], dim, kernel)
+
+    return (record, convert_cutout(bubble_cutout, dtype), convert_cutout(control_cutout, dtype))
+
+
+def read_batch(read, batch):
+    '''
+    Returns:
+    ______________
+    list of the (record, bubble_crop, control_crop) of every item of batch, read
+    with read (read_regions or read_pyramid_regions)
+
+    '''
+
+    return [read(item) for item in batch]
+
+
+def resize_region_batch(dim, dtype, batch, kernel='linear'):
+    '''
+    Returns:
+    ______________
+    list of (record, bubble_cutout, control_cutout), resize_regions of every item
+    of batch, in order
+
+    Notes:
+    --------------
+    All the crops of the batch go through one resize_kernel.resize_batch call, so
+    crops of the same size are resized together, whichever pair they belong to.
+    With the pyramid, crops are between dim and 2 * dim across, so the bubbles of
+    a batch often share sizes
+
+    '''
+
+    if kernel == 'skimage':
+        return [resize_regions(dim, dtype, item, kernel) for item in batch]
+
+    crops = []
+    for record, bubble_crop, control_crop in batch:
+        crops.extend([bubble_crop, control_crop])
+    cutouts = resize_batch(crops, dim, kernel)
+
+    return [(item[0], convert_cutout(cutouts[2 * k], dtype),
+             convert_cutout(cutouts[2 * k + 1], dtype)) for k, item in enumerate(batch)]
+
+
+def chunk_items(items, size):
+    '''
+    Returns:
+    ______________
+    generator of lists of up to size consecutive items
+    '''
+
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def store_cutouts(buffer, slots, passthrough, item, journal=None, hashes=None):
+    '''
+    Returns:
+    ______________
+    item, after storing its cutouts in the dataset buffer at the slots of its
+    record. If passthrough is False, (record, None, None) is returned instead
+
+    Args:
+    --------------
+    buffer: CutoutBuffer of the dataset
+    slots: dict of {catalog position: (bubble_index, control_index)}
+    journal: RowJournal or None; if given, the pair is also appended to it
+    hashes: dict of {catalog position: (bubble_hash, control_hash)}, with a journal
+
+    '''
+
+    record, bubble_cutout, control_cutout = item
+    bubble_index, control_index = slots[record.position]
+
+    buffer.put(bubble_index, bubble_cutout)
+    buffer.put(control_index, control_cutout)
+    if journal is not None:
+        journal.append(record.name, hashes[record.position][0], hashes[record.position][1],
+                       bubble_cutout, control_cutout)
+
+    if passthrough:
+        return item
+
+    return (record, None, None)
+
+
+def encode_cutouts(item):
+    '''
+    Returns:
+    ______________
+    (record, bubble_jpeg, control_jpeg) with the cutouts encoded to JPEG bytes
+
+    '''
+
+    record, bubble_cutout, control_cutout = item
+
+    return (record, encode_jpeg(convert_cutout(bubble_cutout, np.uint8)),
+            encode_jpeg(convert_cutout(control_cutout, np.uint8)))
+
+
+def write_cutouts(writer, item):
+    '''
+    Returns:
+    ______________
+    (record, bubble_location, control_location), after writing ID.jpg and
+    ID_control.jpg with the CutoutWriter
+
+    '''
+
+    record, bubble_jpeg, control_jpeg = item
+
+    return (record, writer.write(record.name + ".jpg", bubble_jpeg),
+            writer.write(record.name + "_control.jpg", control_jpeg))
+
+
+def record_cutouts(manifest, hashes, item):
+    '''
+    Returns:
+    ______________
+    item, after recording its written bubble and control in the manifest
+
+    Args:
+    --------------
+    manifest: CutoutManifest of the output directory
+    hashes: dict of {catalog position: (bubble_hash, control_hash)}
+    item: (record, bubble_location, control_location) from write_cutouts
+
+    '''
+
+    record, bubble_location, control_location = item
+    bubble_hash, control_hash = hashes[record.position]
+
+    manifest.record(record.name + ".jpg", bubble_hash, bubble_location)
+    manifest.record(record.name + "_control.jpg", control_hash, control_location)
+
+    return item
+
+
+def plan_input_hashes(catalog, plan, params, tiles, pyramid=None, target_size=None):
+    '''
+    Returns:
+    ______________
+    dict of {catalog position: (bubble_hash, control_hash)} for the planned items
+
+    Args:
+    --------------
+    catalog: converted BubbleCatalog
+    plan: list of (record, bubble_borders, control_borders) from plan_cutouts
+    params: dict of the generation parameters that change the output
+    tiles: list of (name, left, width, checksum) from tile_checksums
+    pyramid, target_size: the pyramid the crops are read from with extract_for and
+                          its target_size, or None when they are read from level 0
+
+    '''
+
+    def source(borders):
+        return None if pyramid is None else pyramid.source_borders_for(borders, target_size)
+
+    hashes = {}
+    for record, bubble_borders, control_borders in plan:
+        bubble = catalog[record.position]
+        values = (bubble['glon'], bubble['glat'], bubble['reff'])
+        hashes[record.position] = (
+            cutout_input_hash(record.name + ".jpg", *values, borders=bubble_borders,
+                              params=params, tiles=tiles, source_borders=source(bubble_borders)),
+            cutout_input_hash(record.name + "_control.jpg", *values, borders=control_borders,
+                              params=params, tiles=tiles,
+                              source_borders=source(control_borders)))
+
+    return hashes
+
+
+def previous_dataset(dataset_dir, dim):
+    '''
+    Returns:
+    ______________
+    (CutoutDataset, {id: input_hash}) of an earlier incremental run in dataset_dir,
+    or (None, {}) if there is none with the same cutout shape
+
+    '''
+
+    try:
+        dataset = CutoutDataset(dataset_dir)
+        with open(os.path.join(dataset_dir, DATASET_HASHES)) as hash_file:
+            hashes = json.load(hash_file)
+    except (IOError, OSError, ValueError):
+        return (None, {})
+
+    if tuple(dataset.info['dim']) != tuple(dim):
+        return (None, {})
+
+    return (dataset, hashes)
+
+
+def run_cutout_pipeline(catalog, panorama, save_dir, pad=50, dim=(224, 224, 3), hshift=0,
+                        vshift=0, skipped_cutouts=None, skipped_controls=None, read_workers=2,
+                        resize_workers=None, encode_workers=None, write_workers=4,
+                        resize_processes=True, layout='flat', write_jpegs=True, dataset_dir=None,
+                        queue_size=16, manifest=None, tiles=None, control_centers=None,
+                        pyramid=None, instrumentation=None, positions=None,
+                        resize_kernel='skimage', resize_batch_size=RESIZE_BATCH_PAIRS):
+    '''
+    Returns:
+    ______________
+    list of (CutoutRecord, bubble_location, control_location) tuples for the saved
+    bubble/control pairs, in catalog order. The locations are relative to save_dir,
+    or None when no JPEGs are written
+
+    Args:
+    --------------
+    catalog: converted BubbleCatalog (the x, y, r fields are filled in)
+    panorama: anything that supports [top:bot, left:right, :] slicing and .shape
+    save_dir: string; directory the cutout JPEGs are written to
+    pad, dim, hshift, vshift: the cutoutgen.py loop parameters
+    skipped_cutouts, skipped_controls: lists or None; see plan_cutouts
+    read_workers: int; threads reading regions from the panorama
+    resize_workers: int; resize workers, defaults to os.cpu_count()
+    encode_workers: int; JPEG encoding processes, defaults to os.cpu_count()
+    write_workers: int; threads writing the encoded JPEGs
+    resize_processes: bool; if True, resize in worker processes instead of threads
+    layout: string; output layout, one of cutout_writer.LAYOUTS
+    write_jpegs: bool; if False, the encode and write stages are left out
+    dataset_dir: string or None; if given, the cutouts are also stored in a
+                 memory-mapped dataset there, see dataset.py
+    queue_size: int; capacity of the queue in front of every stage
+    manifest: CutoutManifest of save_dir or None; if given, only bubbles whose
+              inputs changed are generated and stale outputs are removed
+    tiles: list of (name, left, width, checksum) from tile_checksums, so that a
+           changed tile regenerates the cutouts it overlaps. Only used with a manifest
+    control_centers: dict of {catalog position: (x, y)} or None; sampled control
+                     centers (see control_sampling.py) instead of the mirror locations
+    pyramid: PanoramaPyramid or None; if given, crops are read from the pyramid
+             level closest to dim, so large bubbles resize small crops
+    instrumentation: Instrumentation or None; if given, the read and resize time
+                     of every pair and the stage throughputs are recorded
+    positions: iterable of catalog positions or None; only these bubbles are
+               produced, read in this order (see plan_cutouts). The dataset rows
+               and the returned list stay in catalog order
+    resize_kernel: string; one of resize_kernel.RESIZE_KERNELS. 'skimage' keeps the
+                   cutouts of the cutoutgen.py loop, 'linear' and 'area' are faster
+    resize_batch_size: int; with the linear and area kernels, the read and resize
+                       stages work on batches of this many pairs, and the crops of
+                       a batch are grouped by size (see resize_region_batch). Their
+                       throughput reports count batches
+
+    Notes:
+    --------------
+    An interrupted incremental run can simply be started again: every written
+    pair is recorded in the manifest as soon as it is on disk, and its dataset
+    rows in the RowJournal of dataset_dir as soon as they are stored
+
+    Usage:
+    ______________
+    saved = run_cutout_pipeline(catalog, final_panorama, 'cutouts', layout='hashed')
+    saved = run_cutout_pipeline(catalog, final_panorama, 'cutouts',
+                                manifest=CutoutManifest('cutouts'),
+                                tiles=tile_checksums(data_dir))
+
+    '''
+
+    if resize_workers is None:
+        resize_workers = os.cpu_count() or 1
+    if encode_workers is None:
+        encode_workers = os.cpu_count() or 1
+    if not write_jpegs and dataset_dir is None:
+        raise ValueError('nothing to produce: enable write_jpegs or give a dataset_dir')
+
+    if manifest is not None and not write_jpegs:
+        raise ValueError('a manifest tracks the JPEG outputs, it needs write_jpegs')
+
+    if resize_kernel not in RESIZE_KERNELS:
+        raise ValueError('unknown resize kernel %r, expected one of %s'
+                         % (resize_kernel, ', '.join(RESIZE_KERNELS)))
+
+    plan = plan_cutouts(catalog, panorama.shape, pad, hshift, vshift, skipped_cutouts,
+                        skipped_controls, control_centers, positions)
+
+    #Split the plan into pairs that are up to date and pairs to generate
+    reused = []
+    journal = None
+    hashes = None
+    if manifest is not None:
+        plan = list(plan)
+        params = {'pad': pad, 'dim': list(dim), 'hshift': hshift, 'vshift': vshift,
+                  'layout': layout, 'pyramid': pyramid is not None}
+        #Only other kernels are hashed, so outputs of earlier runs stay current
+        if resize_kernel != 'skimage':
+            params['resize_kernel'] = resize_kernel
+        hashes = plan_input_hashes(catalog, plan, params, tiles or [], pyramid,
+                                   min(dim[0], dim[1]))
+        old_dataset, old_hashes = (None, {})
+        if dataset_dir is not None:
+            old_dataset, old_hashes = previous_dataset(dataset_dir, dim)
+            #The pairs stored by an earlier run that was interrupted
+            journal = RowJournal(dataset_dir, dim)
+
+        todo = []
+        for item in plan:
+            name = item[0].name
+            bubble_hash, control_hash = hashes[item[0].position]
+            current = (manifest.is_current(name + ".jpg", bubble_hash) and
+                       manifest.is_current(name + "_control.jpg", control_hash))
+            if dataset_dir is not None:
+                current = current and (journal.has(name, bubble_hash, control_hash) or
+                                       (old_hashes.get(name) == bubble_hash and
+                                        old_hashes.get(name + "_control") == control_hash))
+            if current:
+                reused.append(item)
+            else:
+                todo.append(item)
+
+        current_names = set()
+        for item in plan:
+            current_names.update([item[0].name + ".jpg", item[0].name + "_control.jpg"])
+        stale = [name for name in manifest.entries if name not in current_names]
+
+        print("Status: %d cutout pairs up to date, %d to generate, %d stale outputs to remove"
+              % (len(reused), len(todo), len(stale)))
+        plan = todo
+
+    if pyramid is None:
+        read = functools.partial(read_regions, panorama)
+    else:
+        read = functools.partial(read_pyramid_regions, pyramid, min(dim[0], dim[1]))
+
+    read_item = resize_item = None
+    if instrumentation is not None:
+        def read_item(item, result, seconds):
+            instrumentation.item('read', seconds, item[0].name, radius=item[0].radius,
+                                 bytes=result[1].nbytes + result[2].nbytes)
+
+        def resize_item(item, result, seconds):
+            instrumentation.item('resize', seconds, item[0].name, radius=item[0].radius,
+                                 crop=list(item[1].shape[:2]))
+
+    batched = resize_kernel != 'skimage' and resize_batch_size > 1
+    if batched:
+        #The pairs of a batch share its time
+        if instrumentation is not None:
+            read_one, resize_one = read_item, resize_item
+
+            def read_item(batch, results, seconds):
+                for item, result in zip(batch, results):
+                    read_one(item, result, seconds / len(batch))
+
+            def resize_item(batch, results, seconds):
+                for item, result in zip(batch, results):
+                    resize_one(item, result, seconds / len(batch))
+
+        stages = [PipelineStage('read', functools.partial(read_batch, read), read_workers,
+                                on_item=read_item),
+                  PipelineStage('resize', functools.partial(resize_region_batch, tuple(dim),
+                                                            np.uint8, kernel=resize_kernel),
+                                resize_workers, processes=resize_processes, on_item=resize_item,
+                                split=True)]
+    else:
+        stages = [PipelineStage('read', read, read_workers, on_item=read_item),
+                  PipelineStage('resize', functools.partial(resize_regions, tuple(dim), np.uint8,
+                                                            kernel=resize_kernel),
+                                resize_workers, processes=resize_processes, on_item=resize_item)]
+
+    #The dataset rows are known up front: bubbles first, then their controls
+    buffer = None
+    if dataset_dir is not None:
+        plan = list(plan)
+        everything = sorted(plan + reused, key=lambda item: item[0].position)
+        slots = dict((item[0].position, (k, len(everything) + k))
+                     for k, item in enumerate(everything))
+        #An incremental run builds the new array next to the old one it copies from
+        file_name = DATASET_CUTOUTS if manifest is None else DATASET_CUTOUTS + '.partial'
+        buffer = create_cutout_array(dataset_dir, 2 * len(everything), dim, file_name)
+        for item in reused:
+            bubble_index, control_index = slots[item[0].position]
+            pair = journal.pair(item[0].name, *hashes[item[0].position])
+            if pair is None:
+                pair = (old_dataset.by_id(item[0].name)[0],
+                        old_dataset.by_id(item[0].name + "_control")[0])
+            buffer.put(bubble_index, pair[0])
+            buffer.put(control_index, pair[1])
+        stages.append(PipelineStage('store', functools.partial(store_cutouts, buffer, slots,
+                                                               write_jpegs, journal=journal,
+                                                               hashes=hashes), 1))
+
+    writer = None
+    if write_jpegs:
+        writer = CutoutWriter(save_dir, layout=layout)
+        stages.append(PipelineStage('encode', encode_cutouts, encode_workers, processes=True))
+        stages.append(PipelineStage('write', functools.partial(write_cutouts, writer),
+                                    write_workers))
+    if manifest is not None:
+        stages.append(PipelineStage('manifest', functools.partial(record_cutouts, manifest,
+                                                                  hashes), 1))
+
+    try:
+        saved = run_pipeline(chunk_items(plan, resize_batch_size) if batched else plan, stages,
+                             queue_size=queue_size)
+    finally:
+        if writer is not None:
+            writer.close()
+        if buffer is not None:
+            buffer.flush()
+        if journal is not None:
+            journal.close()
+
+    if instrumentation is not None:
+        instrumentation.pipeline('cutouts', stages)
+
+    if writer is not None:
+        print("Status: wrote %d cutouts, %.1f MB, with the %s layout"
+              % (writer.count, writer.bytes_written / 1024.0 ** 2, layout))
+
+    if manifest is not None:
+        saved = saved + [(item[0], manifest.location(item[0].name + ".jpg"),
+                          manifest.location(item[0].name + "_control.jpg")) for item in reused]
+        manifest.remove_stale(current_names)
+        manifest.compact()
+        if buffer is not None:
+            #Release the old array before it is replaced
+            old_dataset = None
+            final_path = os.path.join(dataset_dir, DATASET_CUTOUTS)
+            os.replace(buffer.path, final_path)
+            buffer.path = final_path
+            row_hashes = {}
+            for position, (bubble_hash, control_hash) in hashes.items():
+                name = catalog[position]['id']
+                row_hashes[str(name)] = bubble_hash
+                row_hashes[str(name) + "_control"] = control_hash
+            with open(os.path.join(dataset_dir, DATASET_HASHES), 'w') as hash_file:
+                json.dump(row_hashes, hash_file)
+            journal.remove()
+
+    if buffer is not None:
+        print("Status: stored %d cutouts in %s" % (buffer.capacity, dataset_dir))
+
+    return sorted(saved, key=lambda item: item[0].position)
@@ -0,0 +1,536 @@
+'''
+Local cutout service that keeps the panorama resident.
+
+cutoutgen.py maps the survey, cuts every bubble and exits, so a single new
+cutout costs a whole run. The server opens the panorama pyramid and the catalog
+once and answers cutout requests over HTTP on localhost:
+
+GET  /cutout?id=1G303341-007180&control=1
+GET  /cutout?glon=303.34&glat=-0.72&reff=0.03&dim=128&format=jpeg
+POST /cutouts    a JSON list of the same queries, answered as one .npz
+GET  /status
+
+Cutouts are cut exactly like in cutoutgen.py (pad, hshift, vshift, dim) from
+the matching pyramid level. The controls of catalog IDs are the ones cutoutgen.py
+samples with the same pad and control options (--mirror-controls serves the
+mirror locations instead). Requests from all connections are gathered by one
+batching thread, for up to batch_size requests or max_delay seconds, and a batch
+is read in panorama column order. Finished cutouts are kept in an LRU cache with
+a byte budget. cutout_client.CutoutClient is the matching client.
+
+Usage:
+______________
+python cutout_server.py ../Desktop/mapping_data/bubbly.csv --data-dir ../Desktop/mapping_data
+'''
+
+import argparse
+import collections
+import http.server
+import io
+import json
+import queue
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+
+from catalog import FLAG_BAD_COORDS
+from coords import degrees_to_pixels, invalid_coordinates
+from cutout_client import DEFAULT_PORT
+from cutout_buffer import convert_cutout
+from cutout_stream import crop_borders, inside_panorama, mirror_center, resize_cutout
+
+#Response formats: raw .npy bytes or the JPEG cutoutgen.py would write
+FORMATS = ('npy', 'jpeg')
+
+
+class CutoutCache(object):
+    '''
+    Thread-safe LRU cache of cutout arrays, bounded by their total size.
+
+    Args:
+    --------------
+    max_bytes: int; arrays are evicted, least recently used first, above this size
+
+    '''
+
+    def __init__(self, max_bytes=256 * 1024 ** 2):
+
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        '''
+        Returns:
+        ______________
+        the cached array for key, or None
+        '''
+
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses = self.misses + 1
+                return None
+            self._items.move_to_end(key)
+            self.hits = self.hits + 1
+
+            return value
+
+    def put(self, key, value):
+
+        if value.nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._items:
+                self.nbytes = self.nbytes - self._items.pop(key).nbytes
+            self._items[key] = value
+            self.nbytes = self.nbytes + value.nbytes
+            while self.nbytes > self.max_bytes:
+                self.nbytes = self.nbytes - self._items.popitem(last=False)[1].nbytes
+
+
+def parse_query(query, defaults):
+    '''
+    Returns:
+    ______________
+    dict; one normalized cutout request with the keys 'id' or 'glon', 'glat',
+    'reff', and 'control', 'pad', 'dim', 'hshift', 'vshift', 'format'
+
+    Args:
+    --------------
+    query: dict of request parameters (strings from a URL or JSON values)
+    defaults: dict of the server's 'pad', 'dim', 'hshift', 'vshift'
+
+    '''
+
+    request = {'control': str(query.get('control', '0')).lower() in ('1', 'true', 'yes'),
+               'pad': int(query.get('pad', defaults['pad'])),
+               'hshift': int(query.get('hshift', defaults['hshift'])),
+               'vshift': int(query.get('vshift', defaults['vshift'])),
+               'format': str(query.get('format', 'npy'))}
+
+    dim = query.get('dim', defaults['dim'])
+    if isinstance(dim, str):
+        dim = [int(value) for value in dim.split(',')]
+    dim = [int(value) for value in np.atleast_1d(dim)]
+    if len(dim) == 1:
+        dim = dim * 2
+    if len(dim) == 2:
+        dim = dim + [defaults['dim'][2]]
+    request['dim'] = tuple(dim)
+
+    if request['format'] not in FORMATS:
+        raise ValueError('format must be one of %s' % (FORMATS,))
+    if len(request['dim']) != 3 or min(request['dim']) <= 0:
+        raise ValueError('dim must be "size", "rows,cols" or "rows,cols,channels"')
+
+    if 'id' in query:
+        request['id'] = str(query['id'])
+    elif all(name in query for name in ('glon', 'glat', 'reff')):
+        for name in ('glon', 'glat', 'reff'):
+            request[name] = float(query[name])
+    else:
+        raise ValueError('a request needs an id or glon, glat and reff')
+
+    return request
+
+
+class _Pending(object):
+    '''
+    A request waiting for the batching thread
+    '''
+
+    def __init__(self, request):
+
+        self.request = request
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class CutoutService(object):
+    '''
+    Cuts bubble/control cutouts from a resident panorama pyramid.
+
+    Args:
+    --------------
+    pyramid: PanoramaPyramid of the panorama
+    catalog: converted BubbleCatalog (the x, y, r fields are filled in)
+    pad, dim, hshift, vshift: default cutoutgen.py loop parameters of a request
+    control_centers: dict of {catalog position: (x, y)} or None for the mirror locations
+    cache_bytes: int; size of the cutout cache
+    batch_size: int; most requests cut in one batch
+    max_delay: float; seconds the batching thread waits for more requests
+
+    Usage:
+    ______________
+    service = CutoutService(pyramid, catalog)
+    cutout = service.cutout({'id': '1G303341-007180'})
+    service.close()
+
+    '''
+
+    def __init__(self, pyramid, catalog, pad=50, dim=(224, 224, 3), hshift=0, vshift=0,
+                 control_centers=None, cache_bytes=256 * 1024 ** 2, batch_size=32,
+                 max_delay=0.005):
+
+        self.pyramid = pyramid
+        self.catalog = catalog
+        self.defaults = {'pad': pad, 'dim': tuple(dim), 'hshift': hshift, 'vshift': vshift}
+        self.control_centers = control_centers
+        self.cache = CutoutCache(cache_bytes)
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.started = time.time()
+        self.requests = 0
+        self.batches = 0
+        self.cut_seconds = 0.0
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._batch_loop, name='cutout-batcher',
+                                        daemon=True)
+        self._thread.start()
+
+    def borders(self, request):
+        '''
+        Returns:
+        ______________
+        (left, right, top, bot) level 0 crop borders of a parsed request. Raises
+        KeyError for unknown IDs and ValueError for crops outside of the panorama
+        '''
+
+        shape = self.pyramid.shape
+
+        if 'id' in request:
+            position = self.catalog.position(request['id'])
+            record = self.catalog[position]
+            if record['flags'] & FLAG_BAD_COORDS:
+                raise ValueError('%s has out of range coordinates' % request['id'])
+            center = (int(record['x']), int(record['y']))
+            radius = int(record['r'])
+            if request['control']:
+                if self.control_centers is None:
+                    center = mirror_center(center, shape)
+                elif position in self.control_centers:
+                    center = self.control_centers[position]
+                else:
+                    raise ValueError('%s has no control' % request['id'])
+        else:
+            bad = invalid_coordinates(request['glon'], request['glat'], request['reff'])
+            if any(np.any(values) for values in bad):
+                raise ValueError('glon, glat or reff is out of range')
+            x, y, r = degrees_to_pixels([request['glon']], [request['glat']], [request['reff']],
+                                        shape)
+            center = (int(x[0]), int(y[0]))
+            radius = int(r[0])
+            if request['control']:
+                center = mirror_center(center, shape)
+
+        borders = crop_borders(center, radius, request['pad'], request['hshift'],
+                               request['vshift'])
+        if not inside_panorama(borders, shape):
+            raise ValueError('the crop %s leaks outside of the panorama' % (borders,))
+
+        return borders
+
+    def cut(self, requests):
+        '''
+        Returns:
+        ______________
+        list with a uint8 cutout or the exception raised for every parsed request.
+        Cached cutouts are reused, and duplicate requests are cut once
+
+        '''
+
+        results = [None] * len(requests)
+        missing = collections.defaultdict(list)
+
+        for number, request in enumerate(requests):
+            try:
+                key = (self.borders(request), request['dim'])
+            except (KeyError, ValueError) as error:
+                results[number] = error
+                continue
+            cutout = self.cache.get(key)
+            if cutout is None:
+                missing[key].append(number)
+            else:
+                results[number] = cutout
+
+        #Neighbouring crops share pages of the memmapped levels
+        start = time.time()
+        for key in sorted(missing, key=lambda key: (key[0][0], key[0][2])):
+            borders, dim = key
+            crop = np.asarray(self.pyramid.extract_for(borders, dim[0]))
+            cutout = convert_cutout(resize_cutout(crop, dim), np.uint8)
+            cutout.setflags(write=False)
+            self.cache.put(key, cutout)
+            for number in missing[key]:
+                results[number] = cutout
+        self.cut_seconds = self.cut_seconds + time.time() - start
+
+        return results
+
+    def _batch_loop(self):
+
+        while True:
+            pending = [self._queue.get()]
+            if pending[0] is None:
+                return
+            deadline = time.time() + self.max_delay
+            while len(pending) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                pending.append(item)
+
+            try:
+                results = self.cut([item.request for item in pending])
+            except Exception as error:
+                results = [error] * len(pending)
+            self.batches = self.batches + 1
+            self.requests = self.requests + len(pending)
+
+            for item, result in zip(pending, results):
+                if isinstance(result, Exception):
+                    item.error = result
+                else:
+                    item.result = result
+                item.done.set()
+
+    def cutouts(self, requests):
+        '''
+        Returns:
+        ______________
+        list with a uint8 cutout or an exception for every parsed request, cut by
+        the batching thread together with the requests of other callers
+        '''
+
+        pending = [_Pending(request) for request in requests]
+        for item in pending:
+            self._queue.put(item)
+        for item in pending:
+            item.done.wait()
+
+        return [item.error if item.error is not None else item.result for item in pending]
+
+    def cutout(self, query):
+        '''
+        Returns:
+        ______________
+        uint8 cutout for one query dict (see parse_query). Raises its KeyError or ValueError
+        '''
+
+        result = self.cutouts([parse_query(query, self.defaults)])[0]
+        if isinstance(result, Exception):
+            raise result
+
+        return result
+
+    def status(self):
+        '''
+        Returns:
+        ______________
+        dict of service statistics, as served on /status
+        '''
+
+        return {'uptime_seconds': time.time() - self.started,
+                'catalog_size': len(self.catalog),
+                'panorama_shape': list(self.pyramid.shape),
+                'pyramid_levels': len(self.pyramid),
+                'defaults': self.defaults,
+                'requests': self.requests,
+                'batches': self.batches,
+                'mean_batch_size': self.requests / float(max(self.batches, 1)),
+                'cut_seconds': self.cut_seconds,
+                'cache_items': len(self.cache),
+                'cache_bytes': self.cache.nbytes,
+                'cache_hits': self.cache.hits,
+                'cache_misses': self.cache.misses}
+
+    def close(self):
+        '''
+        Stop the batching thread
+        '''
+
+        self._queue.put(None)
+        self._thread.join()
+
+
+def encode_cutout(cutout, format='npy'):
+    '''
+    Returns:
+    ______________
+    (bytes, content type) of cutout in one of FORMATS
+    '''
+
+    if format == 'jpeg':
+        from cutout_writer import encode_jpeg
+        return (encode_jpeg(cutout), 'image/jpeg')
+
+    stream = io.BytesIO()
+    np.save(stream, cutout, allow_pickle=False)
+
+    return (stream.getvalue(), 'application/x-npy')
+
+
+class CutoutRequestHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    HTTP front end of a CutoutService, set as the server's service attribute
+    '''
+
+    #Keep-alive connections, so a client pays the TCP handshake once
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, code, body, content_type):
+
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, code, message):
+
+        self._send(code, json.dumps({'error': message}).encode(), 'application/json')
+
+    def do_GET(self):
+
+        service = self.server.service
+        url = urllib.parse.urlsplit(self.path)
+
+        if url.path == '/status':
+            self._send(200, json.dumps(service.status()).encode(), 'application/json')
+            return
+        if url.path != '/cutout':
+            self._send_error(404, 'unknown path %s' % url.path)
+            return
+
+        try:
+            request = parse_query(dict(urllib.parse.parse_qsl(url.query)), service.defaults)
+        except ValueError as error:
+            self._send_error(400, str(error))
+            return
+
+        result = service.cutouts([request])[0]
+        if isinstance(result, KeyError):
+            self._send_error(404, 'unknown bubble ID %s' % request['id'])
+        elif isinstance(result, Exception):
+            self._send_error(422, str(result))
+        else:
+            self._send(200, *encode_cutout(result, request['format']))
+
+    def do_POST(self):
+
+        service = self.server.service
+        if urllib.parse.urlsplit(self.path).path != '/cutouts':
+            self._send_error(404, 'unknown path %s' % self.path)
+            return
+
+        try:
+            queries = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            requests = [parse_query(query, service.defaults) for query in queries]
+        except (TypeError, ValueError, AttributeError) as error:
+            self._send_error(400, str(error))
+            return
+
+        #Cutout i is stored as 'i'; the 'errors' entry is empty for cutouts that worked
+        arrays = {}
+        errors = []
+        for number, result in enumerate(service.cutouts(requests)):
+            if isinstance(result, Exception):
+                errors.append('%s: %s' % (type(result).__name__, result))
+            else:
+                arrays[str(number)] = result
+                errors.append('')
+        arrays['errors'] = np.array(errors, dtype=str)
+
+        stream = io.BytesIO()
+        np.savez(stream, **arrays)
+        self._send(200, stream.getvalue(), 'application/x-npz')
+
+
+def make_server(service, host='127.0.0.1', port=DEFAULT_PORT):
+    '''
+    Returns:
+    ______________
+    http.server.ThreadingHTTPServer serving service; call serve_forever() on it
+
+    '''
+
+    server = http.server.ThreadingHTTPServer((host, port), CutoutRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+
+    return server
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Serve bubble/control cutouts over HTTP.')
+    parser.add_argument('catalog', help='bubble csv, e.g. ../Desktop/mapping_data/bubbly.csv')
+    parser.add_argument('--data-dir', default='../Desktop/mapping_data',
+                        help='directory of the survey tiles and the panorama cache')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--pad', type=int, default=50)
+    parser.add_argument('--size', type=int, default=224, help='default cutout rows and cols')
+    parser.add_argument('--cache-mb', type=float, default=256)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--max-delay', type=float, default=0.005)
+    parser.add_argument('--controls-per-bubble', type=int, default=1)
+    parser.add_argument('--control-candidates', type=int, default=8)
+    parser.add_argument('--control-seed', type=int, default=0)
+    parser.add_argument('--mirror-controls', action='store_true',
+                        help='serve the mirror locations instead of the cutoutgen.py controls')
+    args = parser.parse_args(argv)
+
+    from catalog import BubbleCatalog
+    from pyramid import PanoramaPyramid
+
+    pyramid = PanoramaPyramid(args.data_dir)
+    pyramid.advise_random_access()
+    catalog = BubbleCatalog.from_csv(args.catalog).convert(pyramid.shape)
+
+    #The controls of a cutoutgen.py run with the same pad and control options
+    control_centers = None
+    if not args.mirror_controls:
+        from control_sampling import first_controls, sample_controls
+        control_centers = first_controls(sample_controls(
+            catalog, pyramid.shape, count=args.controls_per_bubble, pad=args.pad,
+            candidates=args.control_candidates, seed=args.control_seed))
+
+    service = CutoutService(pyramid, catalog, pad=args.pad, dim=(args.size, args.size, 3),
+                            control_centers=control_centers,
+                            cache_bytes=int(args.cache_mb * 1024 ** 2),
+                            batch_size=args.batch_size, max_delay=args.max_delay)
+    server = make_server(service, args.host, args.port)
+    print("Status: serving %d bubbles on http://%s:%d" % (len(catalog), args.host, args.port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    main()
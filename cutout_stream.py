@@ -0,0 +1,270 @@
+'''
+Streaming bubble/control cutout generation.
+
+Cutouts are produced one bubble at a time (or in fixed size batches) straight
+from the catalog and the panorama, so memory stays flat no matter how large the
+catalog is. The boundary checks and the pad/dim/hshift/vshift parameters are
+the same as in the cutoutgen.py loop.
+'''
+
+import collections
+
+import numpy as np
+
+from catalog import FLAG_SKIPPED_CUTOUT, FLAG_SKIPPED_CONTROL
+from coords import mirror_coordinates, pixels_to_degrees
+from cutout_buffer import convert_cutout
+from resize_kernel import resize_batch
+
+#Metadata of one produced bubble/control pair
+'''CutoutRecord fields:
+   position        position of the bubble in the catalog
+   name            bubble ID; the control is named name + "_control"
+   radius          effective radius (pixels)
+   hitrate         (unitless)
+   bubble_center   (x, y) pixel tuple
+   control_center  (x, y) pixel tuple of the control, by default the mirror location
+   control_coordinates  (glon, glat) of the control center. Unit: degrees
+'''
+CutoutRecord = collections.namedtuple('CutoutRecord', ['position', 'name', 'radius', 'hitrate',
+                                                       'bubble_center', 'control_center',
+                                                       'control_coordinates'])
+
+
+def resize_cutout(image, dim, kernel='skimage'):
+    '''
+    Returns:
+    ______________
+    image resized to dim with skimage.transform.resize, as in the cutoutgen.py loop,
+    or with another kernel of resize_kernel.py
+
+    '''
+
+    if kernel != 'skimage':
+        return resize_batch([image], dim, kernel)[0]
+
+    from skimage.transform import resize
+
+    return resize(image, dim)
+
+
+def mirror_center(center, shape):
+    '''
+    Returns:
+    ______________
+    tuple: (x, y) of the control, the mirror location of center in the panorama
+
+    Args:
+    --------------
+    center: (x, y) pixel tuple
+    shape: panorama shape, (rows, cols, ...)
+
+    '''
+
+    return ((shape[1] - 1 - center[0]), (shape[0] - 1 - center[1]))
+
+
+def crop_borders(center, radius, pad, hshift=0, vshift=0):
+    '''
+    Returns:
+    ______________
+    tuple: (left, right, top, bot) crop borders around center
+
+    '''
+
+    left = center[0] - (radius + pad) + hshift
+    right = center[0] + (radius + pad) + hshift
+    top = (center[1] - (radius + pad)) + vshift
+    bot = (center[1] + (radius + pad)) + vshift
+
+    return (left, right, top, bot)
+
+
+def inside_panorama(borders, shape):
+    '''
+    Returns:
+    ______________
+    bool; False if the crop borders leak outside of the meaningful array range
+
+    '''
+
+    left, right, top, bot = borders
+
+    return not (top < 0 or bot > shape[0] - 1 or left < 0 or right > shape[1] - 1)
+
+
+def plan_cutouts(catalog, shape, pad=50, hshift=0, vshift=0, skipped_cutouts=None,
+                 skipped_controls=None, control_centers=None, positions=None):
+    '''
+    Returns:
+    ______________
+    generator of (CutoutRecord, bubble_borders, control_borders) tuples for the
+    bubbles whose bubble and control crops are inside the panorama. The borders
+    are (left, right, top, bot) tuples
+
+    Args:
+    --------------
+    catalog: converted BubbleCatalog (the x, y, r fields are filled in)
+    shape: panorama shape, (rows, cols, ...)
+    pad, hshift, vshift: the cutoutgen.py loop parameters
+    skipped_cutouts: list or None; names of bubbles that leak outside are appended
+    skipped_controls: list or None; names of bubbles whose control leaks outside are appended
+    control_centers: dict of {catalog position: (x, y)} or None; control centers
+                     to use instead of the mirror locations, e.g. from
+                     control_sampling.first_controls. Bubbles without an entry
+                     are skipped like controls that leak outside
+    positions: iterable of catalog positions or None; only these bubbles are
+               planned, in this order (e.g. the bubbles of one shard, see sharding.py)
+
+    Notes:
+    --------------
+    Skipped bubbles are also flagged in the catalog
+
+    '''
+
+    if positions is None:
+        positions = range(len(catalog))
+
+    for position in positions:
+
+        #Get values from the catalog record
+        record = catalog[position]
+        name = str(record['id'])
+        bubble_center = (int(record['x']), int(record['y']))
+        radius = int(record['r'])
+        hitrate = float(record['hitrate'])
+
+        #Get the center for each control, which is the mirror location of the bubble
+        #unless sampled control centers are given
+        control_center = mirror_center(bubble_center, shape)
+        if control_centers is not None:
+            control_center = control_centers.get(position)
+
+        #Skip bubbles that leak outside of meaningful array range
+        bubble_borders = crop_borders(bubble_center, radius, pad, hshift, vshift)
+        if not inside_panorama(bubble_borders, shape):
+            if skipped_cutouts is not None:
+                skipped_cutouts.append(name)
+            catalog.set_flag(FLAG_SKIPPED_CUTOUT, position)
+            continue
+
+        #Skip controls that leak outside of meaningful array range
+        control_borders = None
+        if control_center is not None:
+            control_borders = crop_borders(control_center, radius, pad, hshift, vshift)
+        if control_borders is None or not inside_panorama(control_borders, shape):
+            if skipped_controls is not None:
+                skipped_controls.append(name)
+            catalog.set_flag(FLAG_SKIPPED_CONTROL, position)
+            continue
+
+        #The exact mirrored degrees for mirror controls, the pixel's degrees otherwise
+        if control_center == mirror_center(bubble_center, shape):
+            glon, glat = mirror_coordinates(record['glon'], record['glat'])
+        else:
+            glon, glat = pixels_to_degrees(control_center[0], control_center[1], shape)
+        control_coordinates = (float(glon), float(glat))
+
+        yield (CutoutRecord(position, name, radius, hitrate, bubble_center, control_center,
+                            control_coordinates), bubble_borders, control_borders)
+
+
+def extract(panorama, borders):
+    '''
+    Returns:
+    ______________
+    the [top:bot, left:right, :] region of panorama for (left, right, top, bot) borders
+
+    '''
+
+    left, right, top, bot = borders
+
+    return panorama[top:bot, left:right, :]
+
+
+def iter_cutouts(catalog, panorama, pad=50, dim=(224, 224, 3), hshift=0, vshift=0,
+                 skipped_cutouts=None, skipped_controls=None, dtype=np.uint8,
+                 resize_fn=resize_cutout, control_centers=None, positions=None):
+    '''
+    Returns:
+    ______________
+    generator of (CutoutRecord, bubble_cutout, control_cutout) tuples
+
+    Args:
+    --------------
+    catalog: converted BubbleCatalog (the x, y, r fields are filled in)
+    panorama: anything that supports [top:bot, left:right, :] slicing and .shape
+    pad, dim, hshift, vshift: the cutoutgen.py loop parameters
+    skipped_cutouts: list or None; names of bubbles that leak outside are appended
+    skipped_controls: list or None; names of bubbles whose control leaks outside are appended
+    dtype: dtype of the yielded cutouts, or None to keep the resize output
+    resize_fn: callable (image, dim) -> resized image
+    control_centers, positions: see plan_cutouts; the sampled controls (e.g. from
+                                control_sampling.first_controls) and the bubbles to cut
+
+    Notes:
+    --------------
+    Skipped bubbles are also flagged in the catalog. Only the current pair of
+    cutouts is held in memory
+
+    Usage:
+    ______________
+    for record, bubble_cutout, control_cutout in iter_cutouts(catalog, final_panorama):
+        io.imsave(record.name + ".jpg", bubble_cutout)
+
+    '''
+
+    for record, bubble_borders, control_borders in plan_cutouts(catalog, panorama.shape, pad,
+                                                                hshift, vshift, skipped_cutouts,
+                                                                skipped_controls, control_centers,
+                                                                positions):
+
+        #Extract the bubble and the control from the array, and resize them
+        bubble_cutout = resize_fn(extract(panorama, bubble_borders), dim)
+        control_cutout = resize_fn(extract(panorama, control_borders), dim)
+
+        if dtype is not None:
+            bubble_cutout = convert_cutout(bubble_cutout, dtype)
+            control_cutout = convert_cutout(control_cutout, dtype)
+
+        yield (record, bubble_cutout, control_cutout)
+
+
+def iter_cutout_batches(catalog, panorama, batch_size=64, dim=(224, 224, 3), dtype=np.uint8,
+                        **kwargs):
+    '''
+    Returns:
+    ______________
+    generator of (records, bubble_batch, control_batch) tuples, where records is a
+    list of CutoutRecords and the batches are (len(records),) + dim arrays
+
+    Args:
+    --------------
+    catalog, panorama: see iter_cutouts
+    batch_size: int; maximum number of bubble/control pairs per batch
+    dim, dtype: see iter_cutouts
+    kwargs: the remaining iter_cutouts arguments
+
+    Notes:
+    --------------
+    A yielded batch is only valid until the next batch is requested, its arrays
+    are reused. Copy them to keep them
+
+    '''
+
+    bubble_batch = np.empty((batch_size,) + tuple(dim), dtype=dtype)
+    control_batch = np.empty((batch_size,) + tuple(dim), dtype=dtype)
+    records = []
+
+    for record, bubble_cutout, control_cutout in iter_cutouts(catalog, panorama, dim=dim,
+                                                              dtype=dtype, **kwargs):
+        bubble_batch[len(records)] = bubble_cutout
+        control_batch[len(records)] = control_cutout
+        records.append(record)
+
+        if len(records) == batch_size:
+            yield (records, bubble_batch, control_batch)
+            records = []
+
+    if records:
+        yield (records, bubble_batch[:len(records)], control_batch[:len(records)])
@@ -0,0 +1,247 @@
+'''
+Parallel JPEG encoding and sharded on-disk layouts for the cutouts directory.
+
+Cutouts are encoded to JPEG bytes (in worker processes when used from the
+pipeline) and written with one of three layouts:
+
+flat:   save_dir/ID.jpg, the original layout
+hashed: save_dir/ab/ID.jpg, spread over hashed subdirectories
+shards: many JPEGs appended to large save_dir/shard-00000.bin files, with an
+        offset index in save_dir/shard_index.csv
+
+Every write returns a location relative to save_dir that read_cutout resolves.
+'''
+
+import hashlib
+import os
+import threading
+
+#Layouts understood by CutoutWriter
+LAYOUTS = ('flat', 'hashed', 'shards')
+
+#Name of the offset index written next to the shard files
+SHARD_INDEX_NAME = 'shard_index.csv'
+
+
+def encode_jpeg(image):
+    '''
+    Returns:
+    ______________
+    bytes; image encoded as JPEG, identical to what skimage.io.imsave writes
+
+    Args:
+    --------------
+    image: uint8 numpy ndarray
+
+    '''
+
+    import imageio.v3 as iio
+
+    return iio.imwrite('<bytes>', image, extension='.jpg')
+
+
+def hashed_subdirectory(name, levels=1):
+    '''
+    Returns:
+    ______________
+    string; relative subdirectory for name, e.g. '3f' or '3f/a2' for levels=2
+
+    '''
+
+    digest = hashlib.md5(name.encode()).hexdigest()
+
+    return os.path.join(*[digest[2 * level:2 * level + 2] for level in range(levels)])
+
+
+def shard_location(shard_name, offset, length):
+    '''
+    Returns:
+    ______________
+    string; location of a JPEG stored in a shard, 'shard-00000.bin@offset+length'
+
+    '''
+
+    return '%s@%d+%d' % (shard_name, offset, length)
+
+
+def read_cutout_bytes(save_dir, location):
+    '''
+    Returns:
+    ______________
+    bytes; the encoded JPEG stored at location, for any of the layouts
+
+    Args:
+    --------------
+    save_dir: string; the directory the cutouts were written to
+    location: string; a location returned by CutoutWriter.write
+
+    '''
+
+    if '@' in location:
+        shard_name, span = location.rsplit('@', 1)
+        offset, length = [int(value) for value in span.split('+')]
+        with open(os.path.join(save_dir, shard_name), 'rb') as shard:
+            shard.seek(offset)
+            return shard.read(length)
+
+    with open(os.path.join(save_dir, location), 'rb') as cutout_file:
+        return cutout_file.read()
+
+
+def read_cutout(save_dir, location):
+    '''
+    Returns:
+    ______________
+    numpy ndarray; the decoded cutout stored at location
+
+    Usage:
+    ______________
+    image = read_cutout('cutouts', the_info[0]['location'])
+
+    '''
+
+    import imageio.v3 as iio
+
+    return iio.imread(read_cutout_bytes(save_dir, location), extension='.jpg')
+
+
+class CutoutWriter(object):
+    '''
+    Writes encoded cutouts to save_dir with the chosen layout. Safe to use from
+    several threads at once.
+
+    Args:
+    --------------
+    save_dir: string; output directory, created if needed
+    layout: one of LAYOUTS
+    levels: int; number of hashed subdirectory levels for the 'hashed' layout
+    shard_size: int; a new shard is started once the current one reaches this many bytes
+
+    Usage:
+    ______________
+    writer = CutoutWriter('cutouts', layout='shards')
+    location = writer.write('1G303341-007180.jpg', encode_jpeg(bubble_cutout))
+    writer.close()
+
+    '''
+
+    def __init__(self, save_dir, layout='flat', levels=1, shard_size=256 * 1024 ** 2):
+
+        if layout not in LAYOUTS:
+            raise ValueError('layout must be one of %s' % (LAYOUTS,))
+
+        self.save_dir = save_dir
+        self.layout = layout
+        self.levels = levels
+        self.shard_size = shard_size
+        self.count = 0
+        self.bytes_written = 0
+
+        self._lock = threading.Lock()
+        self._shard = None
+        self._shard_name = None
+        self._shard_number = 0
+        self._index = None
+
+        if not os.path.isdir(save_dir):
+            os.makedirs(save_dir)
+
+        if layout == 'shards':
+            #Start after any existing shards, so re-runs only ever append
+            while os.path.exists(os.path.join(save_dir, self._name_shard(self._shard_number))):
+                self._shard_number = self._shard_number + 1
+            self._index = open(os.path.join(save_dir, SHARD_INDEX_NAME), 'a')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def _name_shard(number):
+        return 'shard-%05d.bin' % number
+
+    def write(self, file_name, data):
+        '''
+        Returns:
+        ______________
+        string; location of the written file, relative to save_dir
+
+        Args:
+        --------------
+        file_name: string; file name of the cutout, e.g. 'ID.jpg'
+        data: bytes; the encoded cutout
+
+        '''
+
+        if self.layout == 'flat':
+            location = file_name
+        elif self.layout == 'hashed':
+            location = os.path.join(hashed_subdirectory(file_name, self.levels), file_name)
+        else:
+            return self._append_to_shard(file_name, data)
+
+        path = os.path.join(self.save_dir, location)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'wb') as cutout_file:
+            cutout_file.write(data)
+
+        with self._lock:
+            self.count = self.count + 1
+            self.bytes_written = self.bytes_written + len(data)
+
+        return location
+
+    def _append_to_shard(self, file_name, data):
+
+        with self._lock:
+            if self._shard is None or self._shard.tell() >= self.shard_size:
+                if self._shard is not None:
+                    self._shard.close()
+                self._shard_name = self._name_shard(self._shard_number)
+                self._shard_number = self._shard_number + 1
+                self._shard = open(os.path.join(self.save_dir, self._shard_name), 'ab')
+
+            offset = self._shard.tell()
+            self._shard.write(data)
+            location = shard_location(self._shard_name, offset, len(data))
+            self._index.write('%s,%s\n' % (file_name, location))
+
+            self.count = self.count + 1
+            self.bytes_written = self.bytes_written + len(data)
+
+        return location
+
+    def close(self):
+        '''
+        Close the open shard and the shard index
+        '''
+
+        with self._lock:
+            if self._shard is not None:
+                self._shard.close()
+                self._shard = None
+            if self._index is not None:
+                self._index.close()
+                self._index = None
+
+
+def read_shard_index(save_dir):
+    '''
+    Returns:
+    ______________
+    dict of {file_name: location} from the shard index in save_dir. Later entries
+    win, so a cutout written again resolves to its newest copy
+
+    '''
+
+    index = {}
+    with open(os.path.join(save_dir, SHARD_INDEX_NAME)) as index_file:
+        for line in index_file:
+            file_name, location = line.rstrip('\n').rsplit(',', 1)
+            index[file_name] = location
+
+    return index
@@ -1,18 +1,25 @@
 '''
 Generate bubble-centric cutouts for the neural network.
 Author: Gregory M. Nero
+
+Importing this module has no side effects and only loads numpy, so degree_to_pixel,
+dict_adjust and show_cutout_samples can be reused by other tools. The run itself
+is run_cutoutgen, or from the command line:
+
+python cutoutgen.py --data-dir ../Desktop/mapping_data --save-dir cutouts --layout hashed
 '''
 
-import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
-import collections
+import argparse
 import os
-import sys
-from skimage import io
-from skimage.transform import resize, rescale
+import pickle
+
+from coords import degrees_to_pixels, mirror_coordinates, galactic_to_equatorial
+
+#Default location of the survey tiles and bubbly.csv
+DATA_DIR = "../Desktop/mapping_data"
 
-def show_cutout_samples(cutout_dictionary, show_best, num_samples=12):
+
+def show_cutout_samples(cutout_dictionary, show_best, num_samples=12, cutout_buffer=None):
     '''
     Returns:
     -------------
@@ -24,12 +31,16 @@ def show_cutout_samples(cutout_dictionary, show_best, num_samples=12):
     show_best: bool; if True, will show assortment of high hitrate bubbles
                      if Fasle, will show random assortment of bubbles
     num_samples: int; number of samples to show. Currently fixed at 12 for convenience
+    cutout_buffer: CutoutBuffer or None; if given, the dictionary holds indices into it
+                   instead of image arrays
 
     Usage:
     -------------
     show_cutout_samples(cutout_dict, show_best=True)
 
     ''' 
+
+    import matplotlib.pyplot as plt
     
     #Initialize lists to store dictionary information
     cutout_names = []
@@ -69,7 +80,10 @@ def show_cutout_samples(cutout_dictionary, show_best, num_samples=12):
     #Plot the sample cutouts
     for sample in range(1,13):
         fig.add_subplot(3,4,sample)
-        plt.imshow(cutout_images[sample])
+        if cutout_buffer is None:
+            plt.imshow(cutout_images[sample])
+        else:
+            plt.imshow(cutout_buffer[cutout_images[sample]])
         plot_title = cutout_names[sample] + "\n" + "(hitrate = " + str(cutout_hitrates[sample]) + ")"
         plt.title(plot_title, fontsize=6)
     print("Exit figure to continue...")
@@ -95,297 +109,390 @@ def degree_to_pixel(glon, glat, reff, array):
 
     '''
 
-    #Make sure input is good
-    if glon < 0 or glon > 360:
-        print('arg error: glon is out of acceptable range')
-    if glat < -1 or glat > 1:
-        print('arg error: glat is out of acceptable range')
-    if reff < 0:
-        print('arg error: radius must be positive')
-
-    #Regulate glon input to make the spherical wraparound less annoying
-    if glon <= 360 and glon >= 295.5:
-        glon = glon - 360
-
-    #Get array shape
-    rows = array.shape[0]
-    cols = array.shape[1]
-
-    #Set up the degree range for glon and glat based on the array shape
-    glat_range = np.linspace(1,-1,rows)
-    glon_range = np.linspace(64.5, -64.5, cols)
-
-    #Get the index based on closes value
-    glat_idx = (np.abs(glat_range - glat)).argmin()
-    glon_idx = (np.abs(glon_range - glon)).argmin()
-
-    #Get the effective pixel radius
-    radius_in_pixels = int(reff * 3000)
+    #Use the closed form batch conversion on a single bubble. It also checks the input
+    glon_idx, glat_idx, radius_in_pixels = (int(value[0]) for value in
+                                            degrees_to_pixels([glon], [glat], [reff], array))
 
     return (glon_idx, glat_idx, radius_in_pixels)
 
 
-def dict_adjust(original_bubble_dict, dict_with_cutouts):
+def dict_adjust(original_bubble_dict, dict_with_cutouts, keep_control_metadata=False):
     '''
     Returns:
     ______________
-    dictionary with form: {ID: bubble_cutout, glon, glat, r_eff, hitrate, ra, dec} or
-                          {ID_control: control_cutout, X, X, X, X, X, X} 
+    dictionary with form: {ID: (bubble_cutout, (glon, glat, r_eff, hitrate, ra, dec))} or
+                          {ID_control: (control_cutout, (0, 0, 0, 0, 0, 0))}
     [0]image_array
-    [1]glon: degrees
-    [2]glat: degrees
-    [3]r_eff: degrees
-    [4]hitrate: unitless
-    [5]ra: degrees
-    [6]dec: degrees    
-    
-    Note: for control cutouts, the metadata is represented by placeholder X's (str)
-          intend to add meaningful metadata later 
- 
+    [1][0]glon: degrees
+    [1][1]glat: degrees
+    [1][2]r_eff: degrees
+    [1][3]hitrate: unitless
+    [1][4]ra: degrees
+    [1][5]dec: degrees
+
+    Note: by default the control metadata is represented by placeholder zeros.
+          With keep_control_metadata, controls get the glon/glat of their center
+          (the fifth entry of a control value, else the mirrored glon/glat) and the
+          matching ra/dec, the bubble's r_eff and a hitrate of 0, and both bubbles
+          and controls get two extra entries:
+    [1][6]center: (x, y) pixel tuple
+    [1][7]radius: pixels
+
     Args:
     --------------
     original_bubble_dict: dict, the original dictionary of bubble:numerics data
-    dict_with_cutouts: dict, the cutout/control dictionary with other metadata  
+    dict_with_cutouts: dict, the cutout/control dictionary with other metadata
+    keep_control_metadata: bool, if True, keep real control metadata instead of zeros
+
+    Notes:
+    --------------
+    The IDs are matched with dictionary lookups, so this runs in linear time. The
+    image arrays are referenced, not copied
 
     Usage:
     ______________
     new_adjusted_dictionary = dict_adjust(bubble_dict, cutout_dict)
 
     '''
-    
+
+    #Position of each name, used when a bubble and its control are in the same dict
+    positions = dict((name, i) for i, name in enumerate(dict_with_cutouts))
+
     #Initialize the new dictionary to return later
     new_dict = {}
-    
-    #Loop through the two dictionaries to match IDs and consolidate meaningful metadata
+
+    #Look up each ID and its control, and consolidate meaningful metadata
     for name1, value1 in original_bubble_dict.items():
-        for name2, value2 in dict_with_cutouts.items():
-            #This if catches the bubble cutouts
-            if name1 == name2:
+        control_name = name1 + "_control"
+        bubble_position = positions.get(name1)
+        control_position = positions.get(control_name)
+
+        #This if catches the bubble cutouts
+        if bubble_position is not None and (control_position is None or
+                                             bubble_position < control_position):
+            value2 = dict_with_cutouts[name1]
+            if keep_control_metadata:
+                new_dict[name1] = (value2[0], tuple(value1) + (value2[3], value2[1]))
+            else:
                 new_dict[name1] = (value2[0], value1)
-                break 
-            #This elif catches the control cutouts
-            elif (name1 + "_control") == name2:
-                new_dict[name1 + "_control"] = (value2[0], (0, 0, 0, 0, 0, 0))
-                break
+        #This elif catches the control cutouts
+        elif control_position is not None:
+            value2 = dict_with_cutouts[control_name]
+            if keep_control_metadata:
+                if len(value2) > 4:
+                    glon, glat = value2[4]
+                else:
+                    glon, glat = mirror_coordinates(value1[0], value1[1])
+                ra, dec = galactic_to_equatorial(glon, glat)
+                new_dict[control_name] = (value2[0], (float(glon), float(glat), value1[2], 0,
+                                                      float(ra), float(dec), value2[3], value2[1]))
             else:
-                continue
+                new_dict[control_name] = (value2[0], (0, 0, 0, 0, 0, 0))
 
     return new_dict
 
 
 def merge_dicts(dict1, dict2):
-    
-    merged_dict = {}
-
-    for name_1, value_1 in dict1.items():
-        merged_dict[name_1] = value_1
 
-    for name_2, value_2 in dict2.items():
-        merged_dict[name_2] = value_2
+    merged_dict = dict(dict1)
+    merged_dict.update(dict2)
 
     return merged_dict
 
 
+def join_cutouts(catalog, saved_cutouts, keep_control_metadata=False):
+    '''
+    Returns:
+    ______________
+    (cutout_dict, control_dict, big_dict); the cutout/control dicts of the saved
+    pairs and their join with the catalog numerics, see dict_adjust
 
-#Read in the bubble csv with pandas and then convert to a numpy array
-bubble_data = (pd.read_csv("../Desktop/mapping_data/bubbly.csv")).values
-
-#Create an array of the bubble IDs (columnated)
-IDs = bubble_data[:,0].reshape((3744,1))
-
-#Create an array with the quantitative bubble info (columnated)
-'''Current numerics:
-   [0]galactic longitude (degrees)
-   [1]galactic latitude  (degrees)
-   [2]effective radius   (degrees)
-   [3]hitrate            (unitless)
-   [4]ra                 (degrees)
-   [5]dec                (degrees)
-'''
-bubble_numerics = (np.vstack((bubble_data[:,1], bubble_data[:,2],
-                              bubble_data[:,3]/60, bubble_data[:,4],
-                              bubble_data[:,5], bubble_data[:,6]))).T
-
-#Initialize a dictionary to store the bubble data
-bubble_dict = {}
-
-#Fill the bubble dictionary with the IDs as keys and numerics as values
-for i in range(0,3744):
-    bubble_dict[IDs[i,0]] = (bubble_numerics[i,0], bubble_numerics[i,1],
-                             bubble_numerics[i,2], bubble_numerics[i,3],
-                             bubble_numerics[i,4], bubble_numerics[i,5])
-
-if not 'image_dict' in globals():
-    #Initialize an ordered dictionary to store image (name:array) pairs
-    image_dict = collections.OrderedDict()
-
-    #Load the sorted image names and arrays into the dictionary
-    for file in sorted(os.listdir("../Desktop/mapping_data")):
-        if file.endswith(".jpg"):
-            with open(os.path.join("../Desktop/mapping_data", file), 'rb') as myfile:
-                image_dict[file] = io.imread(myfile.name)
-                print("Status: Loaded image %s" %file)
-
-if not 'final_panorama' in globals():
-    #Initialize a list to store all of the image arrays from image_dict
-    image_list_unordered = []
-    
-    #Fill the list with the arrays
-    for array_value in image_dict.values():
-        image_list_unordered.append(array_value)
-    
-    #Split this list into the northgrid/southgrid lists
-    northgrid_list = image_list_unordered[0:22][::-1]
-    southgrid_list = image_list_unordered[22:43][::-1]
-    
-    
-    #Construct the spatially oriented northgrid and southgrid arrays
-    northgrid = np.concatenate(northgrid_list, axis=1)
-    print("Status: northgrid created.")
-    southgrid = np.concatenate(southgrid_list, axis=1)
-    print("Status: southgrid created.")
-    
-    #Construct the final array of concatenated spatially arranged images
-    final_panorama = np.concatenate((northgrid,southgrid), axis=1)
-    print("Status: final image created.")
-
-
-#Initialize dictionary to store same bubble IDs with their new converted values
-converted_bubble_dict = {}
-
-#Fill the dictionary with the converted values using degree_to_pixel
-#Also add the numeric bubble values that don't need to be converted (currently only hitrate)
-'''Dictionary has form:
-   ID: ((glon_idx, glat_idx, radius_in_pixels), hitrate)
-'''
-for bubblename, numeric_tuple in bubble_dict.items():
-    converted_bubble_dict[bubblename] = (degree_to_pixel(numeric_tuple[0], numeric_tuple[1],
-                                                        numeric_tuple[2], final_panorama),
-                                                        numeric_tuple[3])
-
-'''Initialize dictionaries for storing the cutouts
->cutout_dict contains clean, valid bubbles with no boundary errors
->control_dict contains clean, valid control samples that coorespond to each bubble's mirror location
-'''
-cutout_dict = {}
-control_dict = {}
-
-'''Initialize lists to store names (only) of the skipped bubbles
->skipped_cutouts stores the names of the cutouts that were skipped
->skipped_controls stores the names of the controls that were skipped
-'''
-skipped_cutouts = []
-skipped_controls = []
-
-#Loop parameters
-pad = 50
-dim = (224,224,3)
-vshift = 0 #Also consider shifting relative to radius in loop!!!!!!
-hshift = 0 #Consider radius thing again
-
-#Loop to create the cutouts, control cutouts, and trash
-for name,value in converted_bubble_dict.items():
-
-    #Get values from converted_bubble_dict
-    bubble_center = (value[0][0], value[0][1])
-    radius = value[0][2]
-    hitrate = value[1]
-    
-    #Get the center for each control, which is the mirror location of the bubble
-    control_center = ((386999 - bubble_center[0]), (5999 - bubble_center[1])) 
-
-    #Establish crop borders for the bubble
-    bubble_left = bubble_center[0] - (radius + pad) + hshift
-    bubble_right = bubble_center[0] + (radius + pad) + hshift
-    bubble_top = (bubble_center[1] - (radius + pad)) + vshift
-    bubble_bot = (bubble_center[1] + (radius + pad)) + vshift
-
-    #Skip bubbles that leak outside of meaningful array range
-    if bubble_top < 0 or bubble_bot > 5999 or bubble_left < 0 or bubble_right > 386999:
-       skipped_cutouts.append(name)
-       continue 
-   
-    #Establish crop borders for the control
-    control_left = control_center[0] - (radius + pad) + hshift
-    control_right = control_center[0] + (radius + pad) + hshift
-    control_top = (control_center[1] - (radius + pad)) + vshift
-    control_bot = (control_center[1] + (radius + pad)) + vshift
-
-    #Skip controls that leak outside of meaningful array range
-    if control_top < 0 or control_bot > 5999 or control_left < 0 or control_right > 386999:
-       skipped_controls.append(name)
-       continue 
-
-    #Extract the bubble from the array
-    extracted_bubble = final_panorama[bubble_top:bubble_bot,bubble_left:bubble_right,:]
-
-    #Extract the control from the array
-    extracted_control = final_panorama[control_top:control_bot,control_left:control_right,:]
-
-    #Make the resized cutout of the bubble
-    bubble_cutout = resize(extracted_bubble, dim)
+    Args:
+    --------------
+    catalog: the converted BubbleCatalog the cutouts were made from
+    saved_cutouts: list of (CutoutRecord, bubble_location, control_location), in
+                   catalog order, as returned by run_cutout_pipeline
+    keep_control_metadata: bool; see dict_adjust
 
-    #Make the resized cutout of the control
-    control_cutout = resize(extracted_control, dim)
+    '''
 
-    #Fill the cutout dictionary 
-    cutout_dict[name] = (bubble_cutout, radius, hitrate, bubble_center)
+    '''Initialize dictionaries for storing the cutouts
+    >cutout_dict contains clean, valid bubbles with no boundary errors
+    >control_dict contains clean, valid control samples that coorespond to each bubble's mirror location,
+     or to a sampled region free of bubbles when the mirror location overlaps one
+    '''
+    cutout_dict = {}
+    control_dict = {}
 
-    #Fill the control dictionary
-    control_name = name + "_control"
-    control_dict[control_name] = (control_cutout, radius, hitrate, control_center)
+    #Fill the cutout/control dictionaries with the saved locations, relative to save_dir
+    for record, bubble_location, control_location in saved_cutouts:
+        cutout_dict[record.name] = (bubble_location, record.radius, record.hitrate,
+                                    record.bubble_center)
 
+        control_name = record.name + "_control"
+        control_dict[control_name] = (control_location, record.radius, record.hitrate,
+                                      record.control_center, record.control_coordinates)
 
-#Prepare the bubble/control cutout dicts for merging
-prepared_cutout_dict = dict_adjust(bubble_dict, cutout_dict)
-prepared_control_dict = dict_adjust(bubble_dict, control_dict)
+    #dict_adjust matches against the {ID: (glon, glat, reff, hitrate, ra, dec)} form
+    bubble_dict = dict((name, catalog.numerics(i)) for i, name in enumerate(catalog.ids))
 
-#Merge the prepared bubble/control cutout dicts
-big_dict = merge_dicts(prepared_cutout_dict, prepared_control_dict)
+    #Prepare the bubble/control cutout dicts for merging
+    prepared_cutout_dict = dict_adjust(bubble_dict, cutout_dict, keep_control_metadata)
+    prepared_control_dict = dict_adjust(bubble_dict, control_dict, keep_control_metadata)
 
+    #Merge the prepared bubble/control cutout dicts
+    big_dict = merge_dicts(prepared_cutout_dict, prepared_control_dict)
 
-the_info = []
+    return (cutout_dict, control_dict, big_dict)
 
 
-#Tell what directory to save cutouts to
-save_dir = 'cutouts'
+def describe_cutouts(big_dict, save_dir):
+    '''
+    Returns:
+    ______________
+    list of {'location', 'radec', 'meta': {'hitrate', 'is_bubble'}} dicts, one per
+    cutout of big_dict, as pickled to gregs_data.pck
 
-#Save cutouts to save_dir
-image_counter = 0
-for imagename, imageinfo in big_dict.items():
-    image_array = imageinfo[0]
-    final_name = imagename + ".jpg"
-    hitrate = imageinfo[1][3]
-    ra = imageinfo[1][4]
-    dec = imageinfo[1][5]
+    '''
 
-    #A binary identifier for bubble/not bubble to allow NN search in tsne
-    if "control" in final_name:
-        is_bubble = 0 #it isn't a bubble
-    else:
-        is_bubble = 1 #it is a bubble
+    the_info = []
 
+    for imagename, imageinfo in big_dict.items():
+        final_name = imagename + ".jpg"
+        hitrate = imageinfo[1][3]
+        ra = imageinfo[1][4]
+        dec = imageinfo[1][5]
 
-    location = '/Users/gnero/mapping/cutouts/' + final_name
+        #A binary identifier for bubble/not bubble to allow NN search in tsne
+        if "control" in final_name:
+            is_bubble = 0 #it isn't a bubble
+        else:
+            is_bubble = 1 #it is a bubble
 
-    tempdict = {'location': location, 'radec' : (ra,dec), 'meta' : {'hitrate': str(hitrate),
-                                                                    'is_bubble': str(is_bubble)}}
-    the_info.append(tempdict)
-    
+        location = os.path.join(save_dir, imageinfo[0])
 
-    io.imsave(os.path.join(save_dir, final_name), image_array)
-    image_counter = image_counter + 1
-print("Saved {} images!".format(image_counter))
+        tempdict = {'location': location, 'radec' : (ra,dec), 'meta' : {'hitrate': str(hitrate),
+                                                                        'is_bubble': str(is_bubble)}}
+        the_info.append(tempdict)
 
+    return the_info
 
-import pickle
 
-with open('gregs_data.pck', 'wb') as fp:
-    pickle.dump(the_info, fp, pickle.HIGHEST_PROTOCOL)
+def run_cutoutgen(data_dir=DATA_DIR, save_dir='cutouts', dataset_dir='dataset', pad=50,
+                  dim=(224, 224, 3), hshift=0, vshift=0, controls_per_bubble=1,
+                  control_candidates=8, control_seed=0, read_workers=2, resize_workers=None,
+                  encode_workers=None, write_workers=4, queue_size=16, layout='flat',
+                  use_pyramid=True, keep_control_metadata=False, pickle_path='gregs_data.pck',
+                  report_path='run_report.json', profile=False, trace_memory=False,
+                  catalog_path=None, pyramid=None, resize_kernel='skimage', controls=None,
+                  stage_peak_rss=False):
+    '''
+    Returns:
+    ______________
+    dict with the products of the run: 'saved_cutouts' (from run_cutout_pipeline),
+    'cutout_dict', 'control_dict', 'big_dict', 'the_info', 'skipped_cutouts',
+    'skipped_controls' and 'pyramid'
 
+    Args:
+    --------------
+    data_dir: string; directory containing the survey tiles and bubbly.csv
+    save_dir: string; directory the cutout JPEGs are written to
+    dataset_dir: string; directory of the memory-mapped training dataset
+    pad, dim, hshift, vshift: loop parameters; pixels added to the radius, cutout
+                              shape, and shift of the crop
+    controls_per_bubble, control_candidates, control_seed: see control_sampling.sample_controls
+    read_workers, resize_workers, encode_workers, write_workers, queue_size: pipeline
+        workers per stage and the capacity of the queues between them
+    layout: string; output layout of save_dir, one of cutout_writer.LAYOUTS
+    use_pyramid: bool; if True, crops are read from the pyramid level closest to dim
+    keep_control_metadata: bool; see dict_adjust
+    pickle_path: string; where the cutout descriptions are pickled
+    report_path: string; where the instrumentation run report is written
+    profile, trace_memory: bool; add cProfile/tracemalloc results to the report
+    catalog_path: string; bubble csv, defaults to data_dir/bubbly.csv
+    pyramid: PanoramaPyramid or None; an already open pyramid, e.g. from the last
+             run in an interactive session, so it is not opened again
+    resize_kernel: string; one of resize_kernel.RESIZE_KERNELS, see run_cutout_pipeline
+    controls: numpy array of control_sampling.CONTROL_DTYPE or None; controls to use
+              instead of sampling them, e.g. the controls of a shard plan
+              (sharding.shard_controls)
+    stage_peak_rss: bool; report the peak RSS during every stage instead of the peak
+                    so far, by resetting the high-water mark of this process (see
+                    instrumentation.Instrumentation)
 
+    Usage:
+    ______________
+    results = run_cutoutgen("../Desktop/mapping_data", layout='hashed')
 
+    '''
 
+    from catalog import BubbleCatalog
+    from control_sampling import first_controls, sample_controls
+    from cutout_pipeline import run_cutout_pipeline
+    from dataset import write_metadata
+    from instrumentation import Instrumentation
+    from manifest import CutoutManifest
+    from panorama_cache import (build_panorama_cache, open_panorama_cache, read_cache_header,
+                                tile_checksums)
+    from pyramid import PanoramaPyramid
+
+    if catalog_path is None:
+        catalog_path = os.path.join(data_dir, 'bubbly.csv')
+
+    #Wall/CPU time, peak RSS, bytes and items of every stage, and the slowest bubbles,
+    #written to report_path at the end. profile/trace_memory add cProfile/tracemalloc results
+    instrumentation = Instrumentation(profile=profile, trace_memory=trace_memory,
+                                      stage_peak_rss=stage_peak_rss)
+
+    #Read in the bubble csv as a columnar catalog
+    #Fields: id, glon, glat, reff (degrees), hitrate, ra, dec, x, y, r, flags
+    with instrumentation.stage('catalog') as stage:
+        catalog = BubbleCatalog.from_csv(catalog_path)
+        stage['items'] = len(catalog)
+
+    if pyramid is None:
+        #Memory-map the stitched panorama and its power-of-two pyramid. The tiles are only
+        #decoded and stitched on the first run, or when the source JPEGs change, using
+        #load_workers processes, so stitch takes no time when the cache is current
+        load_workers = os.cpu_count()
+        with instrumentation.stage('load'):
+            try:
+                panorama = open_panorama_cache(data_dir, rebuild=False)
+            except IOError:
+                panorama = None
+        with instrumentation.stage('stitch') as stage:
+            if panorama is None:
+                panorama = build_panorama_cache(data_dir, workers=load_workers)
+                stage['items'] = len(read_cache_header(panorama.filename)['tiles'])
+        with instrumentation.stage('pyramid') as stage:
+            pyramid = PanoramaPyramid(data_dir, workers=load_workers, panorama=panorama)
+            stage['items'] = len(pyramid)
+        print("Status: final image created.")
+    final_panorama = pyramid[0]
+
+
+    #Fill the x, y, r pixel fields of the catalog using the batch degrees_to_pixels
+    with instrumentation.stage('convert', items=len(catalog)):
+        catalog.convert(final_panorama)
+
+    '''Initialize lists to store names (only) of the skipped bubbles
+    >skipped_cutouts stores the names of the cutouts that were skipped
+    >skipped_controls stores the names of the controls that were skipped
+    '''
+    skipped_cutouts = []
+    skipped_controls = []
+
+    #Control sampling: the mirror location is kept when its cutout is free of bubbles,
+    #otherwise the first of control_candidates random regions that is free of bubbles
+    with instrumentation.stage('controls') as stage:
+        if controls is None:
+            controls = sample_controls(catalog, final_panorama.shape, count=controls_per_bubble,
+                                       pad=pad, hshift=hshift, vshift=vshift,
+                                       candidates=control_candidates, seed=control_seed)
+        stage['items'] = len(controls)
+
+    #Only regenerate cutouts whose inputs (catalog row, parameters, source tiles) changed
+    manifest = CutoutManifest(save_dir)
+    tiles = tile_checksums(data_dir)
+
+    #Read, resize and save the cutouts and control cutouts in overlapping pipeline stages
+    with instrumentation.stage('cutouts') as stage:
+        saved_cutouts = run_cutout_pipeline(catalog, final_panorama, save_dir, pad=pad, dim=dim,
+                                            hshift=hshift, vshift=vshift,
+                                            skipped_cutouts=skipped_cutouts,
+                                            skipped_controls=skipped_controls,
+                                            read_workers=read_workers,
+                                            resize_workers=resize_workers,
+                                            encode_workers=encode_workers,
+                                            write_workers=write_workers, layout=layout,
+                                            dataset_dir=dataset_dir, queue_size=queue_size,
+                                            manifest=manifest, tiles=tiles,
+                                            control_centers=first_controls(controls),
+                                            pyramid=pyramid if use_pyramid else None,
+                                            instrumentation=instrumentation,
+                                            resize_kernel=resize_kernel)
+        stage['items'] = 2 * len(saved_cutouts)
+    manifest.close()
+    print("Status: created %d cutouts, peak memory %.1f MB." % (
+        2 * len(saved_cutouts), instrumentation.process_peak_rss_mb()))
+
+    #Describe the dataset rows, with the JPEG locations relative to the dataset
+    with instrumentation.stage('metadata', items=2 * len(saved_cutouts)):
+        write_metadata(dataset_dir, catalog, saved_cutouts, cutout_dir=save_dir, dim=dim)
+
+    with instrumentation.stage('join', items=2 * len(saved_cutouts)):
+        cutout_dict, control_dict, big_dict = join_cutouts(catalog, saved_cutouts,
+                                                           keep_control_metadata)
+
+    #Describe the cutouts saved to save_dir
+    the_info = describe_cutouts(big_dict, save_dir)
+    print("Saved {} images!".format(len(the_info)))
+
+    #Kept for older consumers. The dataset directory is the memory-mapped replacement
+    with instrumentation.stage('save', items=len(the_info)):
+        with open(pickle_path, 'wb') as fp:
+            pickle.dump(the_info, fp, pickle.HIGHEST_PROTOCOL)
+
+    instrumentation.write(report_path)
+    print("Status: run report written to %s" % report_path)
+
+    return {'saved_cutouts': saved_cutouts, 'cutout_dict': cutout_dict,
+            'control_dict': control_dict, 'big_dict': big_dict, 'the_info': the_info,
+            'skipped_cutouts': skipped_cutouts, 'skipped_controls': skipped_controls,
+            'pyramid': pyramid}
+
+
+def main(argv=None):
+
+    from cutout_writer import LAYOUTS
+    from resize_kernel import RESIZE_KERNELS
+
+    parser = argparse.ArgumentParser(description='Generate bubble-centric cutouts for the '
+                                                 'neural network.')
+    parser.add_argument('--data-dir', default=DATA_DIR,
+                        help='directory of the survey tiles and bubbly.csv')
+    parser.add_argument('--catalog', default=None, help='bubble csv, default DATA_DIR/bubbly.csv')
+    parser.add_argument('--save-dir', default='cutouts', help='directory of the cutout JPEGs')
+    parser.add_argument('--dataset-dir', default='dataset',
+                        help='directory of the memory-mapped dataset')
+    parser.add_argument('--pickle', default='gregs_data.pck', help='cutout description pickle')
+    parser.add_argument('--report', default='run_report.json', help='JSON run report')
+    parser.add_argument('--pad', type=int, default=50)
+    parser.add_argument('--size', type=int, default=224, help='cutout rows and cols')
+    parser.add_argument('--hshift', type=int, default=0)
+    parser.add_argument('--vshift', type=int, default=0)
+    parser.add_argument('--controls-per-bubble', type=int, default=1)
+    parser.add_argument('--control-candidates', type=int, default=8)
+    parser.add_argument('--control-seed', type=int, default=0)
+    parser.add_argument('--read-workers', type=int, default=2)
+    parser.add_argument('--resize-workers', type=int, default=None)
+    parser.add_argument('--encode-workers', type=int, default=None)
+    parser.add_argument('--write-workers', type=int, default=4)
+    parser.add_argument('--layout', choices=LAYOUTS, default='flat')
+    parser.add_argument('--full-resolution', action='store_true',
+                        help='crop from level 0 instead of the matching pyramid level')
+    parser.add_argument('--keep-control-metadata', action='store_true')
+    parser.add_argument('--resize-kernel', choices=RESIZE_KERNELS, default='skimage',
+                        help='skimage reproduces earlier runs, linear and area are faster')
+    parser.add_argument('--profile', action='store_true', help='add cProfile results to the report')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='add tracemalloc results to the report')
+    parser.add_argument('--stage-peak-rss', action='store_true',
+                        help='report the peak RSS during every stage; resets the '
+                             'process-wide RSS high-water mark')
+    args = parser.parse_args(argv)
+
+    run_cutoutgen(data_dir=args.data_dir, save_dir=args.save_dir, dataset_dir=args.dataset_dir,
+                  pad=args.pad, dim=(args.size, args.size, 3), hshift=args.hshift,
+                  vshift=args.vshift, controls_per_bubble=args.controls_per_bubble,
+                  control_candidates=args.control_candidates, control_seed=args.control_seed,
+                  read_workers=args.read_workers, resize_workers=args.resize_workers,
+                  encode_workers=args.encode_workers, write_workers=args.write_workers,
+                  layout=args.layout, use_pyramid=not args.full_resolution,
+                  keep_control_metadata=args.keep_control_metadata, pickle_path=args.pickle,
+                  report_path=args.report, profile=args.profile, trace_memory=args.trace_memory,
+                  catalog_path=args.catalog, resize_kernel=args.resize_kernel,
+                  stage_peak_rss=args.stage_peak_rss)
 
 
 '''Prove mirror symmetry between bubble cutout and control
@@ -410,3 +517,7 @@ print(len(list(cutout_dict.keys())))
 print(len(list(control_dict.keys())))
 print(len(successlist))
 '''
+
+
+if __name__ == '__main__':
+    main()
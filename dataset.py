@@ -0,0 +1,334 @@
+'''
+Memory-mapped training dataset of bubble and control cutouts.
+
+A dataset directory holds:
+
+cutouts.npy:  one contiguous (N, 224, 224, 3) uint8 array of cutouts
+metadata.npy: a structured array with one row per cutout (id, is_bubble,
+              hitrate, ra, dec, glon, glat, reff, x, y, r, location)
+dataset.json: the cutout geometry and the JPEG directory, relative to the dataset
+input_hashes.json: manifest input hash of every row, for incremental runs (optional)
+rows_journal.jsonl, rows_journal.u8: the pairs an unfinished incremental run
+              has stored so far (see RowJournal), removed when it finishes
+
+Both arrays load with np.load(mmap_mode='r'), so a consumer can index single
+cutouts without decoding JPEGs or reading the whole file. Rows 0..n-1 are the
+bubbles in catalog order and rows n..2n-1 are their controls in the same order.
+'''
+
+import json
+import os
+
+import numpy as np
+
+from coords import galactic_to_equatorial
+from cutout_buffer import CutoutBuffer
+
+#File names inside a dataset directory
+DATASET_CUTOUTS = 'cutouts.npy'
+DATASET_METADATA = 'metadata.npy'
+DATASET_INFO = 'dataset.json'
+DATASET_HASHES = 'input_hashes.json'
+DATASET_JOURNAL = 'rows_journal.jsonl'
+DATASET_JOURNAL_ROWS = 'rows_journal.u8'
+
+
+def metadata_dtype(id_length, location_length):
+    '''
+    Returns:
+    ______________
+    numpy structured dtype of the dataset metadata
+
+    '''
+
+    return np.dtype([('id', 'U%d' % max(id_length, 1)),
+                     ('is_bubble', np.uint8),
+                     ('hitrate', np.float64),
+                     ('ra', np.float64),
+                     ('dec', np.float64),
+                     ('glon', np.float64),
+                     ('glat', np.float64),
+                     ('reff', np.float64),
+                     ('x', np.int64),
+                     ('y', np.int64),
+                     ('r', np.int64),
+                     ('location', 'U%d' % max(location_length, 1))])
+
+
+def create_cutout_array(dataset_dir, count, dim=(224, 224, 3), file_name=DATASET_CUTOUTS):
+    '''
+    Returns:
+    ______________
+    CutoutBuffer backed by dataset_dir/file_name, with room for count cutouts
+
+    '''
+
+    if not os.path.isdir(dataset_dir):
+        os.makedirs(dataset_dir)
+
+    return CutoutBuffer(count, dim=dim, dtype=np.uint8,
+                        path=os.path.join(dataset_dir, file_name))
+
+
+def write_metadata(dataset_dir, catalog, saved_cutouts, cutout_dir=None, dim=(224, 224, 3)):
+    '''
+    Returns:
+    ______________
+    numpy structured array; the metadata written to dataset_dir/metadata.npy
+
+    Args:
+    --------------
+    dataset_dir: string; the dataset directory
+    catalog: the converted BubbleCatalog the cutouts were made from
+    saved_cutouts: list of (CutoutRecord, bubble_location, control_location), in
+                   catalog order, as returned by run_cutout_pipeline
+    cutout_dir: string or None; the directory the JPEG locations are relative to
+    dim: tuple; shape of a single cutout
+
+    Notes:
+    --------------
+    Controls get the glon/glat of their center (the mirrored glon/glat for mirror
+    controls), the matching ra/dec and a hitrate of 0
+
+    '''
+
+    count = len(saved_cutouts)
+    records = [item[0] for item in saved_cutouts]
+    positions = np.array([record.position for record in records], dtype=np.int64)
+    bubbles = catalog.records[positions]
+
+    ids = [record.name for record in records] + [record.name + "_control" for record in records]
+    locations = ([item[1] or '' for item in saved_cutouts] +
+                 [item[2] or '' for item in saved_cutouts])
+
+    dtype = metadata_dtype(max([len(name) for name in ids] + [1]),
+                           max([len(name) for name in locations] + [1]))
+    metadata = np.zeros(2 * count, dtype=dtype)
+    metadata['id'] = ids
+    metadata['location'] = locations
+    metadata['is_bubble'][:count] = 1
+
+    #Bubble rows
+    for name in ('hitrate', 'ra', 'dec', 'glon', 'glat', 'reff'):
+        metadata[name][:count] = bubbles[name]
+    metadata['x'][:count] = [record.bubble_center[0] for record in records]
+    metadata['y'][:count] = [record.bubble_center[1] for record in records]
+    metadata['r'][:count] = [record.radius for record in records]
+
+    #Control rows, at the mirror location of each bubble or at its sampled control
+    glon = np.array([record.control_coordinates[0] for record in records], dtype=np.float64)
+    glat = np.array([record.control_coordinates[1] for record in records], dtype=np.float64)
+    ra, dec = galactic_to_equatorial(glon, glat)
+    metadata['glon'][count:] = glon
+    metadata['glat'][count:] = glat
+    metadata['ra'][count:] = ra
+    metadata['dec'][count:] = dec
+    metadata['reff'][count:] = bubbles['reff']
+    metadata['x'][count:] = [record.control_center[0] for record in records]
+    metadata['y'][count:] = [record.control_center[1] for record in records]
+    metadata['r'][count:] = [record.radius for record in records]
+
+    np.save(os.path.join(dataset_dir, DATASET_METADATA), metadata)
+
+    info = {'count': 2 * count, 'dim': list(dim), 'dtype': 'uint8',
+            'cutouts': DATASET_CUTOUTS, 'metadata': DATASET_METADATA,
+            'cutout_dir': None if cutout_dir is None else os.path.relpath(cutout_dir, dataset_dir)}
+    with open(os.path.join(dataset_dir, DATASET_INFO), 'w') as info_file:
+        json.dump(info, info_file, indent=2)
+
+    return metadata
+
+
+class CutoutDataset(object):
+    '''
+    Read-only, memory-mapped view of a dataset directory.
+
+    Args:
+    --------------
+    dataset_dir: string; a directory written by run_cutout_pipeline/write_metadata
+
+    Usage:
+    ______________
+    dataset = CutoutDataset('dataset')
+    image, meta = dataset[12]
+    image, meta = dataset.by_id('1G303341-007180_control')
+    bubbles = dataset.images[dataset.metadata['is_bubble'] == 1]
+
+    '''
+
+    def __init__(self, dataset_dir):
+
+        self.dataset_dir = dataset_dir
+
+        with open(os.path.join(dataset_dir, DATASET_INFO)) as info_file:
+            self.info = json.load(info_file)
+
+        self.images = np.load(os.path.join(dataset_dir, self.info['cutouts']), mmap_mode='r')
+        self.metadata = np.load(os.path.join(dataset_dir, self.info['metadata']), mmap_mode='r')
+        self._positions = None
+
+        if len(self.metadata) > len(self.images):
+            raise ValueError('dataset %s has more metadata rows than cutouts' % dataset_dir)
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def __getitem__(self, index):
+        '''
+        Returns:
+        ______________
+        (image, metadata) at index; both are views into the memory-mapped files
+
+        '''
+
+        return (self.images[index], self.metadata[index])
+
+    def index_of(self, cutout_id):
+        '''
+        Returns:
+        ______________
+        int; row of the cutout with the given ID. Raises KeyError if missing
+
+        '''
+
+        if self._positions is None:
+            self._positions = dict((name, i) for i, name in enumerate(self.metadata['id']))
+
+        return self._positions[cutout_id]
+
+    def by_id(self, cutout_id):
+        return self[self.index_of(cutout_id)]
+
+    def read_jpeg(self, index):
+        '''
+        Returns:
+        ______________
+        the decoded JPEG cutout at index, from the cutout directory the dataset was
+        written with. Raises IOError if no JPEGs were written
+
+        '''
+
+        from cutout_writer import read_cutout
+
+        location = str(self.metadata['location'][index])
+        if not location or self.info.get('cutout_dir') is None:
+            raise IOError('no JPEG was written for cutout %d' % index)
+
+        return read_cutout(os.path.join(self.dataset_dir, self.info['cutout_dir']), location)
+
+
+class RowJournal(object):
+    '''
+    The cutout pairs an incremental run has stored in its dataset so far.
+
+    An incremental run only replaces cutouts.npy and input_hashes.json when it
+    finishes. Every pair it stores is also appended to the journal, the pixels to
+    DATASET_JOURNAL_ROWS and then a line with the name, input hashes and offset to
+    DATASET_JOURNAL, both flushed at once. A run that was interrupted takes the
+    pairs from the journal instead of generating them again, like the manifest
+    journal does for the JPEGs. The journal is removed when the run finishes.
+
+    Args:
+    --------------
+    dataset_dir: string; the dataset directory
+    dim: tuple; shape of a single cutout
+
+    Usage:
+    ______________
+    journal = RowJournal('dataset', (224, 224, 3))
+    journal.append('ID', bubble_hash, control_hash, bubble_cutout, control_cutout)
+    bubble_cutout, control_cutout = journal.pair('ID', bubble_hash, control_hash)
+    journal.remove()
+
+    '''
+
+    def __init__(self, dataset_dir, dim):
+
+        self.dim = tuple(dim)
+        self.pair_bytes = 2 * int(np.prod(self.dim))
+        self.path = os.path.join(dataset_dir, DATASET_JOURNAL)
+        self.rows_path = os.path.join(dataset_dir, DATASET_JOURNAL_ROWS)
+        self.entries = {}
+
+        if not os.path.isdir(dataset_dir):
+            os.makedirs(dataset_dir)
+        self._size = os.path.getsize(self.rows_path) if os.path.exists(self.rows_path) else 0
+
+        if os.path.exists(self.path):
+            with open(self.path) as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        #A line cut short by an interruption
+                        continue
+                    if entry['offset'] + self.pair_bytes <= self._size:
+                        self.entries[entry['name']] = entry
+
+        self._rows = open(self.rows_path, 'ab')
+        self._journal = open(self.path, 'a')
+
+    def __len__(self):
+        return len(self.entries)
+
+    def has(self, name, bubble_hash, control_hash):
+        '''
+        Returns:
+        ______________
+        bool; True if the pair of name was stored from inputs with these hashes
+
+        '''
+
+        entry = self.entries.get(name)
+
+        return (entry is not None and entry['bubble_hash'] == bubble_hash and
+                entry['control_hash'] == control_hash)
+
+    def pair(self, name, bubble_hash, control_hash):
+        '''
+        Returns:
+        ______________
+        (bubble_cutout, control_cutout) uint8 arrays of name, or None if the
+        journal has no pair of name with these hashes
+
+        '''
+
+        if not self.has(name, bubble_hash, control_hash):
+            return None
+
+        with open(self.rows_path, 'rb') as rows:
+            rows.seek(self.entries[name]['offset'])
+            pair = np.frombuffer(rows.read(self.pair_bytes), dtype=np.uint8)
+
+        return tuple(pair.reshape((2,) + self.dim))
+
+    def append(self, name, bubble_hash, control_hash, bubble_cutout, control_cutout):
+        '''
+        Store the pair of name, made from inputs with bubble_hash and control_hash
+        '''
+
+        entry = {'name': name, 'bubble_hash': bubble_hash, 'control_hash': control_hash,
+                 'offset': self._size}
+        for cutout in (bubble_cutout, control_cutout):
+            self._rows.write(np.ascontiguousarray(cutout, dtype=np.uint8).tobytes())
+        self._rows.flush()
+        self._size = self._size + self.pair_bytes
+
+        self.entries[name] = entry
+        self._journal.write(json.dumps(entry) + '\n')
+        self._journal.flush()
+
+    def close(self):
+        self._rows.close()
+        self._journal.close()
+
+    def remove(self):
+        '''
+        Close the journal and delete its files, once the run it belongs to finished
+        '''
+
+        self.close()
+        self.entries = {}
+        for path in (self.path, self.rows_path):
+            if os.path.exists(path):
+                os.remove(path)
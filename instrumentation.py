@@ -0,0 +1,357 @@
+'''
+Stage-level instrumentation of production runs.
+
+An Instrumentation object times the stages of a run (load, conversion, cutouts,
+save, ...) and collects, for every stage: wall and CPU time (including reaped
+worker processes), the peak RSS so far or during the stage (see Instrumentation), the
+bytes the OS read and wrote for the process, items processed, and the slowest
+individual items, e.g. the resizes of huge radius bubbles. cProfile and
+tracemalloc capture are optional. Everything is written as one JSON run report:
+
+instrumentation = Instrumentation(profile=True)
+with instrumentation.stage('convert', items=len(catalog)):
+    catalog.convert(final_panorama)
+instrumentation.item('resize', seconds, name, radius=radius)
+instrumentation.write('run_report.json')
+'''
+
+import contextlib
+import heapq
+import io
+import json
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+
+from cutout_buffer import peak_rss_mb
+
+#Counters of /proc/self/io reported per stage. read_bytes/write_bytes reach the
+#storage, rchar/wchar include reads served from the page cache
+IO_COUNTERS = ('read_bytes', 'write_bytes', 'rchar', 'wchar')
+
+
+def io_counters():
+    '''
+    Returns:
+    ______________
+    dict of IO_COUNTERS of this process, empty where /proc/self/io is not available
+    '''
+
+    try:
+        with open('/proc/self/io') as io_file:
+            values = dict(line.split(':') for line in io_file if ':' in line)
+    except (OSError, ValueError):
+        return {}
+
+    return dict((name, int(values[name])) for name in IO_COUNTERS if name in values)
+
+
+def rss_high_water_mb():
+    '''
+    Returns:
+    ______________
+    float or None; VmHWM of this process, its peak resident set size since it
+    started or since the last reset_rss_high_water. None where /proc/self/status
+    is not available. Unit: megabytes
+    '''
+
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except (OSError, ValueError, IndexError):
+        return None
+
+    return None
+
+
+def reset_rss_high_water():
+    '''
+    Returns:
+    ______________
+    bool; True if VmHWM (and with it ru_maxrss) was reset to the current RSS
+    through /proc/self/clear_refs (Linux 4.0 and later). The mark belongs to
+    the process: anything else in it that reads VmHWM or ru_maxrss loses its peak
+    '''
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        return False
+
+    return rss_high_water_mb() is not None
+
+
+def cpu_seconds():
+    '''
+    Returns:
+    ______________
+    (self, children) user + system CPU seconds. Worker processes only count once
+    they have exited (e.g. when their pool is shut down)
+    '''
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return (own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime)
+
+
+def children_peak_rss_mb():
+    '''
+    Returns:
+    ______________
+    float; peak resident set size of the largest exited child process. Unit: megabytes
+    '''
+
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    return peak / 1024.0 ** 2 if sys.platform == 'darwin' else peak / 1024.0
+
+
+class Instrumentation(object):
+    '''
+    Collects stage and item measurements of one run.
+
+    Args:
+    --------------
+    profile: bool; if True, the stages run under cProfile and the report lists
+             the functions with the most cumulative time (the main thread only)
+    trace_memory: bool; if True, tracemalloc records the peak Python allocations
+                  per stage and the report lists the top allocation sites
+    outliers: int; slowest items kept per stage
+    outlier_factor: float; items slower than this many times their stage's median
+                    are counted as outliers
+    stage_peak_rss: bool; if True, the RSS high-water mark is reset when a stage
+                    starts (see Notes)
+
+    Notes:
+    --------------
+    By default a stage reports 'cumulative_peak_rss_mb', the peak of the whole
+    process up to the end of the stage. With stage_peak_rss on Linux, the
+    high-water mark is reset when a stage starts, so 'peak_rss_mb' of a stage is
+    the peak during that stage (and the stages it encloses). The reset applies to
+    the whole process, so only use it when nothing else in the process measures
+    its own peak (VmHWM or ru_maxrss); process_peak_rss_mb still returns the peak
+    of the whole run, and the report records whether the mark was reset
+
+    '''
+
+    def __init__(self, profile=False, trace_memory=False, outliers=10, outlier_factor=5.0,
+                 stage_peak_rss=False):
+
+        self.started = time.time()
+        self.stages = []
+        self.items = {}
+        self.pipelines = {}
+        self.outliers = outliers
+        self.outlier_factor = outlier_factor
+        self.profiler = None
+        self.trace_memory = trace_memory
+        self.stage_peak_rss = stage_peak_rss
+        self.peak_rss = peak_rss_mb()
+        self._open_stages = []
+
+        if profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+        if trace_memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name, items=0):
+        '''
+        Time a block as stage name. Yields the stage dict, so the block can set
+        'items' and add counters of its own (e.g. 'bytes_written')
+        '''
+
+        stage = {'stage': name, 'items': items}
+        running = {'peak': 0.0, 'reset': self.stage_peak_rss and self._reset_peak_rss()}
+        self._open_stages.append(running)
+        io_before = io_counters()
+        cpu_before = cpu_seconds()
+        if self.trace_memory:
+            import tracemalloc
+            tracemalloc.reset_peak()
+        if self.profiler is not None:
+            self.profiler.enable()
+        start = time.perf_counter()
+
+        try:
+            yield stage
+        finally:
+            wall = time.perf_counter() - start
+            if self.profiler is not None:
+                self.profiler.disable()
+            cpu_after = cpu_seconds()
+            io_after = io_counters()
+
+            stage['wall_seconds'] = wall
+            stage['cpu_seconds'] = cpu_after[0] - cpu_before[0]
+            stage['children_cpu_seconds'] = cpu_after[1] - cpu_before[1]
+            stage['items_per_second'] = stage['items'] / wall if wall > 0 else 0.0
+            self._open_stages.remove(running)
+            if running['reset']:
+                stage['peak_rss_mb'] = max(running['peak'], rss_high_water_mb())
+            else:
+                stage['cumulative_peak_rss_mb'] = peak_rss_mb()
+            stage['children_peak_rss_mb'] = children_peak_rss_mb()
+            for counter in io_after:
+                stage['io_' + counter] = io_after[counter] - io_before.get(counter, 0)
+            if self.trace_memory:
+                import tracemalloc
+                stage['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024.0 ** 2
+            self.stages.append(stage)
+
+    def _reset_peak_rss(self):
+        '''
+        Returns:
+        ______________
+        bool; True if the RSS high-water mark was reset. The mark so far is first
+        kept for the run and for the stages that are still open
+        '''
+
+        current = rss_high_water_mb()
+        if current is None:
+            return False
+
+        self.peak_rss = max(self.peak_rss, current)
+        for running in self._open_stages:
+            running['peak'] = max(running['peak'], current)
+
+        return reset_rss_high_water()
+
+    def process_peak_rss_mb(self):
+        '''
+        Returns:
+        ______________
+        float; peak resident set size of this process since it started, across the
+        high-water mark resets of the stages. Unit: megabytes
+        '''
+
+        return max(self.peak_rss, rss_high_water_mb() or 0.0, peak_rss_mb())
+
+    def item(self, stage, seconds, label, **info):
+        '''
+        Record the duration of one item of stage, e.g. the resize of one bubble.
+        info (radius, crop shape, ...) is kept for the slowest items
+        '''
+
+        record = self.items.setdefault(stage, {'seconds': [], 'slowest': []})
+        record['seconds'].append(seconds)
+
+        entry = (seconds, len(record['seconds']), label, info)
+        if len(record['slowest']) < self.outliers:
+            heapq.heappush(record['slowest'], entry)
+        elif seconds > record['slowest'][0][0]:
+            heapq.heapreplace(record['slowest'], entry)
+
+    def pipeline(self, name, stages):
+        '''
+        Keep the throughput reports of the PipelineStage objects of a run_pipeline call
+        '''
+
+        self.pipelines[name] = [stage.report() for stage in stages]
+
+    def item_report(self):
+        '''
+        Returns:
+        ______________
+        dict of {stage: duration statistics and the slowest items}
+        '''
+
+        report = {}
+        for stage, record in self.items.items():
+            seconds = np.asarray(record['seconds'])
+            median = float(np.median(seconds))
+            report[stage] = {
+                'items': len(seconds),
+                'total_seconds': float(seconds.sum()),
+                'median_seconds': median,
+                'p95_seconds': float(np.percentile(seconds, 95)),
+                'max_seconds': float(seconds.max()),
+                'outliers': int((seconds > self.outlier_factor * median).sum()),
+                'slowest': [dict(info, label=label, seconds=duration) for duration, number, label,
+                            info in sorted(record['slowest'], reverse=True)]}
+
+        return report
+
+    def profile_report(self, top=25):
+        '''
+        Returns:
+        ______________
+        list of dicts of the top functions by cumulative time, or None without profile
+        '''
+
+        if self.profiler is None:
+            return None
+
+        import pstats
+
+        stats = pstats.Stats(self.profiler, stream=io.StringIO())
+        functions = []
+        for (path, line, function), values in stats.stats.items():
+            calls, primitive, own, cumulative = values[:4]
+            functions.append({'function': '%s:%d(%s)' % (path, line, function), 'calls': calls,
+                              'own_seconds': own, 'cumulative_seconds': cumulative})
+
+        return sorted(functions, key=lambda entry: -entry['cumulative_seconds'])[:top]
+
+    def memory_report(self, top=10):
+        '''
+        Returns:
+        ______________
+        list of dicts of the top allocation sites, or None without trace_memory
+        '''
+
+        if not self.trace_memory:
+            return None
+
+        import tracemalloc
+
+        statistics = tracemalloc.take_snapshot().statistics('lineno')[:top]
+
+        return [{'site': str(entry.traceback), 'size_mb': entry.size / 1024.0 ** 2,
+                 'blocks': entry.count} for entry in statistics]
+
+    def report(self):
+        '''
+        Returns:
+        ______________
+        dict; the run report
+        '''
+
+        return {'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'wall_seconds': time.time() - self.started,
+                'pid': os.getpid(),
+                'peak_rss_mb': self.process_peak_rss_mb(),
+                'stage_peak_rss': self.stage_peak_rss,
+                'stages': self.stages,
+                'pipelines': self.pipelines,
+                'items': self.item_report(),
+                'profile': self.profile_report(),
+                'memory': self.memory_report()}
+
+    def write(self, path):
+        '''
+        Write the JSON run report to path. With profile, the raw cProfile stats are
+        written next to it as path + '.prof' (for snakeviz, pstats, ...)
+
+        Returns:
+        ______________
+        dict; the run report
+        '''
+
+        report = self.report()
+        with open(path, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+        if self.profiler is not None:
+            self.profiler.dump_stats(path + '.prof')
+
+        return report
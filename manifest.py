@@ -0,0 +1,218 @@
+'''
+Content-hash manifest for incremental, resumable cutout generation.
+
+For every written cutout the manifest records a hash of everything the image
+depends on: the bubble ID and position, the crop borders, the pad/dim/shift
+parameters, the output layout and the checksums of the source tiles the crop
+touches. A re-run only regenerates cutouts whose hash changed or whose file is
+missing, and removes the outputs of cutouts that are no longer produced.
+
+The manifest is an append-only journal (one JSON object per line) that is
+flushed after every cutout, so an interrupted run resumes where it stopped.
+'''
+
+import hashlib
+import json
+import os
+
+#Name of the manifest journal inside the cutout directory
+MANIFEST_NAME = 'manifest.jsonl'
+
+
+def tiles_for_borders(tiles, borders):
+    '''
+    Returns:
+    ______________
+    list of the (name, left, width, checksum) tiles overlapping the columns of
+    the (left, right, top, bot) borders
+
+    '''
+
+    left, right = borders[0], borders[1]
+
+    return [tile for tile in tiles if tile[1] < right and tile[1] + tile[2] > left]
+
+
+def cutout_input_hash(name, glon, glat, reff, borders, params, tiles, source_borders=None):
+    '''
+    Returns:
+    ______________
+    string; sha1 hex digest of the inputs of one cutout
+
+    Args:
+    --------------
+    name: string; file name of the cutout
+    glon, glat, reff: the catalog values of the bubble. Unit: degrees
+    borders: (left, right, top, bot) crop borders
+    params: dict of the generation parameters (pad, dim, hshift, vshift, layout, ...)
+    tiles: list of (name, left, width, checksum) tuples from tile_checksums
+    source_borders: (left, right, top, bot) level 0 region the crop is computed
+                    from, e.g. PanoramaPyramid.source_borders_for, or None for borders
+
+    Notes:
+    --------------
+    The checksums of the tiles under source_borders are hashed: a crop read from
+    a pyramid level also depends on the level 0 columns its aligned blocks reach
+    into. hitrate, ra and dec are not part of the hash. They only end up in the
+    metadata, which is written again on every run
+
+    '''
+
+    inputs = {'name': name,
+              'bubble': [repr(float(glon)), repr(float(glat)), repr(float(reff))],
+              'borders': [int(value) for value in borders],
+              'params': params,
+              'tiles': [[tile[0], tile[3]] for tile in
+                        tiles_for_borders(tiles, source_borders or borders)]}
+
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def output_exists(save_dir, location):
+    '''
+    Returns:
+    ______________
+    bool; True if the output at location (any cutout_writer layout) is on disk
+
+    '''
+
+    if '@' in location:
+        shard_name, span = location.rsplit('@', 1)
+        offset, length = [int(value) for value in span.split('+')]
+        path = os.path.join(save_dir, shard_name)
+        return os.path.exists(path) and os.path.getsize(path) >= offset + length
+
+    return os.path.exists(os.path.join(save_dir, location))
+
+
+def remove_output(save_dir, location):
+    '''
+    Delete the output at location. Shard entries cannot be deleted from their
+    append-only shard, so they are only forgotten
+    '''
+
+    if '@' in location:
+        return
+
+    path = os.path.join(save_dir, location)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class CutoutManifest(object):
+    '''
+    The manifest of one cutout directory.
+
+    Args:
+    --------------
+    save_dir: string; the cutout directory the manifest describes
+
+    Usage:
+    ______________
+    manifest = CutoutManifest('cutouts')
+    if not manifest.is_current('ID.jpg', input_hash):
+        ...write the cutout...
+        manifest.record('ID.jpg', input_hash, location)
+
+    '''
+
+    def __init__(self, save_dir):
+
+        self.save_dir = save_dir
+        self.path = os.path.join(save_dir, MANIFEST_NAME)
+        self.entries = {}
+
+        if os.path.exists(self.path):
+            with open(self.path) as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        #A line cut short by an interruption
+                        continue
+                    if entry.get('removed'):
+                        self.entries.pop(entry['name'], None)
+                    else:
+                        self.entries[entry['name']] = entry
+
+        if not os.path.isdir(save_dir):
+            os.makedirs(save_dir)
+        self._journal = open(self.path, 'a')
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def is_current(self, name, input_hash):
+        '''
+        Returns:
+        ______________
+        bool; True if name was written from the same inputs and is still on disk
+
+        '''
+
+        entry = self.entries.get(name)
+
+        return (entry is not None and entry['hash'] == input_hash and
+                output_exists(self.save_dir, entry['location']))
+
+    def location(self, name):
+        return self.entries[name]['location']
+
+    def _append(self, entry):
+
+        self._journal.write(json.dumps(entry) + '\n')
+        self._journal.flush()
+
+    def record(self, name, input_hash, location):
+        '''
+        Remember that name was written to location from inputs with input_hash. An
+        older output at a different location is removed
+        '''
+
+        previous = self.entries.get(name)
+        if previous is not None and previous['location'] != location:
+            remove_output(self.save_dir, previous['location'])
+
+        entry = {'name': name, 'hash': input_hash, 'location': location}
+        self.entries[name] = entry
+        self._append(entry)
+
+    def remove(self, name):
+        '''
+        Delete the output of name and forget it
+        '''
+
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            remove_output(self.save_dir, entry['location'])
+            self._append({'name': name, 'removed': True})
+
+    def remove_stale(self, current_names):
+        '''
+        Returns:
+        ______________
+        int; number of outputs removed because their name is not in current_names
+
+        '''
+
+        stale = [name for name in self.entries if name not in current_names]
+        for name in stale:
+            self.remove(name)
+
+        return len(stale)
+
+    def compact(self):
+        '''
+        Rewrite the journal with one line per current entry
+        '''
+
+        self._journal.close()
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as journal:
+            for entry in self.entries.values():
+                journal.write(json.dumps(entry) + '\n')
+        os.replace(temp_path, self.path)
+        self._journal = open(self.path, 'a')
+
+    def close(self):
+        self._journal.close()
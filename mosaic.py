@@ -0,0 +1,269 @@
+'''
+Virtual tiled mosaic of the Spitzer galactic plane survey.
+
+Instead of concatenating every tile into one huge panorama array, the mosaic
+keeps the tiles on disk and only decodes the tiles touched by a slice. Decoded
+tiles are kept in a bounded LRU cache.
+'''
+
+import collections
+import os
+import threading
+
+import numpy as np
+
+#Number of tiles that make up the northgrid. The remaining tiles are the southgrid
+NORTHGRID_TILES = 22
+
+
+def ordered_tile_names(data_dir):
+    '''
+    Returns:
+    ______________
+    list of the .jpg tile names in data_dir, spatially ordered from left to right
+
+    Args:
+    --------------
+    data_dir: string; directory containing the survey tiles
+
+    Notes:
+    --------------
+    The sorted names are split into their northgrid/southgrid categories and each
+    grid is reversed so that the tiles align spatially, i.e. the same
+    [0:22][::-1] / [22:43][::-1] ordering used to build final_panorama
+
+    Usage:
+    ______________
+    names = ordered_tile_names("../Desktop/mapping_data")
+
+    '''
+
+    names = [file for file in sorted(os.listdir(data_dir)) if file.endswith(".jpg")]
+
+    northgrid_list = names[0:NORTHGRID_TILES][::-1]
+    southgrid_list = names[NORTHGRID_TILES:][::-1]
+
+    return northgrid_list + southgrid_list
+
+
+def probe_tile_shape(path):
+    '''
+    Returns:
+    ______________
+    tuple: (rows, cols, channels) of the image at path, read from the header only
+
+    Args:
+    --------------
+    path: string; path to a JPEG tile
+
+    '''
+
+    from PIL import Image
+
+    with Image.open(path) as image:
+        width, height = image.size
+        channels = len(image.getbands())
+
+    return (height, width, channels)
+
+
+def read_tile(path):
+    '''
+    Returns:
+    ______________
+    numpy ndarray of the decoded tile at path
+
+    Args:
+    --------------
+    path: string; path to a JPEG tile
+
+    '''
+
+    from skimage import io
+
+    return io.imread(path)
+
+
+class TileMosaic(object):
+    '''
+    A lazily decoded, horizontally stitched mosaic of image tiles.
+
+    Supports numpy-style [top:bot, left:right, :] slicing. Only the tiles that a
+    slice touches are decoded, and at most cache_size decoded tiles are kept.
+
+    Args:
+    --------------
+    tile_paths: list of strings; tile paths, spatially ordered from left to right
+    tile_shapes: list of (rows, cols, channels) tuples, or None to probe the headers
+    cache_size: int; maximum number of decoded tiles to keep in memory
+    loader: callable; path -> ndarray, defaults to read_tile
+    dtype: numpy dtype of the decoded tiles
+    verbose: bool; if True, print a status line for every tile decode
+
+    Usage:
+    ______________
+    final_panorama = TileMosaic.from_directory("../Desktop/mapping_data")
+    extracted = final_panorama[100:300, 5000:5200, :]
+
+    '''
+
+    def __init__(self, tile_paths, tile_shapes=None, cache_size=4, loader=read_tile,
+                 dtype=np.uint8, verbose=False):
+
+        if len(tile_paths) == 0:
+            raise ValueError('mosaic needs at least one tile')
+        if cache_size < 1:
+            raise ValueError('cache_size must be at least 1')
+
+        if tile_shapes is None:
+            tile_shapes = [probe_tile_shape(path) for path in tile_paths]
+
+        #All tiles are stacked side by side, so they must share rows and channels
+        rows = set(shape[0] for shape in tile_shapes)
+        channels = set(shape[2:] for shape in tile_shapes)
+        if len(rows) != 1 or len(channels) != 1:
+            raise ValueError('all tiles must have the same height and channels')
+
+        self.tile_paths = list(tile_paths)
+        self.tile_shapes = [tuple(shape) for shape in tile_shapes]
+        self.cache_size = cache_size
+        self.loader = loader
+        self.dtype = np.dtype(dtype)
+        self.verbose = verbose
+
+        #Column offset of the left edge of each tile, plus the total width at the end
+        widths = [shape[1] for shape in self.tile_shapes]
+        self.offsets = np.concatenate(([0], np.cumsum(widths))).astype(np.int64)
+
+        self.shape = ((rows.pop(), int(self.offsets[-1])) + channels.pop())
+
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_directory(cls, data_dir, cache_size=4, **kwargs):
+        '''
+        Returns:
+        ______________
+        TileMosaic over the .jpg tiles in data_dir, in northgrid/southgrid order
+
+        '''
+
+        paths = [os.path.join(data_dir, name) for name in ordered_tile_names(data_dir)]
+
+        return cls(paths, cache_size=cache_size, **kwargs)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def tile(self, index):
+        '''
+        Returns:
+        ______________
+        the decoded tile at position index, from the LRU cache if possible
+
+        '''
+
+        with self._lock:
+            if index in self._cache:
+                self._cache.move_to_end(index)
+                return self._cache[index]
+
+        array = self.loader(self.tile_paths[index])
+        #Decodes repeat on cache misses, so only report them when asked to
+        if self.verbose:
+            print("Status: Loaded image %s" % os.path.basename(self.tile_paths[index]))
+        if array.shape != self.tile_shapes[index]:
+            raise ValueError('tile %s has shape %s, expected %s'
+                             % (self.tile_paths[index], array.shape, self.tile_shapes[index]))
+
+        with self._lock:
+            self._cache[index] = array
+            self._cache.move_to_end(index)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        return array
+
+    def tiles_for_columns(self, left, right):
+        '''
+        Returns:
+        ______________
+        range of the tile positions overlapping the columns [left, right)
+
+        '''
+
+        if right <= left:
+            return range(0)
+
+        first = int(np.searchsorted(self.offsets, left, side='right')) - 1
+        last = int(np.searchsorted(self.offsets, right, side='left'))
+
+        return range(max(first, 0), min(last, len(self.tile_paths)))
+
+    def __getitem__(self, key):
+
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > self.ndim:
+            raise IndexError('too many indices for mosaic')
+
+        row_key = key[0]
+        col_key = key[1] if len(key) > 1 else slice(None)
+        rest = key[2:]
+
+        #Integer indices are turned into length one slices and squeezed at the end
+        squeeze = []
+        if isinstance(row_key, (int, np.integer)):
+            row_key = self._int_to_slice(row_key, self.shape[0])
+            squeeze.append(0)
+        if isinstance(col_key, (int, np.integer)):
+            col_key = self._int_to_slice(col_key, self.shape[1])
+            squeeze.append(1)
+        if not isinstance(row_key, slice) or not isinstance(col_key, slice):
+            raise TypeError('mosaic only supports integer and slice indices on rows/columns')
+
+        start, stop, step = col_key.indices(self.shape[1])
+        columns = np.arange(start, stop, step)
+
+        if len(columns) == 0:
+            result = self.tile(0)[(row_key, slice(0, 0)) + rest]
+        else:
+            #Split the requested columns into runs that fall inside a single tile
+            tile_ids = np.searchsorted(self.offsets, columns, side='right') - 1
+            breaks = np.flatnonzero(np.diff(tile_ids)) + 1
+            pieces = []
+            for run in np.split(np.arange(len(columns)), breaks):
+                tile_id = tile_ids[run[0]]
+                local = columns[run] - self.offsets[tile_id]
+                if step == 1:
+                    local = slice(int(local[0]), int(local[-1]) + 1)
+                pieces.append(self.tile(tile_id)[(row_key, local) + rest])
+
+            if len(pieces) == 1:
+                result = pieces[0]
+            else:
+                result = np.concatenate(pieces, axis=1)
+
+        for axis in reversed(squeeze):
+            result = result[(slice(None),) * axis + (0,)]
+
+        return result
+
+    @staticmethod
+    def _int_to_slice(index, length):
+
+        if index < -length or index >= length:
+            raise IndexError('index %d is out of bounds for axis with size %d' % (index, length))
+        index = index % length
+
+        return slice(index, index + 1)
+
+    def __repr__(self):
+        return 'TileMosaic(shape=%s, tiles=%d, cache_size=%d)' % (self.shape,
+                                                                   len(self.tile_paths),
+                                                                   self.cache_size)
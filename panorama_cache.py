@@ -0,0 +1,363 @@
+'''
+Persistent memory-mapped cache of the stitched panorama.
+
+The first run decodes the survey tiles once and writes the stitched panorama to
+a raw uint8 file with a small JSON header describing the geometry. Later runs
+open the file with np.memmap, which takes milliseconds instead of minutes. The
+cache is rebuilt automatically when the source JPEGs change.
+'''
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+from mosaic import ordered_tile_names, probe_tile_shape, read_tile
+
+#Default name of the cache file, stored next to the source tiles
+PANORAMA_CACHE_NAME = 'final_panorama.u8'
+
+#First bytes of every cache file
+CACHE_MAGIC = b'PANOCACHE1\n'
+
+#The header is padded so the pixel data starts on a page boundary
+HEADER_SIZE = 4096
+
+
+def source_fingerprint(data_dir):
+    '''
+    Returns:
+    ______________
+    string; hex digest identifying the current set of source tiles in data_dir
+
+    Notes:
+    ______________
+    The digest covers the spatial tile order and the size and modification time
+    of every tile, so adding, removing, replacing or touching a tile changes it
+
+    '''
+
+    digest = hashlib.sha1()
+    for name in ordered_tile_names(data_dir):
+        stat = os.stat(os.path.join(data_dir, name))
+        digest.update(('%s:%d:%d\n' % (name, stat.st_size, stat.st_mtime_ns)).encode())
+
+    return digest.hexdigest()
+
+
+def read_cache_header(cache_path):
+    '''
+    Returns:
+    ______________
+    dict with the cache geometry, or None if cache_path is missing or not a cache
+
+    '''
+
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            raw = cache_file.read(HEADER_SIZE)
+    except (IOError, OSError):
+        return None
+
+    if len(raw) < HEADER_SIZE or not raw.startswith(CACHE_MAGIC):
+        return None
+
+    try:
+        header = json.loads(raw[len(CACHE_MAGIC):].rstrip(b'\0').decode())
+    except ValueError:
+        return None
+
+    #A cache whose build was interrupted is shorter than its header claims
+    expected = HEADER_SIZE + int(np.prod(header['shape'])) * np.dtype(header['dtype']).itemsize
+    if os.path.getsize(cache_path) != expected:
+        return None
+
+    return header
+
+
+def create_cache_file(path, header):
+    '''
+    Write the magic, the JSON header and room for the pixels described by the
+    header's shape and dtype to path
+    '''
+
+    raw = CACHE_MAGIC + json.dumps(header).encode()
+    if len(raw) > HEADER_SIZE:
+        raise ValueError('cache header does not fit in %d bytes' % HEADER_SIZE)
+
+    nbytes = int(np.prod(header['shape'])) * np.dtype(header['dtype']).itemsize
+    with open(path, 'wb') as cache_file:
+        cache_file.write(raw.ljust(HEADER_SIZE, b'\0'))
+        cache_file.truncate(HEADER_SIZE + nbytes)
+
+
+def _decode_into_cache(cache_path, shape, tile_path, left, width):
+    '''
+    Decode the tile at tile_path and write it into the columns [left, left + width)
+    of the cache at cache_path. Runs inside the worker processes, so only the timing
+    is sent back to the parent
+
+    Returns:
+    ______________
+    float; seconds spent decoding and writing the tile
+
+    '''
+
+    start = time.time()
+
+    tile = read_tile(tile_path)
+    expected = (shape[0], width) + tuple(shape[2:])
+    if tile.shape != expected:
+        raise ValueError('tile %s has shape %s, expected %s' % (tile_path, tile.shape, expected))
+
+    panorama = np.memmap(cache_path, dtype=np.uint8, mode='r+', offset=HEADER_SIZE, shape=shape)
+    panorama[:, left:left + width] = tile
+    panorama.flush()
+    del panorama
+
+    return time.time() - start
+
+
+def _decode_tiles(cache_path, shape, jobs, workers=None):
+    '''
+    Decode every (name, tile_path, left, width) job into its column block of the
+    cache at cache_path, using workers processes
+    '''
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(jobs)))
+
+    start = time.time()
+    if workers == 1:
+        for name, tile_path, left, width in jobs:
+            seconds = _decode_into_cache(cache_path, shape, tile_path, left, width)
+            print("Status: Loaded image %s (%.2f s)" % (name, seconds))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {}
+            for name, tile_path, left, width in jobs:
+                future = pool.submit(_decode_into_cache, cache_path, shape, tile_path, left, width)
+                futures[future] = name
+            for future in concurrent.futures.as_completed(futures):
+                print("Status: Loaded image %s (%.2f s)" % (futures[future], future.result()))
+    print("Status: Loaded %d images in %.2f s using %d workers" % (len(jobs), time.time() - start,
+                                                                   workers))
+
+
+def build_panorama_cache(data_dir, cache_path=None, workers=None):
+    '''
+    Returns:
+    ______________
+    read-only np.memmap of the stitched panorama
+
+    Args:
+    --------------
+    data_dir: string; directory containing the survey tiles
+    cache_path: string; where to write the cache, defaults to data_dir/PANORAMA_CACHE_NAME
+    workers: int; number of decoding processes, defaults to os.cpu_count()
+
+    Notes:
+    --------------
+    Each worker decodes one tile at a time and writes it straight into its column
+    block of the memmap, so no arrays are pickled back and no concatenation is
+    needed. Peak memory is about one decoded tile per worker. The file is written
+    under a temporary name and only renamed into place once complete
+
+    Usage:
+    ______________
+    final_panorama = build_panorama_cache("../Desktop/mapping_data")
+
+    '''
+
+    if cache_path is None:
+        cache_path = os.path.join(data_dir, PANORAMA_CACHE_NAME)
+
+    names = ordered_tile_names(data_dir)
+    if len(names) == 0:
+        raise ValueError('no .jpg tiles found in %s' % data_dir)
+    shapes = [probe_tile_shape(os.path.join(data_dir, name)) for name in names]
+
+    if len(set((shape[0],) + shape[2:] for shape in shapes)) != 1:
+        raise ValueError('all tiles must have the same height and channels')
+
+    widths = [shape[1] for shape in shapes]
+    shape = (shapes[0][0], sum(widths)) + shapes[0][2:]
+
+    header = {'shape': list(shape),
+              'dtype': 'uint8',
+              'tiles': names,
+              'tile_widths': widths,
+              'fingerprint': source_fingerprint(data_dir)}
+    temp_path = cache_path + '.tmp'
+    create_cache_file(temp_path, header)
+
+    #Column offset of the left edge of each tile
+    lefts = np.concatenate(([0], np.cumsum(widths)[:-1])).tolist()
+    _decode_tiles(temp_path, shape, [(name, os.path.join(data_dir, name), left, width)
+                                     for name, left, width in zip(names, lefts, widths)], workers)
+
+    os.replace(temp_path, cache_path)
+    print("Status: panorama cache written to %s" % cache_path)
+
+    return np.memmap(cache_path, dtype=np.uint8, mode='r', offset=HEADER_SIZE, shape=shape)
+
+
+def open_panorama_cache(data_dir, cache_path=None, rebuild=True, workers=None):
+    '''
+    Returns:
+    ______________
+    read-only np.memmap of the stitched panorama
+
+    Args:
+    --------------
+    data_dir: string; directory containing the survey tiles
+    cache_path: string; location of the cache, defaults to data_dir/PANORAMA_CACHE_NAME
+    rebuild: bool; if True, a missing or stale cache is (re)built
+                   if False, a missing or stale cache raises an IOError
+    workers: int; number of decoding processes used for a rebuild
+
+    Usage:
+    ______________
+    final_panorama = open_panorama_cache("../Desktop/mapping_data")
+
+    '''
+
+    if cache_path is None:
+        cache_path = os.path.join(data_dir, PANORAMA_CACHE_NAME)
+
+    header = read_cache_header(cache_path)
+
+    if header is None or header['fingerprint'] != source_fingerprint(data_dir):
+        if not rebuild:
+            raise IOError('panorama cache %s is missing or stale' % cache_path)
+        print("Status: panorama cache is missing or stale, rebuilding.")
+        return build_panorama_cache(data_dir, cache_path, workers=workers)
+
+    return np.memmap(cache_path, dtype=np.dtype(header['dtype']), mode='r',
+                     offset=HEADER_SIZE, shape=tuple(header['shape']))
+
+
+def open_partial_cache(data_dir, cache_path, tiles, names, workers=None):
+    '''
+    Returns:
+    ______________
+    (memmap, decoded); a read-only np.memmap with the geometry of the whole
+    panorama in which only the tiles in names are decoded, and the list of the
+    tiles decoded by this call (empty when the cache was reused)
+
+    Args:
+    --------------
+    data_dir: string; directory containing (at least) the tiles in names
+    cache_path: string; where to write the cache
+    tiles: list of (name, left, width, checksum) from tile_checksums, of all tiles
+    names: the tiles to decode
+    workers: int; number of decoding processes, defaults to os.cpu_count()
+
+    Notes:
+    --------------
+    The other columns read as zeros and take no disk space, as the cache is a
+    sparse file. The header records the checksums of the decoded tiles, so a
+    cache of the same tiles is reused, e.g. when a node runs its shard again.
+    Used by the nodes of a sharded run, see sharding.py
+
+    Usage:
+    ______________
+    panorama, decoded = open_partial_cache(data_dir, 'shard.u8', tiles, ['tile05.jpg'])
+
+    '''
+
+    names = set(names)
+    selected = [tile for tile in tiles if tile[0] in names]
+    if len(selected) != len(names):
+        raise ValueError('tiles %s are not in the survey' % sorted(names - set(tile[0] for
+                                                                            tile in tiles)))
+
+    tile_shape = probe_tile_shape(os.path.join(data_dir, selected[0][0]))
+    shape = (tile_shape[0], sum(tile[2] for tile in tiles)) + tile_shape[2:]
+
+    digest = hashlib.sha1()
+    for name, left, width, checksum in selected:
+        digest.update(('%s:%d:%d:%s\n' % (name, left, width, checksum)).encode())
+
+    header = read_cache_header(cache_path)
+    decoded = []
+    if (header is None or header['fingerprint'] != digest.hexdigest() or
+            tuple(header['shape']) != shape):
+        header = {'shape': list(shape),
+                  'dtype': 'uint8',
+                  'tiles': [tile[0] for tile in selected],
+                  'fingerprint': digest.hexdigest()}
+        temp_path = cache_path + '.tmp'
+        create_cache_file(temp_path, header)
+        _decode_tiles(temp_path, shape, [(name, os.path.join(data_dir, name), left, width)
+                                         for name, left, width, checksum in selected], workers)
+        os.replace(temp_path, cache_path)
+        decoded = header['tiles']
+
+    return (np.memmap(cache_path, dtype=np.uint8, mode='r', offset=HEADER_SIZE, shape=shape),
+            decoded)
+
+
+def tile_checksums(data_dir, checksum_path=None):
+    '''
+    Returns:
+    ______________
+    list of (name, left, width, checksum) tuples for the tiles in data_dir, in
+    spatial order. left is the first panorama column of the tile and checksum
+    the sha1 hex digest of the tile file
+
+    Args:
+    --------------
+    data_dir: string; directory containing the survey tiles
+    checksum_path: string; where the checksums are remembered between runs,
+                   defaults to data_dir/tile_checksums.json
+
+    Notes:
+    --------------
+    A tile is only hashed again when its size or modification time changed
+
+    '''
+
+    if checksum_path is None:
+        checksum_path = os.path.join(data_dir, 'tile_checksums.json')
+
+    try:
+        with open(checksum_path) as checksum_file:
+            known = json.load(checksum_file)
+    except (IOError, OSError, ValueError):
+        known = {}
+
+    tiles = []
+    updated = {}
+    left = 0
+    for name in ordered_tile_names(data_dir):
+        path = os.path.join(data_dir, name)
+        stat = os.stat(path)
+        key = '%d:%d' % (stat.st_size, stat.st_mtime_ns)
+
+        if name in known and known[name]['stat'] == key:
+            checksum = known[name]['sha1']
+        else:
+            digest = hashlib.sha1()
+            with open(path, 'rb') as tile_file:
+                for chunk in iter(lambda: tile_file.read(1024 ** 2), b''):
+                    digest.update(chunk)
+            checksum = digest.hexdigest()
+        updated[name] = {'stat': key, 'sha1': checksum}
+
+        width = probe_tile_shape(path)[1]
+        tiles.append((name, left, width, checksum))
+        left = left + width
+
+    if updated != known:
+        try:
+            with open(checksum_path, 'w') as checksum_file:
+                json.dump(updated, checksum_file, indent=1)
+        except (IOError, OSError):
+            pass
+
+    return tiles
@@ -0,0 +1,350 @@
+'''
+Power-of-two image pyramid over the stitched panorama.
+
+Level 0 is the panorama cache itself. Level k is a 2**k times smaller copy,
+made by averaging 2x2 blocks of level k - 1, and stored next to the cache as
+final_panorama.L<k>.u8 with the same header format, so every level opens as a
+np.memmap. The levels are rebuilt whenever the cache is.
+
+Cutouts read their crop from the smallest level that still has at least the
+target resolution, so the resize works on crops of about the same size no
+matter the bubble radius. Displays read from the level that matches the screen.
+'''
+
+import concurrent.futures
+import mmap
+import os
+import time
+
+import numpy as np
+
+from panorama_cache import (HEADER_SIZE, PANORAMA_CACHE_NAME, create_cache_file,
+                            open_panorama_cache, read_cache_header)
+
+#Levels are built until the next one would have fewer rows than this
+MIN_LEVEL_ROWS = 128
+
+#Target rows downsampled per worker task. Tasks read whole source rows, which
+#keeps the reads from the (possibly uncached) source file sequential
+LEVEL_CHUNK_ROWS = 32
+
+
+def level_path(cache_path, level):
+    '''
+    Returns:
+    ______________
+    string; file of pyramid level next to cache_path, e.g. final_panorama.L1.u8
+
+    '''
+
+    if level == 0:
+        return cache_path
+
+    root, extension = os.path.splitext(cache_path)
+
+    return '%s.L%d%s' % (root, level, extension)
+
+
+def downsample_blocks(strip):
+    '''
+    Returns:
+    ______________
+    uint16 array; the rounded average of every 2x2 block of strip, the value of
+    the next pyramid level. strip has an even number of rows and columns
+
+    '''
+
+    strip = np.asarray(strip, dtype=np.uint16)
+    block = strip[0::2, 0::2] + strip[1::2, 0::2]
+    block += strip[0::2, 1::2]
+    block += strip[1::2, 1::2]
+    block += 2
+    block //= 4
+
+    return block
+
+
+def _downsample_into_level(source_path, source_shape, target_path, target_shape, top, height):
+    '''
+    Average the 2x2 blocks of the source rows [2 * top, 2 * (top + height)) into
+    the target rows [top, top + height). Runs inside the worker processes
+
+    Returns:
+    ______________
+    float; seconds spent
+
+    '''
+
+    start = time.time()
+
+    source = np.memmap(source_path, dtype=np.uint8, mode='r', offset=HEADER_SIZE,
+                       shape=source_shape)
+    target = np.memmap(target_path, dtype=np.uint8, mode='r+', offset=HEADER_SIZE,
+                       shape=target_shape)
+
+    cols = target_shape[1]
+    target[top:top + height] = downsample_blocks(source[2 * top:2 * (top + height), :2 * cols])
+    target.flush()
+    del source, target
+
+    return time.time() - start
+
+
+def build_level(cache_path, header, level, workers=None):
+    '''
+    Returns:
+    ______________
+    read-only np.memmap of pyramid level, built from level - 1
+
+    Args:
+    --------------
+    cache_path: string; the level 0 panorama cache
+    header: dict; header of the level 0 cache
+    level: int; level to build, at least 1
+    workers: int; number of processes, defaults to os.cpu_count()
+
+    '''
+
+    source_path = level_path(cache_path, level - 1)
+    source_header = read_cache_header(source_path)
+    source_shape = tuple(source_header['shape'])
+    shape = (source_shape[0] // 2, source_shape[1] // 2) + source_shape[2:]
+
+    level_header = {'shape': list(shape),
+                    'dtype': 'uint8',
+                    'level': level,
+                    'scale': 2 ** level,
+                    'fingerprint': header['fingerprint']}
+    path = level_path(cache_path, level)
+    temp_path = path + '.tmp'
+    create_cache_file(temp_path, level_header)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    chunks = [(top, min(LEVEL_CHUNK_ROWS, shape[0] - top))
+              for top in range(0, shape[0], LEVEL_CHUNK_ROWS)]
+
+    start = time.time()
+    if workers == 1:
+        for top, height in chunks:
+            _downsample_into_level(source_path, source_shape, temp_path, shape, top, height)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_downsample_into_level, source_path, source_shape, temp_path,
+                                   shape, top, height) for top, height in chunks]
+            for future in futures:
+                future.result()
+
+    os.replace(temp_path, path)
+    print("Status: built pyramid level %d, %dx%d, in %.2f s" % (level, shape[1], shape[0],
+                                                                 time.time() - start))
+
+    return np.memmap(path, dtype=np.uint8, mode='r', offset=HEADER_SIZE, shape=shape)
+
+
+class PanoramaPyramid(object):
+    '''
+    The memory-mapped levels of the panorama pyramid.
+
+    Args:
+    --------------
+    data_dir: string; directory containing the survey tiles
+    cache_path: string; location of the level 0 cache, defaults to data_dir/PANORAMA_CACHE_NAME
+    rebuild: bool; if True, missing or stale levels are (re)built, else they raise an IOError
+    workers: int; number of processes used to build the cache and the levels
+    min_rows: int; the smallest level has at least this many rows
+    panorama: level 0 memmap already opened from cache_path (open_panorama_cache or
+              build_panorama_cache), or None to open (or build) it here
+
+    Usage:
+    ______________
+    pyramid = PanoramaPyramid("../Desktop/mapping_data")
+    level = pyramid.level_for(crop_size=1200, target_size=224)
+    crop = pyramid.extract((left, right, top, bot), level)
+    overview = pyramid[pyramid.display_level(screen_width=2000)]
+
+    '''
+
+    def __init__(self, data_dir, cache_path=None, rebuild=True, workers=None,
+                 min_rows=MIN_LEVEL_ROWS, panorama=None):
+
+        if cache_path is None:
+            cache_path = os.path.join(data_dir, PANORAMA_CACHE_NAME)
+
+        self.data_dir = data_dir
+        self.cache_path = cache_path
+        self.min_rows = min_rows
+        if panorama is None:
+            panorama = open_panorama_cache(data_dir, cache_path, rebuild=rebuild, workers=workers)
+        self.levels = [panorama]
+        header = read_cache_header(cache_path)
+
+        while self.levels[-1].shape[0] // 2 >= min_rows:
+            level = len(self.levels)
+            level_header = read_cache_header(level_path(cache_path, level))
+            if level_header is not None and level_header['fingerprint'] == header['fingerprint']:
+                self.levels.append(np.memmap(level_path(cache_path, level), dtype=np.uint8,
+                                             mode='r', offset=HEADER_SIZE,
+                                             shape=tuple(level_header['shape'])))
+                continue
+            if not rebuild:
+                raise IOError('pyramid level %d of %s is missing or stale' % (level, cache_path))
+            self.levels.append(build_level(cache_path, header, level, workers=workers))
+
+    def __len__(self):
+        return len(self.levels)
+
+    def __getitem__(self, level):
+        return self.levels[level]
+
+    @property
+    def shape(self):
+        return self.levels[0].shape
+
+    def advise_random_access(self):
+        '''
+        Tell the kernel that the levels are read at scattered places (many small
+        crops), which turns off readahead. Reading crops from a level that does
+        not fit in the page cache gets several times faster. A no-op where
+        madvise is not available
+        '''
+
+        if not hasattr(mmap, 'MADV_RANDOM'):
+            return
+
+        for level in self.levels:
+            handle = getattr(level, '_mmap', None)
+            if handle is not None:
+                handle.madvise(mmap.MADV_RANDOM)
+
+    def level_for(self, crop_size, target_size):
+        '''
+        Returns:
+        ______________
+        int; the smallest level at which a crop_size pixel crop (at level 0) still
+        has at least target_size pixels
+
+        '''
+
+        level = 0
+        while level + 1 < len(self) and crop_size // 2 ** (level + 1) >= target_size:
+            level = level + 1
+
+        return level
+
+    def display_level(self, screen_width, columns=None):
+        '''
+        Returns:
+        ______________
+        int; the smallest level that shows columns level 0 pixels (default: the
+        whole panorama) with at least screen_width pixels
+
+        '''
+
+        if columns is None:
+            columns = self.shape[1]
+
+        level = 0
+        while level + 1 < len(self) and columns // 2 ** (level + 1) >= screen_width:
+            level = level + 1
+
+        return level
+
+    def extract(self, borders, level):
+        '''
+        Returns:
+        ______________
+        the region of level 0 borders (left, right, top, bot), read from level
+
+        '''
+
+        left, right, top, bot = borders
+        scale = 2 ** level
+
+        return self.levels[level][top // scale:-(-bot // scale), left // scale:-(-right // scale), :]
+
+    def extract_for(self, borders, target_size):
+        '''
+        Returns:
+        ______________
+        the region of level 0 borders, read from the smallest level that still has
+        target_size pixels across it
+
+        '''
+
+        return self.extract(borders, self.level_for(borders[1] - borders[0], target_size))
+
+    def source_borders(self, borders, level):
+        '''
+        Returns:
+        ______________
+        tuple: (left, right, top, bot) of the level 0 region that the region of
+        level 0 borders at level is computed from: the 2**level aligned blocks
+        under it. The crop depends on every level 0 pixel in there
+
+        '''
+
+        left, right, top, bot = borders
+        scale = 2 ** level
+        rows, cols = self.shape[0] // scale, self.shape[1] // scale
+
+        return (left // scale * scale, min(-(-right // scale), cols) * scale,
+                top // scale * scale, min(-(-bot // scale), rows) * scale)
+
+    def source_borders_for(self, borders, target_size):
+        '''
+        Returns:
+        ______________
+        tuple: source_borders of the level extract_for reads borders from
+
+        '''
+
+        return self.source_borders(borders, self.level_for(borders[1] - borders[0], target_size))
+
+
+class MosaicPyramid(PanoramaPyramid):
+    '''
+    The pyramid of a TileMosaic (or any level 0 array), without level files.
+
+    A region of level k is computed from the 2**k aligned level 0 blocks under it,
+    with the same rounding as build_level, so extract returns exactly what the
+    PanoramaPyramid of the same tiles returns. Only level 0 under the regions is
+    read, e.g. on a node that only has the tiles of its shard (see sharding.py).
+    Only level 0 can be indexed directly.
+
+    Args:
+    --------------
+    mosaic: TileMosaic of the survey tiles, or the level 0 np.memmap
+    min_rows: int; the smallest level has at least this many rows
+
+    Usage:
+    ______________
+    pyramid = MosaicPyramid(TileMosaic.from_directory("../Desktop/mapping_data"))
+    crop = pyramid.extract_for((left, right, top, bot), 224)
+
+    '''
+
+    def __init__(self, mosaic, min_rows=MIN_LEVEL_ROWS):
+
+        self.data_dir = None
+        self.cache_path = None
+        self.min_rows = min_rows
+        self.levels = [mosaic]
+
+        #The same number of levels PanoramaPyramid builds for these rows
+        self.depth = 1
+        while mosaic.shape[0] // 2 ** self.depth >= min_rows:
+            self.depth = self.depth + 1
+
+    def __len__(self):
+        return self.depth
+
+    def extract(self, borders, level):
+
+        left, right, top, bot = self.source_borders(borders, level)
+        region = self.levels[0][top:bot, left:right, :]
+
+        for step in range(level):
+            region = downsample_blocks(region).astype(np.uint8)
+
+        return region
@@ -0,0 +1,717 @@
+'''
+Catalog sharding for multi-node cutout runs.
+
+The panorama is split into shards along tile boundaries, with about the same
+number of bubbles in each. A shard is a glon range together with its mirror
+range (a contiguous range of |glon|), so a bubble and its mirror control always
+fall in the same shard, and a shard owns the bubbles whose center lies in its
+columns. The controls that are sampled away from the mirror location are drawn
+inside the columns of the shard of their bubble (sample_controls with columns),
+so its node only needs its own tiles and the neighbouring tiles that the r + pad
+halo of the crops reaches into. plan_shards lists them per shard, and a node
+only decodes those tiles, into a sparse panorama cache of its own. Its pyramid
+levels are computed on the fly (MosaicPyramid), so it needs neither the other
+tiles nor the full cache and its levels.
+
+Every node writes partial outputs to its own directory: the JPEGs with their
+manifest, a partial dataset, its skip lists and a run report. merge_shards
+combines the shards in catalog order into one cutout directory, dataset and
+gregs_data.pck, identical to a single-node cutoutgen.py run with the same
+parameters and controls. Bubbles with a clean mirror location (most of them)
+get the same control as in a single-node run, the others a control from their
+own shard instead of one anywhere in the panorama (see shard_controls):
+
+python sharding.py plan --shards 4 --work-dir shards
+python sharding.py node shards/shard_plan.json 2         (on every node)
+python sharding.py merge shards/shard_plan.json
+python sharding.py local --shards 4                      (processes stand in for nodes)
+'''
+
+import argparse
+import json
+import os
+import pickle
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from cutoutgen import DATA_DIR, describe_cutouts, join_cutouts
+
+#Name of the plan in the work directory, and of the summary in every shard directory
+SHARD_PLAN = 'shard_plan.json'
+SHARD_SUMMARY = 'shard.json'
+
+
+def shard_directory(work_dir, shard):
+    '''
+    Returns:
+    ______________
+    string; the output directory of shard in work_dir, e.g. work_dir/shard-002
+
+    '''
+
+    return os.path.join(work_dir, 'shard-%03d' % shard)
+
+
+def load_plan(plan_path):
+    '''
+    Returns:
+    ______________
+    dict; the plan written by plan_shards, with 'work_dir' set to its directory
+
+    '''
+
+    with open(plan_path) as plan_file:
+        plan = json.load(plan_file)
+    plan['work_dir'] = os.path.dirname(os.path.abspath(plan_path))
+
+    return plan
+
+
+def _write_json(path, value):
+
+    #Written under a temporary name, so a reader never sees half a file
+    with open(path + '.tmp', 'w') as json_file:
+        json.dump(value, json_file, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def survey_mosaic(data_dir, tiles, shape):
+    '''
+    Returns:
+    ______________
+    TileMosaic over tiles, with their shapes given, so no tile file is opened
+    until a crop reads from it
+
+    Args:
+    --------------
+    data_dir: string; directory containing the survey tiles
+    tiles: list of (name, left, width, checksum) from tile_checksums
+    shape: panorama shape, (rows, cols, channels)
+
+    '''
+
+    from mosaic import TileMosaic
+
+    return TileMosaic([os.path.join(data_dir, tile[0]) for tile in tiles],
+                      [(shape[0], tile[2]) + tuple(shape[2:]) for tile in tiles])
+
+
+def load_catalog(catalog_path, shape):
+    '''
+    Returns:
+    ______________
+    the BubbleCatalog of catalog_path, converted to pixels of a panorama of shape
+
+    '''
+
+    from catalog import BubbleCatalog
+
+    catalog = BubbleCatalog.from_csv(catalog_path)
+    catalog.convert(tuple(shape))
+
+    return catalog
+
+
+def shard_controls(catalog, shape, params, shards):
+    '''
+    Returns:
+    ______________
+    numpy array of control_sampling.CONTROL_DTYPE; the controls of run_cutoutgen,
+    with the random candidates of every bubble drawn inside the columns of its shard
+
+    Args:
+    --------------
+    catalog: converted BubbleCatalog
+    shape: panorama shape, (rows, cols, channels)
+    params: dict; the run parameters of the plan
+    shards: list of the shard entries of the plan, with 'columns' and 'positions'
+
+    Usage:
+    ______________
+    plan = load_plan('shards/shard_plan.json')
+    controls = shard_controls(catalog, plan['shape'], plan['params'], plan['shards'])
+    results = run_cutoutgen(controls=controls)      (the single-node run of the plan)
+
+    '''
+
+    from control_sampling import sample_controls
+
+    columns = [[(0, shape[1])]] * len(catalog)
+    for entry in shards:
+        for position in entry['positions']:
+            columns[position] = [tuple(run) for run in entry['columns']]
+
+    return sample_controls(catalog, tuple(shape), count=params['controls_per_bubble'],
+                           pad=params['pad'], hshift=params['hshift'], vshift=params['vshift'],
+                           candidates=params['control_candidates'], seed=params['control_seed'],
+                           columns=columns)
+
+
+def prepare_catalog(catalog_path, shape, params, shards):
+    '''
+    Returns:
+    ______________
+    (catalog, control_centers); the converted BubbleCatalog and the control
+    centers of control_sampling.first_controls, as run_cutoutgen makes them but
+    with the controls of shard_controls
+
+    '''
+
+    from control_sampling import first_controls
+
+    catalog = load_catalog(catalog_path, shape)
+
+    return (catalog, first_controls(shard_controls(catalog, shape, params, shards)))
+
+
+def fold_tiles(count):
+    '''
+    Returns:
+    ______________
+    int array; the folded position min(i, count - 1 - i) of every tile i. A tile
+    and its mirror tile share a folded position, which grows towards the center
+    of the panorama (glon 0)
+
+    '''
+
+    index = np.arange(count)
+
+    return np.minimum(index, count - 1 - index)
+
+
+def shard_bounds(tiles, x, shards):
+    '''
+    Returns:
+    ______________
+    list of (first, stop) ranges of folded tile positions (see fold_tiles), one
+    per shard, that cover the survey from its ends to its center and hold about
+    the same number of the bubble centers x
+
+    '''
+
+    folded = fold_tiles(len(tiles))
+    groups = int(folded.max()) + 1
+    if shards < 1 or shards > groups:
+        raise ValueError('shards must be between 1 and %d, the tile pairs of the survey' % groups)
+
+    lefts = np.array([tile[1] for tile in tiles], dtype=np.int64)
+    owners = np.searchsorted(lefts, np.asarray(x, dtype=np.int64), side='right') - 1
+    owners = folded[np.clip(owners, 0, len(tiles) - 1)]
+    cumulative = np.cumsum(np.bincount(owners, minlength=groups))
+
+    stops = [0]
+    for shard in range(1, shards):
+        stop = int(np.searchsorted(cumulative, shard * cumulative[-1] / float(shards))) + 1
+        stop = min(max(stop, stops[-1] + 1), groups - (shards - shard))
+        stops.append(stop)
+    stops.append(groups)
+
+    return list(zip(stops[:-1], stops[1:]))
+
+
+def plan_shards(data_dir=DATA_DIR, shards=4, work_dir='shards', pad=50, dim=(224, 224, 3),
+                hshift=0, vshift=0, controls_per_bubble=1, control_candidates=8, control_seed=0,
+                layout='flat', use_pyramid=True, keep_control_metadata=False, catalog_path=None,
+                resize_kernel='skimage'):
+    '''
+    Returns:
+    ______________
+    dict; the plan, also written to work_dir/SHARD_PLAN. Every shard lists its
+    column ranges, its bubbles (catalog positions, in column order) and the
+    tiles its node needs
+
+    Args:
+    --------------
+    data_dir: string; directory containing the survey tiles and bubbly.csv
+    shards: int; number of shards (nodes), at most half the number of tiles
+    work_dir: string; directory of the plan and the shard outputs
+    the others: the run_cutoutgen parameters of the same name
+
+    Notes:
+    --------------
+    Only the tile headers are read (and the tiles hashed, see tile_checksums), so
+    planning takes seconds
+
+    '''
+
+    from control_sampling import first_controls
+    from cutout_stream import plan_cutouts
+    from mosaic import probe_tile_shape
+    from panorama_cache import tile_checksums
+    from pyramid import MIN_LEVEL_ROWS, MosaicPyramid
+
+    if catalog_path is None:
+        catalog_path = os.path.join(data_dir, 'bubbly.csv')
+
+    tiles = tile_checksums(data_dir)
+    rows, width, channels = probe_tile_shape(os.path.join(data_dir, tiles[0][0]))
+    shape = (rows, sum(tile[2] for tile in tiles), channels)
+
+    params = {'pad': pad, 'dim': list(dim), 'hshift': hshift, 'vshift': vshift,
+              'controls_per_bubble': controls_per_bubble,
+              'control_candidates': control_candidates, 'control_seed': control_seed,
+              'layout': layout, 'use_pyramid': use_pyramid,
+              'keep_control_metadata': keep_control_metadata, 'resize_kernel': resize_kernel}
+    catalog = load_catalog(catalog_path, shape)
+
+    #The shard of every tile, and through the tile under its center, of every bubble
+    bounds = shard_bounds(tiles, catalog['x'], shards)
+    folded = fold_tiles(len(tiles))
+    tile_shards = np.zeros(len(tiles), dtype=np.int64)
+    for shard, (first, stop) in enumerate(bounds):
+        tile_shards[(folded >= first) & (folded < stop)] = shard
+    lefts = np.array([tile[1] for tile in tiles], dtype=np.int64)
+    owners = tile_shards[np.clip(np.searchsorted(lefts, np.asarray(catalog['x']),
+                                                 side='right') - 1, 0, len(tiles) - 1)]
+
+    plan = {'data_dir': os.path.abspath(data_dir),
+            'catalog_path': os.path.abspath(catalog_path),
+            'shape': list(shape),
+            'tiles': [list(tile) for tile in tiles],
+            'min_rows': MIN_LEVEL_ROWS,
+            'params': params,
+            'shards': []}
+    for shard in range(shards):
+        positions = np.flatnonzero(owners == shard)
+        positions = positions[np.argsort(catalog['x'][positions], kind='stable')]
+        own = np.flatnonzero(tile_shards == shard)
+
+        #The column ranges of the runs of adjacent tiles, one, or two mirrored ones
+        runs = np.split(own, np.flatnonzero(np.diff(own) > 1) + 1)
+        columns = [[tiles[run[0]][1], tiles[run[-1]][1] + tiles[run[-1]][2]] for run in runs]
+
+        plan['shards'].append({'shard': shard,
+                               'columns': columns,
+                               'own_tiles': [tiles[index][0] for index in own],
+                               'positions': positions.tolist()})
+
+    #The tiles under every crop a node reads, at the pyramid level it is read from
+    control_centers = first_controls(shard_controls(catalog, shape, params, plan['shards']))
+    mosaic = survey_mosaic(data_dir, tiles, shape)
+    pyramid = MosaicPyramid(mosaic)
+    needed = [set() for shard in range(shards)]
+    for record, bubble_borders, control_borders in plan_cutouts(catalog, shape, pad, hshift,
+                                                                vshift,
+                                                                control_centers=control_centers):
+        for borders in (bubble_borders, control_borders):
+            if use_pyramid:
+                borders = pyramid.source_borders_for(borders, min(dim[0], dim[1]))
+            needed[owners[record.position]].update(mosaic.tiles_for_columns(borders[0],
+                                                                            borders[1]))
+
+    for shard, entry in enumerate(plan['shards']):
+        entry['tiles'] = [tiles[index][0] for index in sorted(needed[shard])]
+        print("Status: shard %d: columns %s, %d bubbles, %d of %d tiles"
+              % (shard, ' and '.join('%d-%d' % tuple(run) for run in entry['columns']),
+                 len(entry['positions']), len(needed[shard]), len(tiles)))
+
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    _write_json(os.path.join(work_dir, SHARD_PLAN), plan)
+
+    return plan
+
+
+def run_shard(plan_path, shard, data_dir=None, read_workers=2, resize_workers=None,
+              encode_workers=None, write_workers=4, queue_size=16, load_workers=None,
+              profile=False):
+    '''
+    Returns:
+    ______________
+    dict; the shard summary, also written to the shard directory as SHARD_SUMMARY
+
+    Args:
+    --------------
+    plan_path: string; the plan written by plan_shards
+    shard: int; the shard this node produces
+    data_dir: string or None; where this node keeps the tiles, defaults to the
+              data_dir of the plan. Only the tiles the plan lists for shard are read
+    read_workers, resize_workers, encode_workers, write_workers, queue_size: see
+        run_cutout_pipeline
+    load_workers: int; processes decoding the tiles, defaults to os.cpu_count()
+    profile: bool; add cProfile results to the shard run report
+
+    Notes:
+    --------------
+    The planned tiles are decoded into panorama.u8 in the shard directory, a
+    sparse panorama cache that only holds them (see open_partial_cache), so the
+    crops are read from a memmap like in a single-node run. The shard directory
+    also holds the JPEGs and their manifest in cutouts/, the partial dataset in
+    dataset/, run_report.json and the summary. Like cutoutgen.py, a node run is
+    incremental: running it again only regenerates what changed
+
+    '''
+
+    from cutout_pipeline import run_cutout_pipeline
+    from dataset import write_metadata
+    from instrumentation import Instrumentation
+    from manifest import CutoutManifest
+    from panorama_cache import open_partial_cache
+    from pyramid import MosaicPyramid
+
+    plan = load_plan(plan_path)
+    entry = plan['shards'][shard]
+    params = plan['params']
+    shape = tuple(plan['shape'])
+    dim = tuple(params['dim'])
+    shard_dir = shard_directory(plan['work_dir'], shard)
+    save_dir = os.path.join(shard_dir, 'cutouts')
+    dataset_dir = os.path.join(shard_dir, 'dataset')
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+
+    instrumentation = Instrumentation(profile=profile)
+
+    with instrumentation.stage('catalog') as stage:
+        catalog, control_centers = prepare_catalog(plan['catalog_path'], shape, params,
+                                                   plan['shards'])
+        stage['items'] = len(entry['positions'])
+
+    #Only the planned tiles are decoded, the rest of the panorama stays empty
+    with instrumentation.stage('load') as stage:
+        panorama, decoded = open_partial_cache(data_dir or plan['data_dir'],
+                                               os.path.join(shard_dir, 'panorama.u8'),
+                                               plan['tiles'], entry['tiles'], workers=load_workers)
+        stage['items'] = len(decoded)
+    pyramid = MosaicPyramid(panorama, plan['min_rows']) if params['use_pyramid'] else None
+
+    skipped_cutouts = []
+    skipped_controls = []
+    manifest = CutoutManifest(save_dir)
+    with instrumentation.stage('cutouts') as stage:
+        saved_cutouts = run_cutout_pipeline(catalog, panorama, save_dir, pad=params['pad'], dim=dim,
+                                            hshift=params['hshift'], vshift=params['vshift'],
+                                            skipped_cutouts=skipped_cutouts,
+                                            skipped_controls=skipped_controls,
+                                            read_workers=read_workers,
+                                            resize_workers=resize_workers,
+                                            encode_workers=encode_workers,
+                                            write_workers=write_workers, layout=params['layout'],
+                                            dataset_dir=dataset_dir, queue_size=queue_size,
+                                            manifest=manifest,
+                                            tiles=[tuple(tile) for tile in plan['tiles']],
+                                            control_centers=control_centers, pyramid=pyramid,
+                                            instrumentation=instrumentation,
+                                            positions=entry['positions'],
+                                            resize_kernel=params.get('resize_kernel', 'skimage'))
+        stage['items'] = 2 * len(saved_cutouts)
+    manifest.close()
+
+    with instrumentation.stage('metadata', items=2 * len(saved_cutouts)):
+        write_metadata(dataset_dir, catalog, saved_cutouts, cutout_dir=save_dir, dim=dim)
+
+    summary = {'shard': shard,
+               'columns': entry['columns'],
+               'saved': [{'position': record.position,
+                          'name': record.name,
+                          'radius': record.radius,
+                          'hitrate': record.hitrate,
+                          'bubble_center': list(record.bubble_center),
+                          'control_center': list(record.control_center),
+                          'control_coordinates': list(record.control_coordinates),
+                          'bubble_location': bubble_location,
+                          'control_location': control_location,
+                          'bubble_hash': manifest.entries[record.name + ".jpg"]['hash'],
+                          'control_hash': manifest.entries[record.name + "_control.jpg"]['hash']}
+                         for record, bubble_location, control_location in saved_cutouts],
+               'skipped_cutouts': sorted(skipped_cutouts, key=catalog.position),
+               'skipped_controls': sorted(skipped_controls, key=catalog.position),
+               'tiles': entry['tiles'],
+               'decoded': decoded}
+    _write_json(os.path.join(shard_dir, SHARD_SUMMARY), summary)
+    instrumentation.write(os.path.join(shard_dir, 'run_report.json'))
+
+    print("Status: shard %d: %d cutouts, %d skipped, %d of %d planned tiles decoded, "
+          "peak memory %.1f MB" % (shard, 2 * len(saved_cutouts),
+                                   len(skipped_cutouts) + len(skipped_controls), len(decoded),
+                                   len(entry['tiles']),
+                                   instrumentation.process_peak_rss_mb()))
+
+    return summary
+
+
+def merge_shards(plan_path, save_dir='cutouts', dataset_dir='dataset',
+                 pickle_path='gregs_data.pck', report_path='run_report.json'):
+    '''
+    Returns:
+    ______________
+    dict with the products of the run, as returned by run_cutoutgen (without the
+    pyramid), plus 'shards', the shard summaries
+
+    Args:
+    --------------
+    plan_path: string; the plan written by plan_shards
+    save_dir, dataset_dir, pickle_path, report_path: the run_cutoutgen outputs
+
+    Notes:
+    --------------
+    Every shard is merged in catalog order, whatever order the nodes finished in:
+    the JPEGs are copied into save_dir with the planned layout (and recorded in
+    its manifest, so merging again only copies what changed), the dataset rows
+    are copied into one array, and the metadata, input hashes and pickle are
+    written like a single-node run writes them. Raises IOError if a shard has
+    not finished
+
+    Usage:
+    ______________
+    results = merge_shards('shards/shard_plan.json')
+
+    '''
+
+    from cutout_stream import CutoutRecord
+    from cutout_writer import CutoutWriter, read_cutout_bytes
+    from dataset import (DATASET_CUTOUTS, DATASET_HASHES, CutoutDataset, create_cutout_array,
+                         write_metadata)
+    from instrumentation import Instrumentation
+    from manifest import CutoutManifest
+
+    plan = load_plan(plan_path)
+    params = plan['params']
+    dim = tuple(params['dim'])
+    instrumentation = Instrumentation()
+
+    summaries = []
+    for entry in plan['shards']:
+        summary_path = os.path.join(shard_directory(plan['work_dir'], entry['shard']),
+                                    SHARD_SUMMARY)
+        if not os.path.exists(summary_path):
+            raise IOError('shard %d has not finished, %s is missing' % (entry['shard'],
+                                                                        summary_path))
+        with open(summary_path) as summary_file:
+            summaries.append(json.load(summary_file))
+
+    with instrumentation.stage('catalog') as stage:
+        catalog = load_catalog(plan['catalog_path'], plan['shape'])
+        stage['items'] = len(catalog)
+
+    #Every saved pair with the shard it comes from, in catalog order
+    pairs = sorted(((row, summary['shard']) for summary in summaries for row in summary['saved']),
+                   key=lambda pair: pair[0]['position'])
+
+    manifest = CutoutManifest(save_dir)
+    writer = CutoutWriter(save_dir, layout=params['layout'])
+    saved_cutouts = []
+    copied = 0
+    with instrumentation.stage('jpegs', items=2 * len(pairs)) as stage:
+        for row, shard in pairs:
+            shard_save_dir = os.path.join(shard_directory(plan['work_dir'], shard), 'cutouts')
+            locations = []
+            for file_name, location, input_hash in (
+                    (row['name'] + ".jpg", row['bubble_location'], row['bubble_hash']),
+                    (row['name'] + "_control.jpg", row['control_location'], row['control_hash'])):
+                if not manifest.is_current(file_name, input_hash):
+                    data = read_cutout_bytes(shard_save_dir, location)
+                    manifest.record(file_name, input_hash, writer.write(file_name, data))
+                    copied = copied + 1
+                locations.append(manifest.location(file_name))
+            record = CutoutRecord(row['position'], row['name'], row['radius'], row['hitrate'],
+                                  tuple(row['bubble_center']), tuple(row['control_center']),
+                                  tuple(row['control_coordinates']))
+            saved_cutouts.append((record, locations[0], locations[1]))
+        writer.close()
+        manifest.remove_stale(set(file_name for row, shard in pairs
+                                  for file_name in (row['name'] + ".jpg",
+                                                    row['name'] + "_control.jpg")))
+        manifest.compact()
+        manifest.close()
+        stage['copied'] = copied
+
+    #Bubbles first, then their controls, like run_cutout_pipeline lays them out
+    count = len(pairs)
+    with instrumentation.stage('dataset', items=2 * count):
+        buffer = create_cutout_array(dataset_dir, 2 * count, dim, DATASET_CUTOUTS + '.partial')
+        datasets = dict((summary['shard'], CutoutDataset(os.path.join(
+            shard_directory(plan['work_dir'], summary['shard']), 'dataset')))
+            for summary in summaries)
+        row_hashes = {}
+        for k, (row, shard) in enumerate(pairs):
+            buffer.put(k, datasets[shard].by_id(row['name'])[0])
+            buffer.put(count + k, datasets[shard].by_id(row['name'] + "_control")[0])
+            row_hashes[row['name']] = row['bubble_hash']
+            row_hashes[row['name'] + "_control"] = row['control_hash']
+        buffer.flush()
+        datasets = None
+        os.replace(buffer.path, os.path.join(dataset_dir, DATASET_CUTOUTS))
+        with open(os.path.join(dataset_dir, DATASET_HASHES), 'w') as hash_file:
+            json.dump(row_hashes, hash_file)
+
+    with instrumentation.stage('metadata', items=2 * count):
+        write_metadata(dataset_dir, catalog, saved_cutouts, cutout_dir=save_dir, dim=dim)
+
+    with instrumentation.stage('join', items=2 * count):
+        cutout_dict, control_dict, big_dict = join_cutouts(catalog, saved_cutouts,
+                                                           params['keep_control_metadata'])
+
+    the_info = describe_cutouts(big_dict, save_dir)
+    with instrumentation.stage('save', items=len(the_info)):
+        with open(pickle_path, 'wb') as fp:
+            pickle.dump(the_info, fp, pickle.HIGHEST_PROTOCOL)
+
+    #The skip lists of all shards, in catalog order
+    skipped_cutouts = sorted((name for summary in summaries
+                              for name in summary['skipped_cutouts']), key=catalog.position)
+    skipped_controls = sorted((name for summary in summaries
+                               for name in summary['skipped_controls']), key=catalog.position)
+
+    instrumentation.write(report_path)
+    print("Status: merged %d shards, %d cutouts (%d copied), %d skipped"
+          % (len(summaries), 2 * count, copied,
+             len(skipped_cutouts) + len(skipped_controls)))
+
+    return {'saved_cutouts': saved_cutouts, 'cutout_dict': cutout_dict,
+            'control_dict': control_dict, 'big_dict': big_dict, 'the_info': the_info,
+            'skipped_cutouts': skipped_cutouts, 'skipped_controls': skipped_controls,
+            'shards': summaries}
+
+
+def run_local(plan_path, parallel=None, node_args=()):
+    '''
+    Run every shard of the plan in its own python process, standing in for the
+    nodes, with at most parallel (default: all) at once. The output of a node is
+    written to node.log in its shard directory. Raises RuntimeError if a node fails
+
+    Returns:
+    ______________
+    list of float; wall seconds of every node
+
+    '''
+
+    plan = load_plan(plan_path)
+    shards = [entry['shard'] for entry in plan['shards']]
+    if parallel is None:
+        parallel = len(shards)
+
+    running = {}
+    seconds = {}
+    failed = []
+    while shards or running:
+        while shards and len(running) < parallel:
+            shard = shards.pop(0)
+            shard_dir = shard_directory(plan['work_dir'], shard)
+            if not os.path.isdir(shard_dir):
+                os.makedirs(shard_dir)
+            log = open(os.path.join(shard_dir, 'node.log'), 'w')
+            command = ([sys.executable, os.path.abspath(__file__), 'node', plan_path, str(shard)]
+                       + list(node_args))
+            running[shard] = (subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT),
+                              log, time.time())
+            print("Status: started node for shard %d" % shard)
+        for shard, (process, log, started) in list(running.items()):
+            if process.poll() is None:
+                continue
+            log.close()
+            del running[shard]
+            seconds[shard] = time.time() - started
+            print("Status: node for shard %d exited with %d after %.1f s"
+                  % (shard, process.returncode, seconds[shard]))
+            if process.returncode != 0:
+                failed.append(shard)
+        time.sleep(0.2)
+
+    if failed:
+        raise RuntimeError('nodes failed for shards %s, see their node.log' % sorted(failed))
+
+    return [seconds[shard] for shard in sorted(seconds)]
+
+
+def main(argv=None):
+
+    from cutout_writer import LAYOUTS
+    from resize_kernel import RESIZE_KERNELS
+
+    parser = argparse.ArgumentParser(description='Shard a cutoutgen.py run over several nodes.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    plan_parser = argparse.ArgumentParser(add_help=False)
+    plan_parser.add_argument('--data-dir', default=DATA_DIR,
+                             help='directory of the survey tiles and bubbly.csv')
+    plan_parser.add_argument('--catalog', default=None,
+                             help='bubble csv, default DATA_DIR/bubbly.csv')
+    plan_parser.add_argument('--shards', type=int, default=4)
+    plan_parser.add_argument('--work-dir', default='shards',
+                             help='directory of the plan and the shard outputs')
+    plan_parser.add_argument('--pad', type=int, default=50)
+    plan_parser.add_argument('--size', type=int, default=224, help='cutout rows and cols')
+    plan_parser.add_argument('--hshift', type=int, default=0)
+    plan_parser.add_argument('--vshift', type=int, default=0)
+    plan_parser.add_argument('--controls-per-bubble', type=int, default=1)
+    plan_parser.add_argument('--control-candidates', type=int, default=8)
+    plan_parser.add_argument('--control-seed', type=int, default=0)
+    plan_parser.add_argument('--layout', choices=LAYOUTS, default='flat')
+    plan_parser.add_argument('--full-resolution', action='store_true',
+                             help='crop from level 0 instead of the matching pyramid level')
+    plan_parser.add_argument('--keep-control-metadata', action='store_true')
+    plan_parser.add_argument('--resize-kernel', choices=RESIZE_KERNELS, default='skimage',
+                             help='skimage reproduces earlier runs, linear and area are faster')
+
+    node_parser = argparse.ArgumentParser(add_help=False)
+    node_parser.add_argument('--node-data-dir', default=None,
+                             help='where this node keeps its tiles, default the planned data dir')
+    node_parser.add_argument('--read-workers', type=int, default=2)
+    node_parser.add_argument('--resize-workers', type=int, default=None)
+    node_parser.add_argument('--encode-workers', type=int, default=None)
+    node_parser.add_argument('--write-workers', type=int, default=4)
+    node_parser.add_argument('--load-workers', type=int, default=None,
+                             help='processes decoding the tiles')
+    node_parser.add_argument('--profile', action='store_true',
+                             help='add cProfile results to the report')
+
+    merge_parser = argparse.ArgumentParser(add_help=False)
+    merge_parser.add_argument('--save-dir', default='cutouts', help='directory of the cutout JPEGs')
+    merge_parser.add_argument('--dataset-dir', default='dataset',
+                              help='directory of the memory-mapped dataset')
+    merge_parser.add_argument('--pickle', default='gregs_data.pck',
+                              help='cutout description pickle')
+    merge_parser.add_argument('--report', default='run_report.json', help='JSON run report')
+
+    commands.add_parser('plan', parents=[plan_parser], help='write the shard plan')
+    node = commands.add_parser('node', parents=[node_parser], help='produce one shard')
+    node.add_argument('plan')
+    node.add_argument('shard', type=int)
+    merge = commands.add_parser('merge', parents=[merge_parser], help='merge the finished shards')
+    merge.add_argument('plan')
+    local = commands.add_parser('local', parents=[plan_parser, node_parser, merge_parser],
+                                help='plan, run every shard in its own process, and merge')
+    local.add_argument('--parallel', type=int, default=None,
+                       help='nodes running at once, default all')
+    args = parser.parse_args(argv)
+
+    if args.command in ('plan', 'local'):
+        plan_shards(data_dir=args.data_dir, shards=args.shards, work_dir=args.work_dir,
+                    pad=args.pad, dim=(args.size, args.size, 3), hshift=args.hshift,
+                    vshift=args.vshift, controls_per_bubble=args.controls_per_bubble,
+                    control_candidates=args.control_candidates, control_seed=args.control_seed,
+                    layout=args.layout, use_pyramid=not args.full_resolution,
+                    keep_control_metadata=args.keep_control_metadata, catalog_path=args.catalog,
+                    resize_kernel=args.resize_kernel)
+    plan_path = os.path.join(args.work_dir, SHARD_PLAN) if args.command == 'local' else None
+
+    if args.command == 'node':
+        run_shard(args.plan, args.shard, data_dir=args.node_data_dir,
+                  read_workers=args.read_workers, resize_workers=args.resize_workers,
+                  encode_workers=args.encode_workers, write_workers=args.write_workers,
+                  load_workers=args.load_workers, profile=args.profile)
+    elif args.command == 'local':
+        node_args = ['--read-workers', str(args.read_workers),
+                     '--write-workers', str(args.write_workers)]
+        for flag, value in (('--node-data-dir', args.node_data_dir),
+                            ('--resize-workers', args.resize_workers),
+                            ('--encode-workers', args.encode_workers),
+                            ('--load-workers', args.load_workers)):
+            if value is not None:
+                node_args += [flag, str(value)]
+        if args.profile:
+            node_args.append('--profile')
+        run_local(plan_path, parallel=args.parallel, node_args=node_args)
+
+    if args.command in ('merge', 'local'):
+        merge_shards(plan_path or args.plan, save_dir=args.save_dir, dataset_dir=args.dataset_dir,
+                     pickle_path=args.pickle, report_path=args.report)
+
+
+if __name__ == '__main__':
+    main()
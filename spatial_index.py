@@ -0,0 +1,293 @@
+'''
+Uniform grid index over bubble positions and radii.
+
+The points are bucketed into square cells and stored sorted by cell, so a
+query only looks at the few cells it touches instead of scanning the whole
+catalog. The same index works in degree space (wrapped glon, glat, reff) and in
+pixel space (x, y, r):
+
+index = SpatialIndex.from_catalog(catalog, space='degrees')
+inside = index.window(10, 12, -0.5, 0.5)
+near = index.within(x=200000, y=3000, distance=500)
+positions, distances = index.nearest(200000, 3000, k=5)
+
+Query results are catalog positions.
+'''
+
+import numpy as np
+
+from coords import wrap_glon
+
+#Coordinate spaces SpatialIndex.from_catalog can index
+SPACES = ('degrees', 'pixels')
+
+
+class SpatialIndex(object):
+    '''
+    Grid index over circles (x, y, radius).
+
+    Args:
+    --------------
+    x, y: arrays of point coordinates
+    radius: array of radii or None for points
+    cell_size: float; side of a grid cell. Defaults to a size that puts about
+               two points in a cell
+
+    Notes:
+    --------------
+    Points with a non-finite coordinate are not indexed
+
+    '''
+
+    def __init__(self, x, y, radius=None, cell_size=None):
+
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        if radius is None:
+            radius = np.zeros(x.shape)
+        radius = np.asarray(radius, dtype=np.float64)
+
+        self.size = len(x)
+        positions = np.flatnonzero(np.isfinite(x) & np.isfinite(y) & np.isfinite(radius))
+
+        if len(positions):
+            self.origin = (x[positions].min(), y[positions].min())
+            extent = (x[positions].max() - self.origin[0], y[positions].max() - self.origin[1])
+        else:
+            self.origin = (0.0, 0.0)
+            extent = (0.0, 0.0)
+
+        if cell_size is None:
+            #Points on a line would otherwise get cells of almost no area and width
+            least = max(max(extent) / max(len(positions), 1), 1e-9)
+            area = max(extent[0], least) * max(extent[1], least)
+            cell_size = np.sqrt(2.0 * area / max(len(positions), 1))
+            cell_size = max(cell_size, max(extent) / 4096.0, 1e-9)
+        self.cell_size = float(cell_size)
+        self.cells = (int(extent[0] // self.cell_size) + 1, int(extent[1] // self.cell_size) + 1)
+
+        cell_x, cell_y = self._cell(x[positions], y[positions])
+        cell_ids = cell_y * self.cells[0] + cell_x
+        order = np.argsort(cell_ids, kind='stable')
+
+        #Points sorted by cell; cell i holds order[starts[i]:starts[i + 1]]
+        self.positions = positions[order]
+        self.x = x[self.positions]
+        self.y = y[self.positions]
+        self.radius = radius[self.positions]
+        self.starts = np.searchsorted(cell_ids[order], np.arange(self.cells[0] * self.cells[1] + 1))
+        self.max_radius = float(self.radius.max()) if len(self.radius) else 0.0
+
+    @classmethod
+    def from_catalog(cls, catalog, space='degrees', cell_size=None):
+        '''
+        Returns:
+        ______________
+        SpatialIndex over the bubbles of catalog
+
+        Args:
+        --------------
+        catalog: BubbleCatalog; pixel space needs a converted catalog
+        space: 'degrees' indexes (wrapped glon, glat, reff), 'pixels' indexes (x, y, r)
+        cell_size: float or None; see SpatialIndex
+
+        '''
+
+        if space == 'degrees':
+            return cls(wrap_glon(catalog['glon']), catalog['glat'], catalog['reff'], cell_size)
+        if space == 'pixels':
+            return cls(catalog['x'], catalog['y'], catalog['r'], cell_size)
+
+        raise ValueError('space must be one of %s' % (SPACES,))
+
+    def __len__(self):
+        return len(self.positions)
+
+    def _cell(self, x, y):
+
+        cell_x = np.floor((np.asarray(x) - self.origin[0]) / self.cell_size)
+        cell_y = np.floor((np.asarray(y) - self.origin[1]) / self.cell_size)
+
+        return (np.clip(cell_x, 0, self.cells[0] - 1).astype(np.int64),
+                np.clip(cell_y, 0, self.cells[1] - 1).astype(np.int64))
+
+    def _candidates(self, xmin, xmax, ymin, ymax):
+        '''
+        Returns:
+        ______________
+        int64 array; indices into the sorted points of the cells covering the window
+        '''
+
+        if not len(self.positions) or xmax < xmin or ymax < ymin:
+            return np.zeros(0, dtype=np.int64)
+
+        (cell_x0, cell_x1), (cell_y0, cell_y1) = [
+            np.asarray(cells).tolist() for cells in self._cell((xmin, xmax), (ymin, ymax))]
+
+        #Every row of cells is one contiguous run of the sorted points
+        rows = np.arange(cell_y0, cell_y1 + 1) * self.cells[0]
+        starts = self.starts[rows + cell_x0]
+        stops = self.starts[rows + cell_x1 + 1]
+        if len(rows) == 1:
+            return np.arange(starts[0], stops[0])
+
+        return np.concatenate([np.arange(start, stop) for start, stop in zip(starts, stops)])
+
+    def window(self, xmin, xmax, ymin, ymax, overlap=False):
+        '''
+        Returns:
+        ______________
+        int64 array; sorted catalog positions of the points inside the window
+
+        Args:
+        --------------
+        xmin, xmax, ymin, ymax: window bounds (inclusive), in index space. In degree
+                                space, x is the wrapped glon (see coords.wrap_glon)
+        overlap: bool; if True, also return circles whose edge reaches into the window
+
+        '''
+
+        xmin, xmax = min(xmin, xmax), max(xmin, xmax)
+        ymin, ymax = min(ymin, ymax), max(ymin, ymax)
+        margin = self.max_radius if overlap else 0.0
+
+        found = self._candidates(xmin - margin, xmax + margin, ymin - margin, ymax + margin)
+        x, y = self.x[found], self.y[found]
+
+        if overlap:
+            #Distance from each center to the closest point of the window
+            dx = np.maximum(np.maximum(xmin - x, x - xmax), 0)
+            dy = np.maximum(np.maximum(ymin - y, y - ymax), 0)
+            keep = dx * dx + dy * dy <= self.radius[found] ** 2
+        else:
+            keep = (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+
+        return np.sort(self.positions[found[keep]])
+
+    def within(self, x, y, distance, overlap=False):
+        '''
+        Returns:
+        ______________
+        int64 array; sorted catalog positions of the points within distance of (x, y)
+
+        Args:
+        --------------
+        x, y: query point
+        distance: float; search radius
+        overlap: bool; if True, return the circles that intersect the search circle
+
+        '''
+
+        margin = distance + (self.max_radius if overlap else 0.0)
+        found = self._candidates(x - margin, x + margin, y - margin, y + margin)
+
+        reach = distance + self.radius[found] if overlap else distance
+        keep = (self.x[found] - x) ** 2 + (self.y[found] - y) ** 2 <= reach ** 2
+
+        return np.sort(self.positions[found[keep]])
+
+    def nearest(self, x, y, k=1):
+        '''
+        Returns:
+        ______________
+        (positions, distances); the catalog positions of the k points closest to
+        (x, y), nearest first, and their center distances
+
+        '''
+
+        k = min(k, len(self.positions))
+        if k <= 0:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0))
+
+        #Grow the search square until it holds k points that are closer than its edge
+        reach = self.cell_size
+        while True:
+            found = self._candidates(x - reach, x + reach, y - reach, y + reach)
+            if len(found) >= k or len(found) == len(self.positions):
+                distances = np.hypot(self.x[found] - x, self.y[found] - y)
+                closest = np.argsort(distances, kind='stable')[:k]
+                if distances[closest[-1]] <= reach or len(found) == len(self.positions):
+                    return (self.positions[found[closest]], distances[closest])
+            reach = reach * 2
+
+    def overlapping(self, x, y, radius, exclude=None):
+        '''
+        Returns:
+        ______________
+        bool array; for every query circle, whether it intersects an indexed circle
+
+        Args:
+        --------------
+        x, y, radius: arrays of query circles
+        exclude: int array or None; a catalog position per query circle that is
+                 ignored, e.g. the bubble a candidate was drawn for
+
+        Notes:
+        --------------
+        Vectorized over the queries: the loop runs over the neighbouring cells and
+        the points within a cell, not over the queries
+
+        '''
+
+        x = np.asarray(x, dtype=np.float64).ravel()
+        y = np.asarray(y, dtype=np.float64).ravel()
+        radius = np.broadcast_to(np.asarray(radius, dtype=np.float64), x.shape)
+        hit = np.zeros(x.shape, dtype=bool)
+        if not len(self.positions) or not x.size:
+            return hit
+
+        #Handle the queries in cell order, so neighbouring queries read neighbouring points
+        cell_x, cell_y = self._cell(x, y)
+        order = np.argsort(cell_y * self.cells[0] + cell_x, kind='stable')
+        x, y, radius = x[order], y[order], radius[order]
+        cell_x, cell_y = cell_x[order], cell_y[order]
+        if exclude is not None:
+            exclude = np.asarray(exclude)[order]
+        span = int(np.ceil((radius.max() + self.max_radius) / self.cell_size))
+        per_cell = int(np.diff(self.starts).max())
+
+        #Position inside the own cell, to skip neighbour cells that are out of reach
+        inside_x = x - self.origin[0] - cell_x * self.cell_size
+        inside_y = y - self.origin[1] - cell_y * self.cell_size
+        reach = (radius + self.max_radius) ** 2
+
+        def gap(offset, inside):
+            if offset > 0:
+                return np.maximum(offset * self.cell_size - inside, 0)
+            if offset < 0:
+                return np.maximum(inside - (offset + 1) * self.cell_size, 0)
+            return 0.0
+
+        for offset_y in range(-span, span + 1):
+            row = cell_y + offset_y
+            gap_y = gap(offset_y, inside_y) ** 2
+            valid_row = (row >= 0) & (row < self.cells[1]) & (gap_y < reach)
+            for offset_x in range(-span, span + 1):
+                column = cell_x + offset_x
+                valid = (valid_row & (column >= 0) & (column < self.cells[0]) & ~hit &
+                         (gap_y + gap(offset_x, inside_x) ** 2 < reach))
+                if not valid.any():
+                    continue
+                queries = np.flatnonzero(valid)
+                cell_ids = row[queries] * self.cells[0] + column[queries]
+                start = self.starts[cell_ids]
+                count = self.starts[cell_ids + 1] - start
+                occupied = count > 0
+                queries, start, count = queries[occupied], start[occupied], count[occupied]
+                for slot in range(per_cell):
+                    active = count > slot
+                    if not active.any():
+                        break
+                    query = queries[active]
+                    point = start[active] + slot
+                    touches = ((self.x[point] - x[query]) ** 2 +
+                               (self.y[point] - y[query]) ** 2 <
+                               (radius[query] + self.radius[point]) ** 2)
+                    if exclude is not None:
+                        touches &= self.positions[point] != exclude[query]
+                    hit[query[touches]] = True
+
+        result = np.zeros(hit.shape, dtype=bool)
+        result[order] = hit
+
+        return result
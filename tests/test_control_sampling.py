@@ -0,0 +1,103 @@
+'''
+Sampled controls never overlap a catalog bubble and only depend on the seed.
+'''
+
+import numpy as np
+import pytest
+
+from catalog import BubbleCatalog
+from control_sampling import bubble_draws, first_controls, sample_controls
+from cutout_stream import crop_borders
+from spatial_index import SpatialIndex
+
+SHAPE = (600, 40000, 3)
+PAD = 20
+
+
+def make_catalog(bubbles=300, seed=0, order=None):
+    '''
+    Returns:
+    ______________
+    converted BubbleCatalog of random bubbles over SHAPE, crowded enough that
+    many mirror locations and random candidates hit another bubble
+    '''
+
+    rng = np.random.default_rng(seed)
+    ids = np.array(['1G%06d' % number for number in range(bubbles)])
+    glon = rng.uniform(-64, 64, bubbles) % 360
+    glat = rng.uniform(-0.9, 0.9, bubbles)
+    reff = np.exp(rng.uniform(np.log(0.005), np.log(0.15), bubbles))
+    if order is not None:
+        ids, glon, glat, reff = ids[order], glon[order], glat[order], reff[order]
+
+    return BubbleCatalog.from_arrays(ids, glon, glat, reff).convert(SHAPE)
+
+
+@pytest.fixture
+def catalog():
+    return make_catalog()
+
+
+def test_controls_do_not_overlap(catalog):
+
+    controls = sample_controls(catalog, SHAPE, count=3, pad=PAD, candidates=8, seed=1)
+    index = SpatialIndex.from_catalog(catalog, space='pixels')
+    half = controls['r'] + PAD
+
+    assert len(controls) > len(catalog)
+    assert not index.overlapping(controls['x'], controls['y'], half).any()
+
+    #Every control crop stays inside the panorama
+    left, right, top, bot = crop_borders((controls['x'], controls['y']), controls['r'], PAD)
+    assert (left >= 0).all() and (right <= SHAPE[1] - 1).all()
+    assert (top >= 0).all() and (bot <= SHAPE[0] - 1).all()
+
+    #The controls of one bubble do not overlap each other, and have its radius
+    for position in np.unique(controls['position']):
+        own = controls[controls['position'] == position]
+        assert own['number'].tolist() == list(range(len(own)))
+        assert (own['r'] == catalog['r'][position]).all()
+        distance = np.hypot(own['x'][:, None] - own['x'][None, :],
+                            own['y'][:, None] - own['y'][None, :])
+        apart = distance >= 2 * (catalog['r'][position] + PAD)
+        assert (apart | np.eye(len(own), dtype=bool)).all()
+
+
+def test_mirror_first(catalog):
+
+    controls = first_controls(sample_controls(catalog, SHAPE, pad=PAD, seed=1))
+    index = SpatialIndex.from_catalog(catalog, space='pixels')
+
+    mirror_x = SHAPE[1] - 1 - catalog['x']
+    mirror_y = SHAPE[0] - 1 - catalog['y']
+    clean = ~index.overlapping(mirror_x, mirror_y, catalog['r'] + PAD)
+    left, right, top, bot = crop_borders((mirror_x, mirror_y), catalog['r'], PAD)
+    clean &= (left >= 0) & (right <= SHAPE[1] - 1) & (top >= 0) & (bot <= SHAPE[0] - 1)
+
+    #A clean mirror location is kept as the control, the others are replaced
+    assert 0 < clean.sum() < len(catalog)
+    for position in np.flatnonzero(clean):
+        assert controls[position] == (mirror_x[position], mirror_y[position])
+    for position in np.flatnonzero(~clean):
+        assert controls.get(position) != (mirror_x[position], mirror_y[position])
+
+
+def test_deterministic_for_a_seed(catalog):
+
+    first = sample_controls(catalog, SHAPE, count=3, pad=PAD, seed=7)
+    again = sample_controls(make_catalog(), SHAPE, count=3, pad=PAD, seed=7)
+    other = sample_controls(catalog, SHAPE, count=3, pad=PAD, seed=8)
+
+    np.testing.assert_array_equal(first, again)
+    assert len(first) != len(other) or (first['x'] != other['x']).any()
+
+    #The draws of a bubble follow its ID, not its position in the catalog
+    order = np.random.default_rng(3).permutation(len(catalog))
+    shuffled = make_catalog(order=order)
+    moved = sample_controls(shuffled, SHAPE, count=3, pad=PAD, seed=7)
+    by_id = dict(((catalog.ids[row['position']], row['number']), (row['x'], row['y']))
+                 for row in first)
+    assert by_id == dict(((shuffled.ids[row['position']], row['number']), (row['x'], row['y']))
+                         for row in moved)
+    np.testing.assert_array_equal(bubble_draws(shuffled.ids, 4, 7),
+                                  bubble_draws(catalog.ids, 4, 7)[order])
@@ -0,0 +1,79 @@
+'''
+degrees_to_pixels against the per-bubble argmin lookup it replaced.
+'''
+
+import numpy as np
+import pytest
+
+from coords import degrees_to_pixels
+
+
+def argmin_degree_to_pixel(glon, glat, reff, shape):
+    '''
+    Returns:
+    ______________
+    (glon_idx, glat_idx, radius_in_pixels); the cutoutgen.py degree_to_pixel of
+    one bubble, without its range warnings
+    '''
+
+    if glon <= 360 and glon >= 295.5:
+        glon = glon - 360
+
+    glat_range = np.linspace(1, -1, shape[0])
+    glon_range = np.linspace(64.5, -64.5, shape[1])
+
+    return ((np.abs(glon_range - glon)).argmin(), (np.abs(glat_range - glat)).argmin(),
+            int(reff * 3000))
+
+
+def check_against_argmin(glon, glat, reff, shape):
+
+    x, y, r = degrees_to_pixels(glon, glat, reff, shape)
+    expected = np.array([argmin_degree_to_pixel(*values, shape=shape)
+                         for values in zip(glon, glat, reff)]).reshape(-1, 3)
+
+    np.testing.assert_array_equal(x, expected[:, 0])
+    np.testing.assert_array_equal(y, expected[:, 1])
+    np.testing.assert_array_equal(r, expected[:, 2])
+
+
+@pytest.mark.parametrize('shape', [(6000, 387000, 3), (6000, 54000), (7, 13), (2, 2), (1, 1)])
+def test_random_bubbles(shape):
+
+    rng = np.random.default_rng(shape[1])
+    count = 300
+    glon = np.where(rng.random(count) < 0.5, rng.uniform(0, 64.5, count),
+                    rng.uniform(295.5, 360, count))
+    glat = rng.uniform(-1, 1, count)
+    reff = rng.uniform(0, 0.1, count)
+
+    check_against_argmin(glon, glat, reff, shape)
+
+
+@pytest.mark.parametrize('shape', [(6000, 387000), (7, 13), (4, 3)])
+def test_grid_points_and_ties(shape):
+    '''
+    Values right on a linspace element and right between two of them, where the
+    closed form and argmin are most likely to round differently
+    '''
+
+    glat_grid = np.linspace(1, -1, shape[0])
+    glon_grid = np.linspace(64.5, -64.5, shape[1])
+    picks = np.unique(np.linspace(0, len(glon_grid) - 1, 200).astype(np.int64))
+    midpoints = (glon_grid[picks[:-1]] + glon_grid[picks[:-1] + 1]) / 2
+    glon = np.concatenate((glon_grid[picks], midpoints))
+    glat = np.resize(np.concatenate((glat_grid, (glat_grid[:-1] + glat_grid[1:]) / 2)), len(glon))
+
+    #Back to the 0-360 convention of the catalog for the negative longitudes
+    glon = np.where(glon < 0, glon + 360, glon)
+
+    check_against_argmin(glon, glat, np.full(len(glon), 0.01), shape)
+
+
+def test_out_of_range_and_wraparound():
+
+    glon = np.array([-1.0, 0.0, 64.5, 64.6, 200.0, 295.4, 295.5, 359.999, 360.0, 361.0, np.nan])
+    glat = np.array([-1.5, -1.0, 1.0, 1.5, 0.0, 0.3, -0.3, 0.999, -0.999, 2.0, np.nan])
+    reff = np.array([0.1, 0.0, -0.01, 0.00033, 0.5, 1.0, 0.2, 0.02, 0.03, 0.04, 0.05])
+
+    check_against_argmin(glon, glat, reff, (6000, 387000))
@@ -0,0 +1,118 @@
+'''
+Cutouts written with every CutoutWriter layout and read back with read_cutout.
+'''
+
+import concurrent.futures
+import os
+
+import numpy as np
+import pytest
+
+from cutout_writer import (LAYOUTS, SHARD_INDEX_NAME, CutoutWriter, encode_jpeg,
+                           hashed_subdirectory, read_cutout, read_cutout_bytes, read_shard_index)
+
+
+@pytest.fixture
+def cutouts():
+    '''
+    Returns:
+    ______________
+    dict of {file name: (cutout, encoded JPEG)} of a few bubbles and controls
+    '''
+
+    rng = np.random.default_rng(0)
+    cutouts = {}
+    for k in range(6):
+        for suffix in ('.jpg', '_control.jpg'):
+            cutout = rng.integers(0, 256, (32, 32, 3), dtype=np.uint8)
+            cutouts['1G%06d-%06d%s' % (k, 3 * k, suffix)] = (cutout, encode_jpeg(cutout))
+
+    return cutouts
+
+
+def decoded(data):
+
+    import imageio.v3 as iio
+
+    return iio.imread(data, extension='.jpg')
+
+
+@pytest.mark.parametrize('layout', LAYOUTS)
+def test_round_trip(layout, cutouts, tmp_path):
+
+    save_dir = str(tmp_path / layout)
+    locations = {}
+    #A small shard size, so the shards layout spreads the cutouts over several shards
+    with CutoutWriter(save_dir, layout=layout, shard_size=3000) as writer:
+        for name, (cutout, data) in cutouts.items():
+            locations[name] = writer.write(name, data)
+
+    assert writer.count == len(cutouts)
+    assert writer.bytes_written == sum(len(data) for cutout, data in cutouts.values())
+
+    for name, (cutout, data) in cutouts.items():
+        assert read_cutout_bytes(save_dir, locations[name]) == data
+        image = read_cutout(save_dir, locations[name])
+        assert image.shape == cutout.shape
+        np.testing.assert_array_equal(image, decoded(data))
+        #JPEG is lossy, but the cutout must still be recognisable
+        assert np.abs(image.astype(int) - cutout).mean() < 64
+
+    if layout == 'flat':
+        assert locations == dict((name, name) for name in cutouts)
+        assert sorted(os.listdir(save_dir)) == sorted(cutouts)
+    elif layout == 'hashed':
+        for name, location in locations.items():
+            assert location == os.path.join(hashed_subdirectory(name), name)
+            assert os.path.isfile(os.path.join(save_dir, location))
+    else:
+        assert read_shard_index(save_dir) == locations
+        shards = sorted(name for name in os.listdir(save_dir) if name.endswith('.bin'))
+        assert len(shards) > 1
+        assert sum(os.path.getsize(os.path.join(save_dir, shard)) for shard in shards) == \
+            writer.bytes_written
+
+
+def test_hashed_levels(cutouts, tmp_path):
+
+    save_dir = str(tmp_path / 'hashed')
+    with CutoutWriter(save_dir, layout='hashed', levels=2) as writer:
+        for name, (cutout, data) in cutouts.items():
+            location = writer.write(name, data)
+            assert len(location.split(os.sep)) == 3
+            assert read_cutout_bytes(save_dir, location) == data
+
+
+def test_shards_append_on_rerun(cutouts, tmp_path):
+
+    save_dir = str(tmp_path / 'shards')
+    names = sorted(cutouts)
+
+    #Written from several threads at once, like the write stage of the pipeline
+    with CutoutWriter(save_dir, layout='shards', shard_size=5000) as writer:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+            first = dict(zip(names, pool.map(lambda name: writer.write(name, cutouts[name][1]),
+                                             names)))
+    shards = set(os.listdir(save_dir)) - {SHARD_INDEX_NAME}
+
+    #A second run appends new shards and the index resolves to the newest copy
+    changed = names[0]
+    data = encode_jpeg(255 - cutouts[changed][0])
+    with CutoutWriter(save_dir, layout='shards', shard_size=5000) as writer:
+        location = writer.write(changed, data)
+
+    assert location.split('@')[0] not in shards
+    index = read_shard_index(save_dir)
+    assert index[changed] == location
+    assert read_cutout_bytes(save_dir, index[changed]) == data
+    for name in names[1:]:
+        assert index[name] == first[name]
+        assert read_cutout_bytes(save_dir, index[name]) == cutouts[name][1]
+    #The earlier copy is still readable at its old location
+    assert read_cutout_bytes(save_dir, first[changed]) == cutouts[changed][1]
+
+
+def test_unknown_layout(tmp_path):
+
+    with pytest.raises(ValueError):
+        CutoutWriter(str(tmp_path), layout='tar')
@@ -0,0 +1,106 @@
+'''
+The hash-join dict_adjust and merge_dicts against the nested loops they replaced.
+'''
+
+import numpy as np
+import pytest
+
+from cutoutgen import dict_adjust, merge_dicts
+
+
+def nested_loop_dict_adjust(original_bubble_dict, dict_with_cutouts):
+    '''
+    Returns:
+    ______________
+    the original cutoutgen.py dict_adjust result, from the nested loop over both dicts
+    '''
+
+    new_dict = {}
+    for name1, value1 in original_bubble_dict.items():
+        for name2, value2 in dict_with_cutouts.items():
+            if name1 == name2:
+                new_dict[name1] = (value2[0], value1)
+                break
+            elif (name1 + "_control") == name2:
+                new_dict[name1 + "_control"] = (value2[0], (0, 0, 0, 0, 0, 0))
+                break
+
+    return new_dict
+
+
+def nested_loop_merge_dicts(dict1, dict2):
+
+    merged_dict = {}
+    for name_1, value_1 in dict1.items():
+        merged_dict[name_1] = value_1
+    for name_2, value_2 in dict2.items():
+        merged_dict[name_2] = value_2
+
+    return merged_dict
+
+
+def random_dicts(seed, bubbles=200):
+    '''
+    Returns:
+    ______________
+    (bubble_dict, cutout_dict); the cutout dict has, in shuffled order, the
+    bubbles, the controls or both for a random subset of the IDs, and unrelated names
+    '''
+
+    rng = np.random.default_rng(seed)
+    names = ['1G%06d-%06d' % (rng.integers(0, 10 ** 6), number) for number in range(bubbles)]
+    bubble_dict = dict((name, tuple(rng.uniform(-1, 1, 6))) for name in names)
+
+    entries = []
+    for name in names:
+        kind = rng.integers(0, 4)
+        if kind in (1, 3):
+            entries.append(name)
+        if kind in (2, 3):
+            entries.append(name + "_control")
+    entries += ['stray%d' % number for number in range(10)]
+    entries = [entries[index] for index in rng.permutation(len(entries))]
+
+    cutout_dict = dict((entry, ('image of ' + entry, rng.integers(1, 300), rng.random(),
+                                (1, 2), (0.5, 0.5))) for entry in entries)
+
+    return bubble_dict, cutout_dict
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_dict_adjust_matches_nested_loop(seed):
+
+    bubble_dict, cutout_dict = random_dicts(seed)
+
+    joined = dict_adjust(bubble_dict, cutout_dict)
+
+    assert list(joined.items()) == list(nested_loop_dict_adjust(bubble_dict, cutout_dict).items())
+
+
+def test_dict_adjust_first_match_wins():
+    '''
+    With a bubble and its control in the same dict, the loop stopped at the first
+    of the two, so only that one is kept
+    '''
+
+    bubble_dict = {'a': (1,) * 6, 'b': (2,) * 6}
+    cutout_dict = {'a_control': ('ac',), 'a': ('a',), 'b': ('b',), 'b_control': ('bc',)}
+
+    joined = dict_adjust(bubble_dict, cutout_dict)
+
+    assert joined == nested_loop_dict_adjust(bubble_dict, cutout_dict)
+    assert list(joined) == ['a_control', 'b']
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_merge_dicts_matches_loops(seed):
+
+    bubble_dict, cutout_dict = random_dicts(seed)
+    cutouts = dict_adjust(bubble_dict, dict((name, value) for name, value in cutout_dict.items()
+                                            if not name.endswith('_control')))
+    controls = dict_adjust(bubble_dict, dict((name, value) for name, value in cutout_dict.items()
+                                             if name.endswith('_control')))
+
+    merged = merge_dicts(cutouts, controls)
+
+    assert list(merged.items()) == list(nested_loop_merge_dicts(cutouts, controls).items())
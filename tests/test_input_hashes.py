@@ -0,0 +1,93 @@
+'''
+Input hashes of cutouts read from a pyramid level, when a tile next to the crop changes.
+'''
+
+import os
+
+import numpy as np
+import pytest
+
+from catalog import BubbleCatalog
+from cutout_pipeline import plan_input_hashes
+from cutout_stream import CutoutRecord
+from mosaic import ordered_tile_names
+from panorama_cache import tile_checksums
+from pyramid import PanoramaPyramid
+
+ROWS = 64
+MIN_ROWS = 8
+TARGET_SIZE = 8
+PARAMS = {'pad': 0, 'dim': [TARGET_SIZE, TARGET_SIZE, 3], 'hshift': 0, 'vshift': 0,
+          'layout': 'flat', 'pyramid': True}
+
+
+def write_tile(path, width, seed):
+
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    Image.fromarray(rng.integers(0, 256, (ROWS, width, 3), dtype=np.uint8)).save(path,
+                                                                                 quality=95)
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+
+    #The tiles are ordered right to left (see ordered_tile_names): tile2 is the first,
+    #and its right edge at column 46 is not on a level 2 block border
+    for k, width in enumerate((40, 40, 46)):
+        write_tile(str(tmp_path / ('tile%d.jpg' % k)), width, k)
+
+    return str(tmp_path)
+
+
+def hashes(data_dir, plan, use_pyramid=True):
+    '''
+    Returns:
+    ______________
+    (dict of {catalog position: (bubble_hash, control_hash)}, the pyramid)
+    '''
+
+    catalog = BubbleCatalog.from_arrays(['1G000000'], [10.0], [0.0], [0.01])
+    pyramid = PanoramaPyramid(data_dir, min_rows=MIN_ROWS, workers=1)
+
+    return (plan_input_hashes(catalog, plan, PARAMS, tile_checksums(data_dir),
+                              pyramid if use_pyramid else None, TARGET_SIZE), pyramid)
+
+
+def test_tile_past_the_crop_makes_it_stale(data_dir):
+
+    first, second = ordered_tile_names(data_dir)[:2]
+    assert first == 'tile2.jpg'
+
+    #The bubble crop ends at column 45, inside the first tile, and is read from level 2,
+    #whose last block [44, 48) reaches two columns into the second tile. The control
+    #crop lies inside the first tile at every level
+    bubble_borders = (13, 45, 10, 42)
+    control_borders = (0, 32, 16, 48)
+    record = CutoutRecord(0, '1G000000', 16, 0.5, (29, 26), (16, 32), (10.0, 0.0))
+    plan = [(record, bubble_borders, control_borders)]
+
+    before, pyramid = hashes(data_dir, plan)
+    level = pyramid.level_for(bubble_borders[1] - bubble_borders[0], TARGET_SIZE)
+    assert level == 2
+    assert pyramid.source_borders_for(bubble_borders, TARGET_SIZE)[1] == 48
+    crop = np.array(pyramid.extract_for(bubble_borders, TARGET_SIZE))
+    plain, pyramid = hashes(data_dir, plan, use_pyramid=False)
+
+    #Change only the tile right of the crop: same size, other pixels
+    path = os.path.join(data_dir, second)
+    write_tile(path, 40, 99)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    after, pyramid = hashes(data_dir, plan)
+    changed = np.array(pyramid.extract_for(bubble_borders, TARGET_SIZE))
+
+    #The level 2 crop really changed, so its cutout must be regenerated
+    assert (changed != crop).any()
+    assert after[0][0] != before[0][0]
+    assert after[0][1] == before[0][1]
+
+    #Read from level 0, the same crop does not depend on the second tile
+    assert hashes(data_dir, plan, use_pyramid=False)[0] == plain
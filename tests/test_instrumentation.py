@@ -0,0 +1,43 @@
+'''
+The RSS high-water mark of the process is only reset when a run asks for it.
+'''
+
+import instrumentation
+from instrumentation import Instrumentation
+
+
+def test_no_reset_by_default(monkeypatch):
+
+    def reset():
+        raise AssertionError('the RSS high-water mark was reset')
+
+    monkeypatch.setattr(instrumentation, 'reset_rss_high_water', reset)
+
+    run = Instrumentation()
+    with run.stage('outer'):
+        with run.stage('inner'):
+            pass
+
+    assert [stage['stage'] for stage in run.stages] == ['inner', 'outer']
+    assert all('cumulative_peak_rss_mb' in stage and 'peak_rss_mb' not in stage
+               for stage in run.stages)
+    assert run.report()['stage_peak_rss'] is False
+
+
+def test_stage_peak_rss(monkeypatch):
+
+    #The high-water marks read at: outer start, inner start, inner end, outer end, report
+    marks = [300.0, 250.0, 20.0, 30.0, 30.0]
+    resets = []
+    monkeypatch.setattr(instrumentation, 'reset_rss_high_water', lambda: resets.append(1) or True)
+    monkeypatch.setattr(instrumentation, 'rss_high_water_mb', lambda: marks.pop(0))
+
+    run = Instrumentation(stage_peak_rss=True)
+    with run.stage('outer'):
+        with run.stage('inner'):
+            pass
+
+    assert len(resets) == 2
+    #The enclosing stage keeps the peak it saw before the inner stage reset the mark
+    assert [stage['peak_rss_mb'] for stage in run.stages] == [20.0, 250.0]
+    assert run.process_peak_rss_mb() >= 300.0
@@ -0,0 +1,146 @@
+'''
+An incremental cutout run that is interrupted part way and started again.
+'''
+
+import os
+
+import numpy as np
+import pytest
+
+import cutout_pipeline
+from catalog import BubbleCatalog
+from coords import GLON_RANGE
+from dataset import CutoutDataset, write_metadata
+from manifest import CutoutManifest
+
+DIM = (32, 32, 3)
+BUBBLES = 60
+
+
+@pytest.fixture
+def survey():
+    '''
+    Returns:
+    ______________
+    (catalog, panorama) of a small random survey
+    '''
+
+    rng = np.random.default_rng(0)
+    ids = ['1G%06d' % number for number in range(BUBBLES)]
+    glon = rng.uniform(GLON_RANGE[1], GLON_RANGE[0], BUBBLES) % 360
+    glat = rng.uniform(-0.8, 0.8, BUBBLES)
+    #Log-uniform radii between 0.2 and 2 arcminutes
+    reff = np.exp(rng.uniform(np.log(0.2), np.log(2.0), BUBBLES)) / 60
+    catalog = BubbleCatalog.from_arrays(ids, glon, glat, reff,
+                                        hitrate=rng.uniform(0, 1, BUBBLES))
+    panorama = rng.integers(0, 256, (600, 4300, 3), dtype=np.uint8)
+    catalog.convert(panorama)
+
+    return catalog, panorama
+
+
+def run(catalog, panorama, work_dir, monkeypatch, fail_after=None):
+    '''
+    Returns:
+    ______________
+    (pairs resized, pairs saved); pairs saved is None when the run was interrupted
+    after fail_after pairs were recorded in the manifest
+    '''
+
+    resized = []
+    resize_regions = cutout_pipeline.resize_regions
+    record_cutouts = cutout_pipeline.record_cutouts
+
+    def counting_resize(*args, **kwargs):
+        resized.append(1)
+        return resize_regions(*args, **kwargs)
+
+    def failing_record(manifest, hashes, item):
+        if fail_after is not None and len(manifest.entries) >= 2 * fail_after:
+            raise RuntimeError('simulated interruption')
+        return record_cutouts(manifest, hashes, item)
+
+    monkeypatch.setattr(cutout_pipeline, 'resize_regions', counting_resize)
+    monkeypatch.setattr(cutout_pipeline, 'record_cutouts', failing_record)
+
+    save_dir = os.path.join(work_dir, 'cutouts')
+    dataset_dir = os.path.join(work_dir, 'dataset')
+    manifest = CutoutManifest(save_dir)
+    try:
+        saved = cutout_pipeline.run_cutout_pipeline(catalog, panorama, save_dir, dim=DIM,
+                                                    dataset_dir=dataset_dir, manifest=manifest,
+                                                    resize_processes=False, encode_workers=1)
+    except RuntimeError:
+        return (len(resized), None)
+    finally:
+        manifest.close()
+        monkeypatch.undo()
+
+    write_metadata(dataset_dir, catalog, saved, dim=DIM)
+
+    return (len(resized), len(saved))
+
+
+def outputs(work_dir):
+    '''
+    Returns:
+    ______________
+    (dataset images, {JPEG name: bytes}) of a run
+    '''
+
+    images = np.array(CutoutDataset(os.path.join(work_dir, 'dataset')).images)
+    jpegs = {}
+    for root, dirs, names in os.walk(os.path.join(work_dir, 'cutouts')):
+        for name in names:
+            if name.endswith('.jpg'):
+                with open(os.path.join(root, name), 'rb') as jpeg:
+                    jpegs[name] = jpeg.read()
+
+    return images, jpegs
+
+
+def test_interrupted_run_resumes(survey, tmp_path, monkeypatch):
+
+    catalog, panorama = survey
+    resumed_dir = str(tmp_path / 'resumed')
+    fresh_dir = str(tmp_path / 'fresh')
+
+    interrupted, saved = run(catalog, panorama, resumed_dir, monkeypatch, fail_after=10)
+    assert saved is None
+
+    resumed, saved = run(catalog, panorama, resumed_dir, monkeypatch)
+    assert saved > 10
+    #The pairs recorded before the interruption are not cut again
+    assert resumed <= saved - 10
+
+    again, saved_again = run(catalog, panorama, resumed_dir, monkeypatch)
+    assert (again, saved_again) == (0, saved)
+
+    fresh, fresh_saved = run(catalog, panorama, fresh_dir, monkeypatch)
+    assert (fresh, fresh_saved) == (saved, saved)
+
+    resumed_images, resumed_jpegs = outputs(resumed_dir)
+    fresh_images, fresh_jpegs = outputs(fresh_dir)
+    np.testing.assert_array_equal(resumed_images, fresh_images)
+    assert resumed_jpegs == fresh_jpegs
+    assert len(resumed_jpegs) == 2 * saved
+
+
+def test_dataset_without_manifest(survey, tmp_path, monkeypatch):
+
+    catalog, panorama = survey
+    work_dir = str(tmp_path / 'plain')
+    save_dir = os.path.join(work_dir, 'cutouts')
+    dataset_dir = os.path.join(work_dir, 'dataset')
+
+    incremental, saved = run(catalog, panorama, str(tmp_path / 'incremental'), monkeypatch)
+    plain = cutout_pipeline.run_cutout_pipeline(catalog, panorama, save_dir, dim=DIM,
+                                                dataset_dir=dataset_dir, resize_processes=False,
+                                                encode_workers=1)
+    write_metadata(dataset_dir, catalog, plain, dim=DIM)
+
+    assert len(plain) == saved
+    plain_images, plain_jpegs = outputs(work_dir)
+    incremental_images, incremental_jpegs = outputs(str(tmp_path / 'incremental'))
+    np.testing.assert_array_equal(plain_images, incremental_images)
+    assert plain_jpegs == incremental_jpegs
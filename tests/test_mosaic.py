@@ -0,0 +1,95 @@
+'''
+TileMosaic slicing against np.concatenate of its tiles.
+'''
+
+import numpy as np
+import pytest
+
+from mosaic import TileMosaic
+
+#Odd tile widths, so runs of columns start and end at every offset inside a tile
+TILE_WIDTHS = (7, 13, 1, 10, 9)
+ROWS = 11
+
+
+@pytest.fixture
+def tiles():
+
+    rng = np.random.default_rng(0)
+
+    return dict(('tile%d.jpg' % k, rng.integers(0, 256, (ROWS, width, 3), dtype=np.uint8))
+                for k, width in enumerate(TILE_WIDTHS))
+
+
+def make_mosaic(tiles, cache_size=2):
+    '''
+    Returns:
+    ______________
+    (TileMosaic over the tiles, decoded from memory, the concatenated panorama)
+    '''
+
+    names = sorted(tiles)
+    mosaic = TileMosaic(names, [tiles[name].shape for name in names], cache_size=cache_size,
+                        loader=tiles.__getitem__)
+
+    return mosaic, np.concatenate([tiles[name] for name in names], axis=1)
+
+
+def test_slices_match_concatenate(tiles):
+
+    mosaic, panorama = make_mosaic(tiles)
+    assert mosaic.shape == panorama.shape
+    assert len(mosaic) == ROWS
+
+    cols = panorama.shape[1]
+    column_slices = [slice(None), slice(0, cols), slice(5, 8), slice(6, 21), slice(20, 21),
+                     slice(19, 31), slice(3, 37), slice(-12, -2), slice(-40, 15), slice(30, 100),
+                     slice(8, 8), slice(15, 5), slice(None, None, 2), slice(1, 35, 3),
+                     slice(-3, 2, -1), slice(None, None, -1), slice(33, 4, -4), slice(21, 20),
+                     slice(-1, None)]
+    row_slices = [slice(None), slice(2, 9), slice(-4, None), slice(None, None, 3),
+                  slice(8, 1, -2), slice(5, 5)]
+
+    for row_key in row_slices:
+        for col_key in column_slices:
+            key = (row_key, col_key)
+            np.testing.assert_array_equal(mosaic[key], panorama[key], err_msg=str(key))
+            key = (row_key, col_key, slice(1, None))
+            np.testing.assert_array_equal(mosaic[key], panorama[key], err_msg=str(key))
+
+
+def test_integer_indices(tiles):
+
+    mosaic, panorama = make_mosaic(tiles)
+
+    for key in [(0, 0), (-1, -1), (3, 20), (4, slice(5, 25)), (slice(1, 4), 7), (5, 30, 2),
+                (slice(None), -9, 1), 4, -2]:
+        np.testing.assert_array_equal(mosaic[key], panorama[key], err_msg=str(key))
+
+    with pytest.raises(IndexError):
+        mosaic[0, panorama.shape[1]]
+    with pytest.raises(IndexError):
+        mosaic[-ROWS - 1, 0]
+
+
+def test_eviction_keeps_results(tiles):
+
+    #Every slice below touches more tiles than the cache holds
+    mosaic, panorama = make_mosaic(tiles, cache_size=1)
+
+    for left in range(0, panorama.shape[1], 3):
+        key = (slice(None), slice(left, None), slice(None))
+        np.testing.assert_array_equal(mosaic[key], panorama[key])
+    assert len(mosaic._cache) == 1
+
+
+def test_tiles_for_columns(tiles):
+
+    mosaic, panorama = make_mosaic(tiles)
+    offsets = np.cumsum((0,) + TILE_WIDTHS)
+
+    for left in range(panorama.shape[1]):
+        for right in range(left, panorama.shape[1] + 1):
+            expected = [k for k in range(len(TILE_WIDTHS)) if right > left
+                        and offsets[k] < right and offsets[k + 1] > left]
+            assert list(mosaic.tiles_for_columns(left, right)) == expected
@@ -0,0 +1,105 @@
+'''
+Invalidation of the panorama cache when the source tiles change.
+'''
+
+import os
+
+import numpy as np
+import pytest
+
+import panorama_cache
+from mosaic import ordered_tile_names, read_tile
+from panorama_cache import PANORAMA_CACHE_NAME, open_panorama_cache, read_cache_header
+
+ROWS = 24
+
+
+def write_tile(path, width, seed):
+
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    Image.fromarray(rng.integers(0, 256, (ROWS, width, 3), dtype=np.uint8)).save(path,
+                                                                                 quality=95)
+
+
+def stitched(data_dir):
+    '''
+    Returns:
+    ______________
+    the decoded tiles of data_dir side by side, in spatial order
+    '''
+
+    return np.concatenate([read_tile(os.path.join(data_dir, name))
+                           for name in ordered_tile_names(data_dir)], axis=1)
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+
+    for k, width in enumerate((16, 24, 8)):
+        write_tile(str(tmp_path / ('tile%d.jpg' % k)), width, k)
+
+    return str(tmp_path)
+
+
+def test_cache_is_reused(data_dir, monkeypatch):
+
+    panorama = open_panorama_cache(data_dir)
+    np.testing.assert_array_equal(panorama, stitched(data_dir))
+    assert read_cache_header(os.path.join(data_dir, PANORAMA_CACHE_NAME)) is not None
+
+    #An unchanged cache opens without decoding a tile
+    def no_rebuild(*args, **kwargs):
+        raise AssertionError('an up to date cache was rebuilt')
+
+    monkeypatch.setattr(panorama_cache, 'build_panorama_cache', no_rebuild)
+    np.testing.assert_array_equal(open_panorama_cache(data_dir), panorama)
+    np.testing.assert_array_equal(open_panorama_cache(data_dir, rebuild=False), panorama)
+
+
+@pytest.mark.parametrize('change', ['replace', 'touch', 'add', 'remove'])
+def test_changed_tiles_invalidate_the_cache(data_dir, change):
+
+    old = np.array(open_panorama_cache(data_dir))
+    path = os.path.join(data_dir, 'tile1.jpg')
+
+    if change == 'replace':
+        #Another size and content
+        write_tile(path, 32, 10)
+    elif change == 'touch':
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    elif change == 'add':
+        write_tile(os.path.join(data_dir, 'tile3.jpg'), 12, 11)
+    else:
+        os.remove(path)
+
+    with pytest.raises(IOError):
+        open_panorama_cache(data_dir, rebuild=False)
+
+    panorama = open_panorama_cache(data_dir)
+    expected = stitched(data_dir)
+    np.testing.assert_array_equal(panorama, expected)
+    if change == 'touch':
+        np.testing.assert_array_equal(panorama, old)
+    else:
+        assert panorama.shape != old.shape
+
+    #The rebuilt cache is current again
+    np.testing.assert_array_equal(open_panorama_cache(data_dir, rebuild=False), expected)
+
+
+def test_interrupted_cache_is_rebuilt(data_dir):
+
+    cache_path = os.path.join(data_dir, PANORAMA_CACHE_NAME)
+    expected = np.array(open_panorama_cache(data_dir))
+
+    #A build that stopped part way leaves a file shorter than its header says
+    with open(cache_path, 'r+b') as cache_file:
+        cache_file.truncate(os.path.getsize(cache_path) - 100)
+    assert read_cache_header(cache_path) is None
+
+    with pytest.raises(IOError):
+        open_panorama_cache(data_dir, rebuild=False)
+    np.testing.assert_array_equal(open_panorama_cache(data_dir), expected)
@@ -0,0 +1,139 @@
+'''
+The pyramid levels and crops against 2x2 block averages of the stitched tiles, and
+the MosaicPyramid of the same tiles against the PanoramaPyramid.
+'''
+
+import os
+
+import numpy as np
+import pytest
+
+from mosaic import TileMosaic, ordered_tile_names, read_tile
+from pyramid import MosaicPyramid, PanoramaPyramid
+
+#Odd tile widths and rows, so every level drops a last row or column somewhere
+TILE_WIDTHS = (45, 63, 29, 51)
+ROWS = 77
+MIN_ROWS = 8
+
+
+def reference_levels(panorama):
+    '''
+    Returns:
+    ______________
+    list of the pyramid levels of panorama, every one the rounded mean of the
+    2x2 blocks of the one before, as long as it keeps MIN_ROWS rows
+    '''
+
+    levels = [np.asarray(panorama)]
+    while levels[-1].shape[0] // 2 >= MIN_ROWS:
+        level = levels[-1].astype(np.uint16)
+        rows, cols = level.shape[0] // 2 * 2, level.shape[1] // 2 * 2
+        level = level[:rows, :cols]
+        blocks = level[0::2, 0::2] + level[1::2, 0::2] + level[0::2, 1::2] + level[1::2, 1::2]
+        levels.append(((blocks + 2) // 4).astype(np.uint8))
+
+    return levels
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+
+    from PIL import Image
+
+    rng = np.random.default_rng(0)
+    for k, width in enumerate(TILE_WIDTHS):
+        tile = rng.integers(0, 256, (ROWS, width, 3), dtype=np.uint8)
+        Image.fromarray(tile).save(str(tmp_path / ('tile%d.jpg' % k)), quality=95)
+
+    return str(tmp_path)
+
+
+def stitched(data_dir):
+
+    return np.concatenate([read_tile(os.path.join(data_dir, name))
+                           for name in ordered_tile_names(data_dir)], axis=1)
+
+
+def crop_borders(rng, shape, count):
+    '''
+    Returns:
+    ______________
+    list of (left, right, top, bot) square crops of every size inside shape,
+    at random (odd and even) positions
+    '''
+
+    borders = []
+    for size in rng.integers(1, shape[0], count):
+        left = int(rng.integers(0, shape[1] - size + 1))
+        top = int(rng.integers(0, shape[0] - size + 1))
+        borders.append((left, left + int(size), top, top + int(size)))
+
+    return borders
+
+
+def test_levels_match_block_averages(data_dir):
+
+    pyramid = PanoramaPyramid(data_dir, min_rows=MIN_ROWS, workers=1)
+    levels = reference_levels(stitched(data_dir))
+
+    assert len(pyramid) == len(levels) > 2
+    for level, expected in enumerate(levels):
+        assert pyramid[level].shape == expected.shape
+        np.testing.assert_array_equal(pyramid[level], expected)
+
+    #The levels are reopened from their files, not rebuilt
+    again = PanoramaPyramid(data_dir, rebuild=False, min_rows=MIN_ROWS)
+    for level, expected in enumerate(levels):
+        np.testing.assert_array_equal(again[level], expected)
+
+
+def test_extract_for_reads_the_matching_level(data_dir):
+
+    pyramid = PanoramaPyramid(data_dir, min_rows=MIN_ROWS, workers=1)
+    levels = reference_levels(stitched(data_dir))
+    rng = np.random.default_rng(1)
+    used = set()
+
+    for target_size in (4, 9, 16):
+        for borders in crop_borders(rng, pyramid.shape, 200):
+            left, right, top, bot = borders
+            level = pyramid.level_for(right - left, target_size)
+            scale = 2 ** level
+            used.add(level)
+
+            #The level still has target_size pixels across the crop, the next one has not
+            assert level == 0 or (right - left) // scale >= target_size
+            assert level == len(pyramid) - 1 or (right - left) // (2 * scale) < target_size
+
+            expected = levels[level][top // scale:-(-bot // scale),
+                                     left // scale:-(-right // scale)]
+            np.testing.assert_array_equal(pyramid.extract_for(borders, target_size), expected)
+            np.testing.assert_array_equal(pyramid.extract(borders, level), expected)
+
+    assert used == set(range(len(pyramid)))
+
+
+def test_mosaic_pyramid_matches_panorama_pyramid(data_dir):
+
+    pyramid = PanoramaPyramid(data_dir, min_rows=MIN_ROWS, workers=1)
+    rng = np.random.default_rng(2)
+    borders = crop_borders(rng, pyramid.shape, 300)
+
+    #Over the lazily decoded tiles, and over the level 0 memmap as on a shard node
+    for level_zero in (TileMosaic.from_directory(data_dir), pyramid[0]):
+        mosaic = MosaicPyramid(level_zero, min_rows=MIN_ROWS)
+        assert len(mosaic) == len(pyramid)
+        assert mosaic.shape == pyramid.shape
+
+        for level in range(len(pyramid)):
+            for crop in borders:
+                np.testing.assert_array_equal(mosaic.extract(crop, level),
+                                              pyramid.extract(crop, level),
+                                              err_msg=str((crop, level)))
+        for target_size in (4, 9, 16):
+            for crop in borders:
+                np.testing.assert_array_equal(mosaic.extract_for(crop, target_size),
+                                              pyramid.extract_for(crop, target_size))
+                assert (mosaic.source_borders_for(crop, target_size) ==
+                        pyramid.source_borders_for(crop, target_size))
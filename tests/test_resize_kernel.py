@@ -0,0 +1,53 @@
+'''
+The batched resize kernels against skimage.transform.resize.
+'''
+
+import numpy as np
+import pytest
+
+from cutout_pipeline import resize_region_batch, resize_regions
+from cutout_stream import CutoutRecord
+from resize_kernel import resize_batch
+
+#Largest difference allowed between the linear kernel and skimage, on the [0, 1] scale
+#of the float outputs. Both compute the same weights, only in float32 instead of float64
+LINEAR_TOLERANCE = 1e-5
+
+#Odd crop sizes, downsampled (as the pyramid crops are) and upsampled (small bubbles)
+SOURCE_SHAPES = [(37, 53, 3), (61, 45, 3), (225, 301, 3), (449, 451, 3), (21, 19, 3)]
+
+
+@pytest.mark.parametrize('shape', SOURCE_SHAPES)
+@pytest.mark.parametrize('dim', [(32, 32, 3), (45, 29, 3)])
+def test_linear_matches_skimage(shape, dim):
+
+    from skimage.transform import resize
+
+    crop = np.random.default_rng(shape[0]).integers(0, 256, shape, dtype=np.uint8)
+
+    expected = resize(crop, dim)
+    resized = resize_batch([crop], dim, 'linear')[0]
+
+    assert resized.dtype == np.float32
+    assert resized.shape == dim
+    np.testing.assert_allclose(resized, expected, rtol=0, atol=LINEAR_TOLERANCE)
+
+
+def test_batch_matches_pairs():
+
+    rng = np.random.default_rng(0)
+    batch = []
+    #Several pairs share a crop size, so the batch groups crops of different pairs
+    for position, side in enumerate([40, 57, 40, 63, 57, 40]):
+        record = CutoutRecord(position, 'bubble%d' % position, side / 2.0, 1.0, (0, 0), (0, 0),
+                              (0.0, 0.0))
+        batch.append((record, rng.integers(0, 256, (side, side, 3), dtype=np.uint8),
+                      rng.integers(0, 256, (side, side, 3), dtype=np.uint8)))
+
+    for kernel in ('linear', 'area'):
+        resized = resize_region_batch((32, 32, 3), np.uint8, batch, kernel)
+        assert [item[0] for item in resized] == [item[0] for item in batch]
+        for item, result in zip(batch, resized):
+            expected = resize_regions((32, 32, 3), np.uint8, item, kernel)
+            np.testing.assert_array_equal(result[1], expected[1])
+            np.testing.assert_array_equal(result[2], expected[2])
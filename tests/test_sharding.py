@@ -0,0 +1,78 @@
+'''
+A sharded run merged back together against the single-node run of the same plan.
+'''
+
+import filecmp
+import os
+import pickle
+
+import numpy as np
+
+import sharding
+from benchmark import make_synthetic_survey
+from cutoutgen import run_cutoutgen
+from dataset import CutoutDataset
+
+DIM = (32, 32, 3)
+
+
+def jpeg_names(save_dir):
+    '''
+    Returns:
+    ______________
+    sorted list of the JPEG paths under save_dir, relative to it
+    '''
+
+    names = []
+    for root, dirs, files in os.walk(save_dir):
+        names.extend(os.path.relpath(os.path.join(root, name), save_dir)
+                     for name in files if name.endswith('.jpg'))
+
+    return sorted(names)
+
+
+def test_merged_shards_equal_single_node_run(tmp_path, monkeypatch):
+
+    data_dir = str(tmp_path / 'data')
+    catalog_path = make_synthetic_survey(data_dir, tile_width=120, bubbles=40, rows=600, seed=1)
+
+    #Both runs write relative paths from a directory of their own, so the pickles compare equal
+    sharded_dir = tmp_path / 'sharded'
+    single_dir = tmp_path / 'single'
+    sharded_dir.mkdir()
+    single_dir.mkdir()
+
+    monkeypatch.chdir(sharded_dir)
+    sharding.plan_shards(data_dir, shards=3, work_dir='shards', pad=20, dim=DIM,
+                         catalog_path=catalog_path)
+    plan_path = os.path.join('shards', sharding.SHARD_PLAN)
+    plan = sharding.load_plan(plan_path)
+    assert len(plan['shards']) == 3
+    for entry in plan['shards']:
+        sharding.run_shard(plan_path, entry['shard'], load_workers=1, resize_workers=1,
+                           encode_workers=1)
+    sharding.merge_shards(plan_path)
+
+    monkeypatch.chdir(single_dir)
+    catalog = sharding.load_catalog(catalog_path, plan['shape'])
+    controls = sharding.shard_controls(catalog, plan['shape'], plan['params'], plan['shards'])
+    run_cutoutgen(data_dir, pad=20, dim=DIM, catalog_path=catalog_path,
+                  resize_workers=1, encode_workers=1, controls=controls)
+
+    names = jpeg_names(str(single_dir / 'cutouts'))
+    assert names
+    assert jpeg_names(str(sharded_dir / 'cutouts')) == names
+    for name in names:
+        assert filecmp.cmp(str(single_dir / 'cutouts' / name), str(sharded_dir / 'cutouts' / name),
+                           shallow=False), name
+
+    single = CutoutDataset(str(single_dir / 'dataset'))
+    merged = CutoutDataset(str(sharded_dir / 'dataset'))
+    np.testing.assert_array_equal(np.array(merged.images), np.array(single.images))
+    for name in sorted(os.listdir(str(single_dir / 'dataset'))):
+        assert filecmp.cmp(str(single_dir / 'dataset' / name), str(sharded_dir / 'dataset' / name),
+                           shallow=False), name
+
+    with open(str(single_dir / 'gregs_data.pck'), 'rb') as single_pickle:
+        with open(str(sharded_dir / 'gregs_data.pck'), 'rb') as merged_pickle:
+            assert pickle.load(merged_pickle) == pickle.load(single_pickle)
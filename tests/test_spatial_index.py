@@ -0,0 +1,228 @@
+'''
+The SpatialIndex queries against brute-force checks of every circle.
+'''
+
+import numpy as np
+import pytest
+
+from spatial_index import SpatialIndex
+
+
+def brute_force_overlapping(x, y, radius, query_x, query_y, query_radius, exclude=None):
+    '''
+    Returns:
+    ______________
+    bool array; for every query circle, whether it intersects one of the finite circles
+    '''
+
+    finite = np.isfinite(x) & np.isfinite(y) & np.isfinite(radius)
+    distance = ((query_x[:, None] - x[None, :]) ** 2 + (query_y[:, None] - y[None, :]) ** 2)
+    touches = (distance < (query_radius[:, None] + radius[None, :]) ** 2) & finite[None, :]
+    if exclude is not None:
+        touches &= np.arange(len(x))[None, :] != np.asarray(exclude)[:, None]
+
+    return touches.any(axis=1)
+
+
+def random_circles(rng, count, width=20000.0, height=1500.0, max_radius=300.0):
+
+    return (rng.uniform(0, width, count), rng.uniform(0, height, count),
+            np.exp(rng.uniform(np.log(3), np.log(max_radius), count)))
+
+
+@pytest.mark.parametrize('seed, cell_size', [(0, None), (1, None), (2, 50.0), (3, 2000.0)])
+def test_overlapping_matches_brute_force(seed, cell_size):
+
+    rng = np.random.default_rng(seed)
+    x, y, radius = random_circles(rng, 400)
+    index = SpatialIndex(x, y, radius, cell_size=cell_size)
+
+    #Queries also reach outside the indexed extent
+    query_x, query_y, query_radius = random_circles(rng, 3000)
+    query_x = query_x * 1.2 - 2000
+    query_y = query_y * 1.4 - 300
+
+    expected = brute_force_overlapping(x, y, radius, query_x, query_y, query_radius)
+
+    np.testing.assert_array_equal(index.overlapping(query_x, query_y, query_radius), expected)
+    assert 0 < expected.sum() < len(expected)
+
+
+def test_overlapping_exclude():
+    '''
+    The indexed circles themselves as queries, each ignoring its own position
+    '''
+
+    rng = np.random.default_rng(4)
+    x, y, radius = random_circles(rng, 500, max_radius=150.0)
+    index = SpatialIndex(x, y, radius)
+    exclude = np.arange(len(x))
+
+    expected = brute_force_overlapping(x, y, radius, x, y, radius, exclude)
+
+    np.testing.assert_array_equal(index.overlapping(x, y, radius, exclude=exclude), expected)
+    assert index.overlapping(x, y, radius).all()
+
+
+def test_overlapping_skips_non_finite_circles():
+
+    rng = np.random.default_rng(5)
+    x, y, radius = random_circles(rng, 300)
+    x[::7] = np.nan
+    radius[3::11] = np.inf
+    index = SpatialIndex(x, y, radius)
+
+    query_x, query_y, query_radius = random_circles(rng, 2000)
+    expected = brute_force_overlapping(x, y, radius, query_x, query_y, query_radius)
+
+    np.testing.assert_array_equal(index.overlapping(query_x, query_y, query_radius), expected)
+
+
+def test_overlapping_touching_circles_do_not_overlap():
+
+    index = SpatialIndex([0.0, 100.0], [0.0, 0.0], [10.0, 10.0])
+
+    hit = index.overlapping([50.0, 50.0, 30.0], [0.0, 0.0, 0.0], [40.0, 40.0001, 10.0])
+
+    np.testing.assert_array_equal(hit, [False, True, False])
+
+
+def test_overlapping_empty():
+
+    index = SpatialIndex([], [], [])
+
+    assert index.overlapping([1.0], [2.0], [3.0]).tolist() == [False]
+    assert SpatialIndex([1.0], [2.0], [3.0]).overlapping([], [], []).shape == (0,)
+
+
+def brute_force_window(x, y, radius, xmin, xmax, ymin, ymax, overlap=False):
+
+    finite = np.isfinite(x) & np.isfinite(y) & np.isfinite(radius)
+    if overlap:
+        dx = np.maximum(np.maximum(xmin - x, x - xmax), 0)
+        dy = np.maximum(np.maximum(ymin - y, y - ymax), 0)
+        keep = dx * dx + dy * dy <= radius ** 2
+    else:
+        keep = (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+
+    return np.flatnonzero(keep & finite)
+
+
+def brute_force_within(x, y, radius, query_x, query_y, distance, overlap=False):
+
+    finite = np.isfinite(x) & np.isfinite(y) & np.isfinite(radius)
+    reach = distance + radius if overlap else distance
+
+    return np.flatnonzero(((x - query_x) ** 2 + (y - query_y) ** 2 <= reach ** 2) & finite)
+
+
+def grid_circles():
+    '''
+    Returns:
+    ______________
+    (x, y, radius); circles centered on the corners of a 100 pixel grid and at
+    random whole pixels, with the cells around (1000, 400) left empty, and a few
+    non-finite ones
+    '''
+
+    rng = np.random.default_rng(6)
+    corners_x, corners_y = np.meshgrid(np.arange(0, 2001, 100.0), np.arange(0, 801, 100.0))
+    x = np.concatenate([corners_x.ravel(), rng.uniform(0, 2000, 200).round()])
+    y = np.concatenate([corners_y.ravel(), rng.uniform(0, 800, 200).round()])
+    #Leave the cells around (1000, 400) empty
+    keep = (np.abs(x - 1000) > 250) | (np.abs(y - 400) > 250)
+    x = np.concatenate([x[keep], [np.nan, 30.0]])
+    y = np.concatenate([y[keep], [50.0, np.nan]])
+    radius = rng.uniform(1, 120, len(x)).round()
+    radius[5] = np.inf
+
+    return x, y, radius
+
+
+@pytest.mark.parametrize('cell_size', [None, 100.0, 37.0])
+def test_window_matches_brute_force(cell_size):
+
+    x, y, radius = grid_circles()
+    index = SpatialIndex(x, y, radius, cell_size=cell_size)
+    rng = np.random.default_rng(7)
+
+    #Bounds on the cell borders, random bounds, an empty cell and windows outside the extent
+    windows = [(300, 700, 100, 400), (0, 2000, 0, 800), (900, 1100, 300, 500),
+               (950, 1050, 350, 450), (-500, -10, 0, 800), (2100, 2500, 900, 1000),
+               (100, 100, 200, 200)]
+    windows += [tuple(np.sort(rng.uniform(-200, 2200, 2)).tolist() +
+                      np.sort(rng.uniform(-200, 1000, 2)).tolist()) for k in range(100)]
+
+    for xmin, xmax, ymin, ymax in windows:
+        for overlap in (False, True):
+            np.testing.assert_array_equal(
+                index.window(xmin, xmax, ymin, ymax, overlap=overlap),
+                brute_force_window(x, y, radius, xmin, xmax, ymin, ymax, overlap),
+                err_msg=str((xmin, xmax, ymin, ymax, overlap)))
+
+    #Swapped bounds describe the same window
+    np.testing.assert_array_equal(index.window(700, 300, 400, 100),
+                                  index.window(300, 700, 100, 400))
+    assert len(index.window(950, 1050, 350, 450)) == 0
+
+
+@pytest.mark.parametrize('cell_size', [None, 100.0, 37.0])
+def test_within_matches_brute_force(cell_size):
+
+    x, y, radius = grid_circles()
+    index = SpatialIndex(x, y, radius, cell_size=cell_size)
+    rng = np.random.default_rng(8)
+
+    #Centers on cell corners with distances that end on other corners, and random ones
+    queries = [(500.0, 300.0, 100.0), (500.0, 300.0, 200.0), (1000.0, 400.0, 50.0),
+               (1000.0, 400.0, 300.0), (0.0, 0.0, 0.0), (-300.0, -300.0, 100.0)]
+    queries += list(zip(rng.uniform(-200, 2200, 100), rng.uniform(-200, 1000, 100),
+                        rng.uniform(0, 400, 100)))
+
+    for query_x, query_y, distance in queries:
+        for overlap in (False, True):
+            np.testing.assert_array_equal(
+                index.within(query_x, query_y, distance, overlap=overlap),
+                brute_force_within(x, y, radius, query_x, query_y, distance, overlap),
+                err_msg=str((query_x, query_y, distance, overlap)))
+
+    #Nothing in the empty cells, and the corner points are found at distance zero
+    assert len(index.within(1000.0, 400.0, 50.0)) == 0
+    assert index.within(0.0, 0.0, 0.0).tolist() == [0]
+
+
+@pytest.mark.parametrize('cell_size', [None, 100.0, 37.0])
+def test_nearest_matches_brute_force(cell_size):
+
+    x, y, radius = grid_circles()
+    index = SpatialIndex(x, y, radius, cell_size=cell_size)
+    finite = np.flatnonzero(np.isfinite(x) & np.isfinite(y) & np.isfinite(radius))
+    rng = np.random.default_rng(9)
+
+    #On a corner, in the middle of the empty cells, outside the extent, and random points
+    queries = [(500.0, 300.0), (1000.0, 400.0), (-400.0, 900.0), (2600.0, -100.0)]
+    queries += list(zip(rng.uniform(-200, 2200, 100), rng.uniform(-200, 1000, 100)))
+
+    for query_x, query_y in queries:
+        expected = np.sort(np.hypot(x[finite] - query_x, y[finite] - query_y))
+        for k in (1, 4, 25):
+            positions, distances = index.nearest(query_x, query_y, k)
+            #Points at the same distance can come in any order, so the distances are compared
+            np.testing.assert_allclose(distances, expected[:k], rtol=0, atol=1e-9)
+            np.testing.assert_allclose(np.hypot(x[positions] - query_x, y[positions] - query_y),
+                                       distances, rtol=0, atol=1e-9)
+            assert len(set(positions.tolist())) == k
+
+    #The exact corner is its own nearest point, and more than every point returns every point
+    assert index.nearest(500.0, 300.0)[1].tolist() == [0.0]
+    assert len(index.nearest(0.0, 0.0, k=10 * len(x))[0]) == len(finite)
+
+
+def test_queries_on_empty_index():
+
+    index = SpatialIndex([], [], [])
+
+    assert len(index.window(0, 1, 0, 1, overlap=True)) == 0
+    assert len(index.within(0.0, 0.0, 10.0)) == 0
+    positions, distances = index.nearest(0.0, 0.0, k=3)
+    assert len(positions) == len(distances) == 0
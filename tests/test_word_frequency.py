@@ -0,0 +1,97 @@
+'''
+The streaming word counts against the nested loop of the original word_frequency_barplot.
+'''
+
+import collections
+import concurrent.futures
+
+import numpy as np
+import pytest
+
+import word_frequency_barplot
+from word_frequency_barplot import count_words, top_words
+
+
+def loop_bars(mylist):
+    '''
+    Returns:
+    ______________
+    (plot_names, plot_frequencies) as the original word_frequency_barplot built
+    them, with a loop over set(mylist) x mylist
+    '''
+
+    frequency_dictionary = {}
+    for unique_name in list(set(mylist)):
+        frequency_counter = 0
+        for name in mylist:
+            if unique_name == name:
+                frequency_counter += 1
+        frequency_dictionary[unique_name] = frequency_counter
+
+    plot_names = sorted(frequency_dictionary, key=frequency_dictionary.get)
+    plot_frequencies = sorted(frequency_dictionary.values())
+    plot_names.reverse()
+    plot_frequencies.reverse()
+
+    return plot_names, plot_frequencies
+
+
+def assert_same_bars(frequencies, mylist):
+    '''
+    The bars of frequencies are the bars of the loop. Words with the same frequency
+    were drawn in the arbitrary order of set(mylist), so only their group is compared
+    '''
+
+    plot_names, plot_frequencies = loop_bars(mylist)
+
+    assert [frequency for name, frequency in frequencies] == plot_frequencies
+    expected = collections.defaultdict(set)
+    for name, frequency in zip(plot_names, plot_frequencies):
+        expected[frequency].add(name)
+    drawn = collections.defaultdict(set)
+    for name, frequency in frequencies:
+        drawn[frequency].add(name)
+    assert drawn == expected
+
+
+@pytest.fixture
+def words():
+
+    rng = np.random.default_rng(0)
+    names = ['bubble', 'control', 'ring', 'arc', 'shell', 'blob', 'void', 'star', 'hii', 'pdr']
+
+    return [names[k] for k in rng.zipf(1.5, 500) % len(names)]
+
+
+def test_small_list(words):
+
+    assert_same_bars(top_words(count_words(words, workers=1)), words)
+    assert_same_bars(top_words(count_words(words, workers=2, chunk_size=37)), words)
+
+
+def test_file_with_workers(words, tmp_path, monkeypatch):
+
+    path = tmp_path / 'labels.log'
+    path.write_text('\n'.join(' %s ' % word for word in words) + '\n\n')
+
+    #A small file is counted in this process, as one range
+    class NoPool(object):
+        def __init__(self, *args, **kwargs):
+            raise AssertionError('a small file started a process pool')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(concurrent.futures, 'ProcessPoolExecutor', NoPool)
+        assert_same_bars(top_words(count_words(str(path), workers=4)), words)
+
+    #Split into ranges over the workers, the lines crossing a range border count once
+    monkeypatch.setattr(word_frequency_barplot, 'MIN_RANGE_BYTES', 1)
+    assert_same_bars(top_words(count_words(str(path), workers=4)), words)
+    assert_same_bars(top_words(count_words(str(path), workers=1, chunk_bytes=100)), words)
+
+
+def test_top_k(words):
+
+    plot_names, plot_frequencies = loop_bars(words)
+    frequencies = top_words(count_words(words, workers=1), 3)
+
+    assert [frequency for name, frequency in frequencies] == plot_frequencies[:3]
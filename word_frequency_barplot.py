@@ -3,14 +3,197 @@
 #Purpose: plots word frequency from list as a barplot
 #
 #Date: July 20th, 2018
+#
+#The words are counted by a streaming map-reduce engine: the input (a list, any
+#iterable, or a file with one entry per line) is cut into chunks, every chunk is
+#counted with a Counter in a process pool, and the partial counts are merged in
+#the parent. Only the top k words are kept for the plot, selected with a heap.
+
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import operator
+import os
+
+#Entries per chunk when counting an iterable
+CHUNK_SIZE = 100000
+
+#Bytes per chunk when counting a file. Workers read their own byte range
+CHUNK_BYTES = 16 * 1024 ** 2
+
+#A file is not split over the workers into ranges smaller than this, so small
+#files are counted in this process, as one range
+MIN_RANGE_BYTES = 1024 ** 2
+
+
+def _count_chunk(words):
+    '''
+    Returns:
+    --------
+    Counter of the words of one chunk. Runs inside the worker processes
+    '''
+
+    return collections.Counter(words)
+
 
-def word_frequency_barplot(mylist, title):
-    
+def _count_file_range(path, start, stop):
+    '''
+    Returns:
+    --------
+    Counter of the stripped, non-empty lines (as bytes) that start in the byte
+    range [start, stop) of the file at path. Runs inside the worker processes
+    '''
+
+    counts = collections.Counter()
+
+    with open(path, 'rb') as word_file:
+        position = start
+        if start > 0:
+            #Finish the line that starts before the range; it belongs to the previous range
+            word_file.seek(start - 1)
+            position = start - 1 + len(word_file.readline())
+
+        def lines():
+            nonlocal position
+            for line in word_file:
+                if position >= stop:
+                    return
+                position += len(line)
+                line = line.strip()
+                if line:
+                    yield line
+
+        counts.update(lines())
+
+    return counts
+
+
+def _file_ranges(path, workers, chunk_bytes):
+    '''
+    Returns:
+    --------
+    list of (start, stop) byte ranges of the file at path: one per worker, but
+    at most chunk_bytes and, unless chunk_bytes is smaller, at least MIN_RANGE_BYTES
+    '''
+
+    size = os.path.getsize(path)
+    step = max(1, min(chunk_bytes, max(-(-size // max(workers, 1)), MIN_RANGE_BYTES)))
+
+    return [(start, min(start + step, size)) for start in range(0, size, step)]
+
+
+def count_words(source, workers=None, chunk_size=CHUNK_SIZE, chunk_bytes=CHUNK_BYTES,
+                encoding='utf-8'):
     '''
     Args:
     --------
-    mylist: list of strings
+    source: list or any iterable of strings, or the path of a text file with one
+            entry per line (surrounding whitespace and empty lines are dropped)
+    workers: int; processes counting the chunks, defaults to os.cpu_count().
+             1 counts in this process
+    chunk_size: int; entries per chunk of an iterable
+    chunk_bytes: int; bytes per chunk of a file
+    encoding: string; encoding of a file
+
+    Returns:
+    --------
+    collections.Counter of {word: frequency}, in order of first occurrence
+
+    Notes:
+    --------
+    An iterable is read lazily, with at most two chunks per worker in flight,
+    so memory stays flat no matter how long it is. A file is never sent to the
+    workers: each one reads its own byte range
+
+    Usage:
+    --------
+    counts = count_words('labels.log', workers=8)
+
+    '''
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if isinstance(source, (str, bytes, os.PathLike)):
+        ranges = _file_ranges(source, workers, chunk_bytes)
+        if workers == 1 or len(ranges) < 2:
+            partials = (_count_file_range(source, start, stop) for start, stop in ranges)
+            return _merge(partials, encoding)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_count_file_range, source, start, stop)
+                       for start, stop in ranges]
+            return _merge((future.result() for future in futures), encoding)
+
+    iterator = iter(source)
+    chunks = iter(lambda: list(itertools.islice(iterator, chunk_size)), [])
+
+    #A single chunk is counted here, a pool would only add its startup time
+    first = next(chunks, [])
+    second = next(chunks, None)
+    if workers == 1 or second is None:
+        head = [first] if second is None else [first, second]
+        return _merge(map(_count_chunk, itertools.chain(head, chunks)))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque(pool.submit(_count_chunk, chunk) for chunk in (first, second))
+
+        def partials():
+            for chunk in chunks:
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+                pending.append(pool.submit(_count_chunk, chunk))
+            while pending:
+                yield pending.popleft().result()
+
+        return _merge(partials())
+
+
+def _merge(partials, encoding=None):
+    '''
+    Returns:
+    --------
+    Counter; the sum of the partial Counters, in order. Bytes keys are decoded
+    '''
+
+    total = collections.Counter()
+    for partial in partials:
+        total.update(partial)
+
+    if encoding is None:
+        return total
+
+    decoded = collections.Counter()
+    for word, frequency in total.items():
+        decoded[word.decode(encoding, errors='replace')] += frequency
+
+    return decoded
+
+
+def top_words(counts, k=None):
+    '''
+    Returns:
+    --------
+    list of (word, frequency) tuples of the k most frequent words, most frequent
+    first. Ties keep the order of first occurrence. k=None returns every word
+
+    '''
+
+    if k is None:
+        return sorted(counts.items(), key=operator.itemgetter(1), reverse=True)
+
+    return heapq.nlargest(k, counts.items(), key=operator.itemgetter(1))
+
+
+def word_frequency_barplot(mylist, title, top=None, workers=None):
+
+    '''
+    Args:
+    --------
+    mylist: list or iterable of strings, or the path of a file with one entry per line
     title: string
+    top: int or None; only the top most frequent words are drawn. None draws all
+    workers: int; processes counting the words, see count_words
 
     Returns:
     --------
@@ -23,37 +206,16 @@ def word_frequency_barplot(mylist, title):
     Usage:
     --------
     word_frequency_barplot(list_of_animal_names, 'Animal Frequency')
+    word_frequency_barplot('labels.log', 'Label Frequency', top=30)
 
     '''
-    
-    #Get all of the unique names from the input list
-    list_of_unique_names = list(set(mylist))
-    
-    #Instantiate a dictionary for storing word:frequency pair
-    frequency_dictionary = {}
-
-    #Loop to fill the dictionary
-    for unique_name in list_of_unique_names:
-        
-        frequency_counter = 0
-
-        for name in mylist:
-    
-            if unique_name == name:
-        
-                frequency_counter += 1
-
-            else:
-                continue
-    
-        frequency_dictionary[unique_name] = frequency_counter
-
-
-    #Strip the list information from the dictionary and prepare it for pass to plt.box()
-    plot_names = sorted(frequency_dictionary, key=frequency_dictionary.get)
-    plot_frequencies = sorted(frequency_dictionary.values())
-    plot_names.reverse()
-    plot_frequencies.reverse()
+
+    import matplotlib.pyplot as plt
+
+    #Count the words in chunks and keep the most frequent ones, most frequent first
+    frequencies = top_words(count_words(mylist, workers=workers), top)
+    plot_names = [name for name, frequency in frequencies]
+    plot_frequencies = [frequency for name, frequency in frequencies]
 
 
     #Matplotlib stuff